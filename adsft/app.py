@@ -1,8 +1,226 @@
-from .models import KeyValue
+from .models import KeyValue, ExtractionState, Segment, SegmentEntry, \
+    ForwardedUpdate, Base
 from adsputils import ADSCelery
+from sqlalchemy import func, event
+from sqlalchemy.exc import IntegrityError, OperationalError
+from collections import OrderedDict
 import os
+import time
+import random
+import functools
+
+
+def retry_when_locked(method):
+    """Runs an operation of the store again when SQLite reports the database
+    locked by another worker process (once its busy timeout has passed, or
+    straight away when two transactions want to write at the same time)"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return method(self, *args, **kwargs)
+            except OperationalError as error:
+                if 'locked' not in str(error) or attempt >= self.locked_retries:
+                    raise
+                attempt += 1
+                time.sleep(random.uniform(0.05, 0.2) * attempt)
+    return wrapper
+
 
 class ADSFulltextCelery(ADSCelery):
 
-    pass
+    _extraction_state_ready = False
+
+    # Updates forwarded by this process, used instead of the database to drop
+    # duplicates when SQLALCHEMY_URL is not set
+    _forwarded = None
+    forwarded_cache_size = 100000
+
+    # Times an operation of the store is run again when the database is locked
+    locked_retries = 5
+
+    def database_enabled(self):
+        """Whether the local database is configured (SQLALCHEMY_URL), for the
+        segment store index and the forwarded updates"""
+        return self._session is not None
+
+    def extraction_state_enabled(self):
+        """Whether the extraction state store is enabled, in the local
+        database (SQLALCHEMY_URL): with EXTRACTION_STATE_STORE, or always
+        with the segment store, which has no meta.json to check instead"""
+        return self.database_enabled() and \
+            (bool(self.conf.get('EXTRACTION_STATE_STORE', False)) or
+             self.conf.get('OUTPUT_BACKEND', 'pairtree') == 'segments')
+
+    def _extraction_state_scope(self):
+        """Session scope for the local database (SQLALCHEMY_URL); its tables
+        (extraction state, segment store index and forwarded updates) are
+        created the first time it is used"""
+        if not self._extraction_state_ready:
+            if self._engine.dialect.name == 'sqlite':
+                event.listen(self._engine, 'connect', self._configure_sqlite)
+                self._engine.dispose()
+            Base.metadata.create_all(self._engine, tables=[ExtractionState.__table__,
+                                                           Segment.__table__,
+                                                           SegmentEntry.__table__,
+                                                           ForwardedUpdate.__table__])
+            self._extraction_state_ready = True
+        return self.session_scope()
+
+    def _configure_sqlite(self, connection, record):
+        """A SQLite database is shared by all the worker processes: it is used
+        in WAL mode, so that reads do not block the writes, and a write waits
+        up to SQLITE_BUSY_TIMEOUT seconds for the others"""
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA busy_timeout = {0:d}'.format(
+            int(self.conf.get('SQLITE_BUSY_TIMEOUT', 30) * 1000)))
+        cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.close()
+
+    @retry_when_locked
+    def get_extraction_state(self, bibcode):
+        """Returns the extraction state of the bibcode as a dictionary, or
+        None if it is not known"""
+        with self._extraction_state_scope() as session:
+            state = session.query(ExtractionState).filter_by(bibcode=bibcode).first()
+            if state is None:
+                return None
+            return state.toJSON()
+
+    @retry_when_locked
+    def update_extraction_state(self, values):
+        """Creates or updates the extraction state of values['bibcode']"""
+        with self._extraction_state_scope() as session:
+            state = session.query(ExtractionState).filter_by(bibcode=values['bibcode']).first()
+            if state is None:
+                state = ExtractionState(bibcode=values['bibcode'])
+                session.add(state)
+            for key, value in values.items():
+                setattr(state, key, value)
+
+    @retry_when_locked
+    def get_segment_entry(self, bibcode, kind):
+        """Returns the segment store index entry of the bibcode as a
+        dictionary, or None if it is not known"""
+        with self._extraction_state_scope() as session:
+            entry = session.query(SegmentEntry).filter_by(bibcode=bibcode, kind=kind).first()
+            if entry is None:
+                return None
+            return entry.toJSON()
+
+    @retry_when_locked
+    def get_segment_entries(self, segment):
+        """Returns the index entries pointing to the given segment"""
+        with self._extraction_state_scope() as session:
+            return [entry.toJSON() for entry in
+                    session.query(SegmentEntry).filter_by(segment=segment)]
+
+    @retry_when_locked
+    def update_segment_entry(self, values):
+        """Creates or updates the index entry of values['bibcode'] and
+        values['kind']"""
+        with self._extraction_state_scope() as session:
+            entry = session.query(SegmentEntry).filter_by(bibcode=values['bibcode'],
+                                                          kind=values['kind']).first()
+            if entry is None:
+                entry = SegmentEntry(bibcode=values['bibcode'], kind=values['kind'])
+                session.add(entry)
+            for key, value in values.items():
+                setattr(entry, key, value)
+
+    @retry_when_locked
+    def move_segment_entry(self, values, segment, offset):
+        """Updates the index entry of values['bibcode'] and values['kind'] only
+        if it still points to the given segment and offset (the record was not
+        written again meanwhile); returns whether it was updated"""
+        with self._extraction_state_scope() as session:
+            return session.query(SegmentEntry).filter_by(
+                bibcode=values['bibcode'], kind=values['kind'],
+                segment=segment, offset=offset).update(values) == 1
+
+    @retry_when_locked
+    def get_segments(self):
+        """Returns all the segments, with the number of bytes of their records
+        still in the index (live)"""
+        with self._extraction_state_scope() as session:
+            live = dict(session.query(SegmentEntry.segment,
+                                      func.sum(SegmentEntry.length))
+                        .group_by(SegmentEntry.segment))
+            segments = []
+            for segment in session.query(Segment).order_by(Segment.name):
+                segment = segment.toJSON()
+                segment['live'] = int(live.get(segment['name']) or 0)
+                segments.append(segment)
+            return segments
+
+    @retry_when_locked
+    def update_segment(self, values):
+        """Creates or updates the segment values['name']"""
+        with self._extraction_state_scope() as session:
+            segment = session.query(Segment).filter_by(name=values['name']).first()
+            if segment is None:
+                segment = Segment(name=values['name'])
+                session.add(segment)
+            for key, value in values.items():
+                setattr(segment, key, value)
+
+    @retry_when_locked
+    def delete_segment(self, name):
+        """Removes the segment from the index, it must not have entries"""
+        with self._extraction_state_scope() as session:
+            session.query(Segment).filter_by(name=name).delete()
+
+    @retry_when_locked
+    def claim_forward(self, bibcode, content_hash, window, now=None):
+        """Whether an update of the bibcode with the given content hash should
+        be forwarded to master: it should not if the same content was already
+        forwarded less than window seconds ago. If it should, it is recorded
+        as forwarded (see release_forward if forwarding fails). The record is
+        kept in the database when SQLALCHEMY_URL is set, so that all the
+        workers share it, otherwise in this process"""
+        if now is None:
+            now = int(time.time())
+
+        if not self.database_enabled():
+            if self._forwarded is None:
+                self._forwarded = OrderedDict()
+            previous = self._forwarded.pop(bibcode, None)
+            if previous is not None and previous[0] == content_hash \
+                    and now - previous[1] < window:
+                self._forwarded[bibcode] = previous
+                return False
+            self._forwarded[bibcode] = (content_hash, now)
+            if len(self._forwarded) > self.forwarded_cache_size:
+                self._forwarded.popitem(last=False)
+            return True
+
+        try:
+            with self._extraction_state_scope() as session:
+                forwarded = session.query(ForwardedUpdate).filter_by(bibcode=bibcode).first()
+                if forwarded is not None and forwarded.content_hash == content_hash \
+                        and now - forwarded.forwarded < window:
+                    return False
+                if forwarded is None:
+                    forwarded = ForwardedUpdate(bibcode=bibcode)
+                    session.add(forwarded)
+                forwarded.content_hash = content_hash
+                forwarded.forwarded = now
+        except IntegrityError:
+            # another worker claimed it at the same time
+            return False
+        return True
+
+    @retry_when_locked
+    def release_forward(self, bibcode, content_hash):
+        """Forgets that the update was forwarded (see claim_forward), so that
+        it is forwarded when it is sent again"""
+        if not self.database_enabled():
+            if self._forwarded is not None and \
+                    self._forwarded.get(bibcode, (None,))[0] == content_hash:
+                del self._forwarded[bibcode]
+            return
 
+        with self._extraction_state_scope() as session:
+            session.query(ForwardedUpdate).filter_by(bibcode=bibcode,
+                                                     content_hash=content_hash).delete()
@@ -23,25 +23,143 @@ import json
 import ptree
 import traceback
 
-from stat import ST_MTIME
+from stat import ST_MTIME, S_ISREG
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from dateutil.parser import parse
 from adsputils import setup_logging
-from adsft.utils import get_filenames
+from adsft.utils import get_filenames, compressed_file_name, find_stored_file
 
 logger = setup_logging(__name__)
 
 
-def file_last_modified_time(file_input):
+class StatCache(object):
+    """
+    Caches the result of os.stat for every path looked at while checking a
+    batch of records. On NFS each stat is a round trip to the file server,
+    while the checker asks several questions (does it exist, is it a file,
+    when was it modified, how big is it) about the same few paths per record.
+    It keeps count of the lookups requested and the stat calls really made.
+    """
+
+    def __init__(self, stats=None):
+        """
+        Initialisation (constructor) method of the class
+
+        :param stats: cached stat results to share with another cache
+        :return: no return
+        """
+        if stats is None:
+            stats = {}
+        self.stats = stats
+        self.requests = 0
+        self.calls = 0
+
+    def view(self):
+        """
+        New cache sharing the stat results of this one, but with its own
+        counters. Used to count the calls per record when records are checked
+        in different threads.
+
+        :return: StatCache
+        """
+        return StatCache(stats=self.stats)
+
+    def prefetch(self, paths):
+        """
+        Stats all the given paths in one go, without counting them as requests
+
+        :param paths: list of paths
+        :return: no return
+        """
+        for path in paths:
+            self._stat(path)
+
+    def _stat(self, path):
+        if path not in self.stats:
+            self.calls += 1
+            try:
+                self.stats[path] = os.stat(path)
+            except OSError:
+                self.stats[path] = None
+        return self.stats[path]
+
+    def stat(self, path):
+        """
+        Cached equivalent of os.stat, but returns None if the path does not
+        exist
+
+        :param path: path to file
+        :return: stat result or None
+        """
+        self.requests += 1
+        return self._stat(path)
+
+    def exists(self, path):
+        """
+        Cached equivalent of os.path.exists
+
+        :param path: path to file
+        :return: boolean value; does the path exist or not
+        """
+        return self.stat(path) is not None
+
+    def isfile(self, path):
+        """
+        Cached equivalent of os.path.isfile
+
+        :param path: path to file
+        :return: boolean value; is the path a regular file or not
+        """
+        stat = self.stat(path)
+        return stat is not None and S_ISREG(stat.st_mode)
+
+    def mtime(self, path):
+        """
+        Last modified time of the given path
+
+        :param path: path to file
+        :return: date time object of the last modified time
+        """
+        stat = self.stat(path)
+        if stat is None:
+            raise OSError('No such file: {0}'.format(path))
+        return datetime.fromtimestamp(stat[ST_MTIME])
+
+    def size(self, path):
+        """
+        Size of the given path
+
+        :param path: path to file
+        :return: size in bytes
+        """
+        stat = self.stat(path)
+        if stat is None:
+            raise OSError('No such file: {0}'.format(path))
+        return stat.st_size
+
+    def saved(self):
+        """
+        Number of stat calls avoided so far thanks to the cache
+
+        :return: number of calls saved
+        """
+        return self.requests - self.calls
+
+
+def file_last_modified_time(file_input, stat_cache=None):
     """
     Stats the given file to find the last modified time
 
     :param file_input: path to file
+    :param stat_cache: StatCache to use, a new one is created if not given
     :return: date time object of the last modified time
     """
 
-    mtime = os.stat(file_input)[ST_MTIME]
-    return datetime.fromtimestamp(mtime)
+    if stat_cache is None:
+        stat_cache = StatCache()
+
+    return stat_cache.mtime(file_input)
 
 
 def create_meta_path(dict_input, extract_path):
@@ -61,18 +179,22 @@ def create_meta_path(dict_input, extract_path):
     return extract_path
 
 
-def meta_output_exists(file_input, extract_path):
+def meta_output_exists(file_input, extract_path, stat_cache=None):
     """
     Checks if there is already a meta-data json file on disk.
 
     :param file_input: dictionary containing article meta-data
     :param extract_path: path to extract the full text content to
+    :param stat_cache: StatCache to use, a new one is created if not given
     :return: boolean value; does the path exist or not
     """
 
+    if stat_cache is None:
+        stat_cache = StatCache()
+
     meta_full_path = create_meta_path(file_input, extract_path)
 
-    if os.path.isfile(meta_full_path):
+    if stat_cache.isfile(meta_full_path):
         return True
     else:
         return False
@@ -110,14 +232,16 @@ def load_meta_file(file_input, extract_path):
 
 
 def meta_needs_update(dict_input, meta_content,
-                      extract_path):
+                      extract_path, stat_cache=None, compression=None):
     """
     By examining the meta-data file and the relevant full text file, it checks
     if the full text should be extracted for the first time (or again). The
     relevant reasons for extraction are:
       1. MISSING_FULL_TEXT: There is no full texte
       2. DIFFERING_FULL_TEXT: The path in the meta.json differs to the one given
-      3. STALE_CONTENT: the meta.json is older than the full text file
+      3. STALE_CONTENT: the meta.json is older than the source file, or the
+         full text file is not the one recorded in meta.json (or older than
+         meta.json, if it records none)
       4. STALE_META: the meta.json file does not all the required keys
 
     The return value is empty if none of the above are true.
@@ -125,9 +249,15 @@ def meta_needs_update(dict_input, meta_content,
     :param dict_input: dictionary containing article meta-data
     :param meta_content: the content in the old meta-data file
     :param extract_key: the content of the meta-data file
+    :param stat_cache: StatCache to use, a new one is created if not given
+    :param compression: compression the full text is expected to be stored
+    with, the full text stored with any compression is looked for
     :return: the keyword that describes why it should be extracted
     """
 
+    if stat_cache is None:
+        stat_cache = StatCache()
+
     # Obtain the indexed date within the meta file
     try:
         time_stamp = meta_content['index_date']
@@ -152,19 +282,19 @@ def meta_needs_update(dict_input, meta_content,
             dict_input['ft_source']:
         return 'DIFFERING_FULL_TEXT'
 
-    if not os.path.exists(meta_content['ft_source']):
+    if not stat_cache.exists(meta_content['ft_source']):
         return 'IGNORE_NON_EXISTENT_FT_SOURCE'
 
     # Content is considered 'stale'
     delta_comp_time = datetime.utcnow() - datetime.now()
 
     ft_source_last_modified = \
-        file_last_modified_time(meta_content['ft_source'])
+        file_last_modified_time(meta_content['ft_source'], stat_cache)
     ft_source_last_modified += delta_comp_time
 
     meta_path = create_meta_path(dict_input, extract_path)
 
-    meta_json_last_modified = file_last_modified_time(meta_path)
+    meta_json_last_modified = file_last_modified_time(meta_path, stat_cache)
 
     # If the source content is newer than the last time it was extracted
     logger.debug(
@@ -175,28 +305,163 @@ def meta_needs_update(dict_input, meta_content,
 
     # If the fulltext is older than the meta file
     fulltext_path = meta_path.replace('meta.json', 'fulltext.txt')
-    fulltext_last_modified = file_last_modified_time(fulltext_path)
+    fulltext_path = find_stored_file(fulltext_path, compression,
+                                     exists=stat_cache.exists) or fulltext_path
+
+    # meta.json records the full text file it was published with: the
+    # document was not completely written if they do not match
+    if 'fulltext_file' in meta_content:
+        stat = stat_cache.stat(fulltext_path)
+        logger.debug('FULLTEXT_PATH recorded: {0}'.format(
+            meta_content['fulltext_file']))
+        if stat is None or meta_content['fulltext_file'] != \
+                [os.path.basename(fulltext_path), stat.st_size, stat.st_mtime]:
+            return 'STALE_CONTENT'
+        return
+
+    fulltext_last_modified = file_last_modified_time(fulltext_path, stat_cache)
 
     logger.debug('FULLTEXT_PATH last modified: {0}'.format(fulltext_last_modified))
     if meta_json_last_modified > fulltext_last_modified:
         return 'STALE_CONTENT'
 
 
-def check_if_extract(message_list, extract_path):
+def state_needs_update(dict_input, state, stat_cache=None):
     """
-    For each bibcode in the list, it is checked if it should be extracted by
-    examining the meta-data supplied, the meta-data that exists in the current
-    file on disk, and the full text content file on path. The possible option
-    in this function are:
+    Equivalent of meta_needs_update when the extraction state store is used.
+    The state holds what was extracted and the modification time and size the
+    source file had at the time, so only the source file needs to be stat'ed:
+      1. DIFFERING_FULL_TEXT: The path in the state differs to the one given
+      2. STALE_CONTENT: the source file was modified since it was extracted
+
+    The return value is empty if none of the above are true.
+
+    :param dict_input: dictionary containing article meta-data
+    :param state: extraction state of the bibcode (see models.ExtractionState)
+    :param stat_cache: StatCache to use, a new one is created if not given
+    :return: the keyword that describes why it should be extracted
+    """
+
+    if stat_cache is None:
+        stat_cache = StatCache()
+
+    # Full text file path has changed
+    if state['ft_source'] != dict_input['ft_source']:
+        return 'DIFFERING_FULL_TEXT'
+
+    stat = stat_cache.stat(get_filenames(state['ft_source'])[0])
+    if stat is None:
+        return 'IGNORE_NON_EXISTENT_FT_SOURCE'
+
+    if int(stat.st_mtime) != state['source_mtime'] \
+            or stat.st_size != state['source_size']:
+        return 'STALE_CONTENT'
+
+
+def probe_message(message, extract_path, stat_cache, state_store=None,
+                  compression=None, has_files=True):
+    """
+    Carries out all the file system work needed to decide if a single record
+    should be extracted: stats of the meta-data, full text and source files
+    and reading of the meta-data file. The possible option in this function
+    are:
 
       1. NOT_EXTRACTED_BEFORE: has not been extracted
+      2. IGNORE_ZERO_BYTE_FT_SOURCE: the source file is empty
+      3. IGNORE_NON_EXISTENT_FT_SOURCE: the source file does not exist
+
+    The remaining possibilties come from meta_needs_update(), or from
+    state_needs_update() if a state store is given and knows the bibcode.
 
-    The remaining possibilties come from meta_needs_update(). If the type of
-    file is a PDF, it gets add to a different output list so that it can
-    get passed to a different extraction queue not used by the other file types.
+    :param message: dictionary containing the article meta-data
+    :param extract_path: path to extract the full text content to
+    :param stat_cache: StatCache used for this record
+    :param state_store: extraction state store (see app.py), optional
+    :param compression: compression the full text is expected to be stored with
+    :param has_files: whether the output backend writes the meta.json and full
+    text files (see storage.py), otherwise only the state store is used
+    :return: the update keyword and the first source file name
+    """
+
+    forced = message.get('UPDATE') in ('FORCE_TO_EXTRACT', 'FORCE_TO_SEND')
+    state = None
+    if state_store is not None and not forced:
+        state = state_store.get_extraction_state(message['bibcode'])
+
+    # Stat everything this record needs in one pass, the decisions below
+    # are then taken from the cache
+    meta_path = create_meta_path(message, extract_path)
+    # only check the first filename
+    ft = get_filenames(message['ft_source'])[0]
+    if forced or state is not None or not has_files:
+        stat_cache.prefetch([ft])
+    else:
+        stat_cache.prefetch([
+            meta_path,
+            compressed_file_name(meta_path.replace('meta.json', 'fulltext.txt'),
+                                 compression),
+            ft
+        ])
+
+    # message should be a dictionary
+    if 'UPDATE' in message \
+            and message['UPDATE'] == 'FORCE_TO_EXTRACT':
+        update = 'FORCE_TO_EXTRACT'
+    elif 'UPDATE' in message \
+            and message['UPDATE'] == 'FORCE_TO_SEND':
+        update = 'FORCE_TO_SEND'
+    elif state is not None:
+        update = state_needs_update(message, state, stat_cache)
+    elif not has_files:
+        logger.debug('No existing extraction state')
+        update = 'NOT_EXTRACTED_BEFORE'
+    elif meta_output_exists(message, extract_path, stat_cache):
+        meta_content = load_meta_file(message, extract_path)
+        update = meta_needs_update(message, meta_content,
+                                   extract_path, stat_cache,
+                                   compression=compression)
+    else:
+        logger.debug('No existing meta file')
+        update = 'NOT_EXTRACTED_BEFORE'
+
+    if stat_cache.exists(ft):
+        ft_source_size = stat_cache.size(ft) # bytes
+        if ft_source_size == 0:
+            update = 'IGNORE_ZERO_BYTE_FT_SOURCE'
+            logger.error("Bibcode '%s' is linked to a zero byte size file '%s'", message['bibcode'], message['ft_source'])
+    else:
+        update = 'IGNORE_NON_EXISTENT_FT_SOURCE'
+        logger.error("Bibcode '%s' is linked to a non-existent file '%s'", message['bibcode'], message['ft_source'])
+
+    logger.debug("Bibcode '%s', update required?: %s", message['bibcode'], update)
+    logger.debug("Bibcode '%s', stat calls saved by the cache: %d", message['bibcode'], stat_cache.saved())
+
+    return update, ft
+
+
+def check_if_extract(message_list, extract_path, concurrency=1,
+                     state_store=None, compression=None, has_files=True):
+    """
+    For each bibcode in the list, it is checked if it should be extracted by
+    examining the meta-data supplied, the meta-data that exists in the current
+    file on disk, and the full text content file on path (see probe_message).
+    If the type of file is a PDF, it gets add to a different output list so
+    that it can get passed to a different extraction queue not used by the
+    other file types.
+
+    The file system work is blocking I/O (typically on NFS), so when
+    concurrency is larger than one the records are probed in a pool of at
+    most that many threads. The output keeps the order of message_list.
 
     :param message_list: list of dictionaries the aricles meta-data
     :param extract_key: the content of the meta-data file
+    :param concurrency: maximum number of records probed at the same time
+    :param state_store: extraction state store used instead of the meta.json
+    files (see app.py), optional
+    :param compression: compression the full text is expected to be stored
+    with (FULLTEXT_COMPRESSION), it is the first one looked for
+    :param has_files: whether the output backend writes the meta.json and full
+    text files, see probe_message
     :return: dictionary containing two lists. One for PDF files and the other
     for normal files. It adds the extra keyword UPDATE which explains why the
     extraction of the full text is required.
@@ -209,35 +474,28 @@ def check_if_extract(message_list, extract_path):
     publish_list_of_standard_dictionaries = []
     publish_list_of_pdf_dictionaries = []
 
-    for message in message_list:
-
-        # message should be a dictionary
-        if 'UPDATE' in message \
-                and message['UPDATE'] == 'FORCE_TO_EXTRACT':
-            update = 'FORCE_TO_EXTRACT'
-        elif 'UPDATE' in message \
-                and message['UPDATE'] == 'FORCE_TO_SEND':
-            update = 'FORCE_TO_SEND'
-        elif meta_output_exists(message, extract_path):
-            meta_content = load_meta_file(message, extract_path)
-            update = meta_needs_update(message, meta_content,
-                                       extract_path)
-        else:
-            logger.debug('No existing meta file')
-            update = 'NOT_EXTRACTED_BEFORE'
-
-        # only check the first filename
-        ft = get_filenames(message['ft_source'])[0]
-        if os.path.exists(ft):
-            ft_source_size = os.stat(ft).st_size # bytes
-            if ft_source_size == 0:
-                update = 'IGNORE_ZERO_BYTE_FT_SOURCE'
-                logger.error("Bibcode '%s' is linked to a zero byte size file '%s'", message['bibcode'], message['ft_source'])
-        else:
-            update = 'IGNORE_NON_EXISTENT_FT_SOURCE'
-            logger.error("Bibcode '%s' is linked to a non-existent file '%s'", message['bibcode'], message['ft_source'])
-
-        logger.debug("Bibcode '%s', update required?: %s", message['bibcode'], update)
+    # All the stat calls of the batch go through the same cache, each record
+    # keeps its own counters
+    stat_cache = StatCache()
+    record_caches = [stat_cache.view() for message in message_list]
+
+    def probe(args):
+        message, record_cache = args
+        return probe_message(message, extract_path, record_cache,
+                             state_store=state_store, compression=compression,
+                             has_files=has_files)
+
+    if concurrency > 1 and len(message_list) > 1:
+        pool = ThreadPool(min(concurrency, len(message_list)))
+        try:
+            probes = pool.map(probe, zip(message_list, record_caches))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        probes = map(probe, zip(message_list, record_caches))
+
+    for message, (update, ft) in zip(message_list, probes):
 
         if update in NEEDS_UPDATE:
             message['meta_path'] = create_meta_path(message, extract_path)
@@ -268,6 +526,10 @@ def check_if_extract(message_list, extract_path):
 
                 publish_list_of_standard_dictionaries.append(message)
 
+    logger.debug('Stat calls: %d made, %d saved by the cache for %d records',
+                 sum([c.calls for c in record_caches]),
+                 sum([c.saved() for c in record_caches]),
+                 len(message_list))
 
     return {'Standard': publish_list_of_standard_dictionaries,
             'PDF': publish_list_of_pdf_dictionaries}
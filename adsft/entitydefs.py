@@ -14,6 +14,7 @@ __credit__ = ['V. Sudilovsky', 'A. Accomazzi', 'J. Luker']
 __license__ = 'GPLv3'
 
 import re
+import sys
 
 entitydefs = {
     'nsqsupe': u'\u22e3',
@@ -1900,29 +1901,84 @@ entitydefs = {
 }
 
 
+ENTITY = re.compile(r'&(#\d+|#x[0-9a-fA-F]+|\w+);')
+
+# Numeric references that are kept as they are: the markup characters, which
+# would change the markup when converted, and the characters not allowed in
+# XML
+MARKUP_CHARACTERS = frozenset([ord('&'), ord('<'), ord('>'), ord('"'), ord("'")])
+
+
+def is_xml_character(number):
+    """
+    Checks that the character can be part of an XML document
+
+    :param number: unicode number of the character
+    :return: boolean
+    """
+    return (number in (0x9, 0xA, 0xD)
+            or 0x20 <= number <= 0xD7FF
+            or 0xE000 <= number <= 0xFFFD
+            or 0x10000 <= number <= 0x10FFFF)
+
+
+def convertentity(name):
+    """
+    Converts the entity with the given name: using entitydefs for the named
+    ones, and into the character referenced for the numeric ones (decimal,
+    #NNN, or hexadecimal, #xNNN). Unknown entities, and numeric references to
+    markup characters or characters not allowed in XML, are kept as they are.
+
+    :param name: name of the entity, without the & and ;
+    :return: the string that should replace the entity
+    """
+    if name in entitydefs:
+        return entitydefs[name]
+
+    if name[0] == '#':
+        if name[1] == 'x':
+            number = int(name[2:], 16)
+        else:
+            number = int(name[1:])
+        if number not in MARKUP_CHARACTERS and is_xml_character(number):
+            if number > sys.maxunicode:
+                # narrow builds hold the character as a surrogate pair
+                number -= 0x10000
+                return unichr(0xD800 + (number >> 10)) + \
+                    unichr(0xDC00 + (number & 0x3FF))
+            return unichr(number)
+
+    return '&{0};'.format(name)
+
+
 def entitymap(match):
     """
-    Matches the HTML character and then checks if its inside any of the entity
-    definitions. If so, it replaces it using the dictionary outlined in
-    entitydefs
+    Matches the HTML character and then converts it, see convertentity
 
     :param match: the regular expression compressed string
     :return: the string that should replace the one given
     """
-    x = match.group(1)
-    if x in entitydefs:
-        return entitydefs[x]
+    return convertentity(match.group(1))
 
 
 def convertentities(input_string):
     """
-    Replaces any of the HTML/LaTeX types listed in entitydefs that are matched
-    by regular expression.
+    Replaces any of the HTML/LaTeX types listed in entitydefs, and the
+    numeric character references, that are matched by regular expression.
+    Unknown entities are kept.
 
     :param input_string: string that needs to be parsed
-    :return: string with the relevant characters removed
+    :return: string with the relevant characters replaced
     """
 
     if input_string is None:
         return input_string
-    return re.sub('&(#\d+|#x[0-9a-fA-F]+|\w+);', entitymap, input_string)
+
+    # Splitting on the entities gives the text around them at even positions
+    # and the names of the entities at odd ones. The names are looked up all
+    # at once, rather than calling entitymap for each match, which dominates
+    # for entity-dense documents.
+    parts = ENTITY.split(input_string)
+    get = entitydefs.get
+    parts[1::2] = [get(name) or convertentity(name) for name in parts[1::2]]
+    return ''.join(parts)
@@ -24,21 +24,140 @@ import os
 import requests
 from adsputils import overrides
 from adsputils import setup_logging
-from adsft.utils import TextCleaner, get_filenames
-from adsft import reader
+from adsft.utils import TextCleaner, TEXT_CLEANER_VERSION, get_filenames
+from adsft import reader, pdftotext, grobid
 import re
 import traceback
 import unicodedata
 from lxml.html import soupparser, document_fromstring, fromstring
-from lxml.etree import tostring
+from lxml.html import XHTMLParser
+from lxml.etree import tostring, XMLSyntaxError
+from lxml import etree
 from adsft import entitydefs as edef
-from adsft.rules import META_CONTENT
+from adsft.rules import META_CONTENT, compiled_xpath
 from requests.exceptions import HTTPError
-from subprocess import Popen, PIPE, STDOUT
 
 proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
 logger = setup_logging(__name__)
 
+# lxml parser used for well-formed XML, the elements it creates have the same
+# methods (e.g., text_content) as the ones created by soupparser
+XML_PARSER = XHTMLParser(resolve_entities=False, load_dtd=False,
+                         no_network=True, huge_tree=True)
+
+# Markup that lxml and BeautifulSoup do not read in the same way. Documents
+# containing any of it are parsed with soupparser.
+XML_SOUP_ONLY = re.compile(
+    # entities defined in the DTD, which is not loaded
+    r'&(?!(?:amp|lt|gt|quot|apos|#\d+|#x[0-9a-fA-F]+);)'
+    # line breaks and attribute values that lxml normalises
+    r'|\r(?!\n)'
+    r'|=\s*"[^"<>]*[\t\n][^"<>]*"'
+    r"|=\s*'[^'<>]*[\t\n][^'<>]*'"
+    # sections BeautifulSoup handles on its own
+    r'|<!\[CDATA\[|<!-- body|endbody -->|<\?CDATA'
+    r'|<(?:[pP][rR][eE]|[tT][eE][xX][tT][aA][rR][eE][aA]|[sS][cC][rR][iI][pP][tT])[\s/>]'
+)
+
+# Character references that BeautifulSoup keeps as text, and are given to it
+# in the decimal form it converts
+SOUP_CHARACTER_REFERENCES = re.compile(r'&(?:apos|#x([0-9a-fA-F]+));')
+
+XML_WHITESPACE = ' \t\n\r'
+
+
+def parse_well_formed_xml(raw_xml):
+    """
+    Parses the XML with lxml, when it can be read in the same way as
+    BeautifulSoup reads it. The tree is then made to look like the one built
+    by soupparser: tag names without default name space in lower case, text
+    made only of white space reduced to a new line or a space, and HTML
+    entities left in the text converted (soupparser converts them twice).
+    Entities and character references are already converted by lxml, so the
+    tree does not need the clean-up that soupparser's requires.
+
+    :param raw_xml: content of the XML file
+    :return: root element, or None if the XML needs soupparser
+    """
+    if XML_SOUP_ONLY.search(raw_xml):
+        return None
+
+    try:
+        root = etree.fromstring(raw_xml, XML_PARSER)
+    except (XMLSyntaxError, ValueError) as err:
+        logger.debug('XML is not well-formed, using soupparser: {0}'
+                     .format(err))
+        return None
+
+    for element in root.iter():
+        if isinstance(element.tag, basestring):
+            if element.prefix is None:
+                tag = element.tag.rsplit('}', 1)[-1].lower()
+                if tag != element.tag:
+                    element.tag = tag
+            for name, value in element.items():
+                if name != name.lower() and name[0] != '{':
+                    del element.attrib[name]
+                    element.set(name.lower(), value)
+                    name = name.lower()
+                if '&' in value:
+                    element.set(name, soupparser.unescape(value))
+            if element.text:
+                element.text = _soup_text(element.text)
+        if element.tail:
+            element.tail = _soup_text(element.tail)
+
+    etree.cleanup_namespaces(root)
+    return root
+
+
+def soup_character_reference(match):
+    """
+    Decimal form of the character reference matched by
+    SOUP_CHARACTER_REFERENCES
+
+    :param match: the regular expression match
+    :return: decimal character reference
+    """
+    if match.group(1) is None:
+        return '&#39;'
+    number = int(match.group(1), 16)
+    if not edef.is_xml_character(number):
+        return match.group(0)
+    return '&#{0};'.format(number)
+
+
+def _soup_text(text):
+    """
+    Text as soupparser would have it, see parse_well_formed_xml
+
+    :param text: text or tail of an lxml element
+    :return: text
+    """
+    if not text.strip(XML_WHITESPACE):
+        return '\n' if '\n' in text else ' '
+    if '&' in text:
+        return soupparser.unescape(text)
+    return text
+
+
+def get_attribute(element, name):
+    """
+    Value of the attribute of the element. soupparser keeps the prefix in the
+    name of the attribute (e.g., xlink:href), lxml the name space.
+
+    :param element: lxml element
+    :param name: name of the attribute
+    :return: value, or None if the element does not have the attribute
+    """
+    value = element.get(name)
+    if value is None and ':' in name:
+        prefix, local_name = name.split(':', 1)
+        if prefix in element.nsmap:
+            value = element.get('{{{0}}}{1}'.format(element.nsmap[prefix],
+                                                    local_name))
+    return value
+
 
 class StandardExtractorBasicText(object):
     """
@@ -229,7 +348,7 @@ class StandardExtractorHTML(object):
         # Remove anything before introduction
         for xpath in META_CONTENT[self.meta_name]['introduction']:
             try:
-                tmp = self.parsed_html.xpath(xpath)
+                tmp = compiled_xpath(xpath)(self.parsed_html)
                 if tmp and len(tmp) > 0:
                     removed_content = tmp[0] # TODO(rca): only first elem?
                     break
@@ -253,7 +372,7 @@ class StandardExtractorHTML(object):
         for xpath in META_CONTENT[self.meta_name]['references']:
             removed_content = None
             try:
-                removed_content = self.parsed_html.xpath(xpath)[0]
+                removed_content = compiled_xpath(xpath)(self.parsed_html)[0]
                 html_ul_element = removed_content.getnext()
                 html_ul_element.getparent().remove(html_ul_element)
                 removed_content.getparent().remove(removed_content)
@@ -277,7 +396,7 @@ class StandardExtractorHTML(object):
 
                 try:
                     table_node_to_insert = \
-                        table_root_node.xpath(xpath)[0].getparent()
+                        compiled_xpath(xpath)(table_root_node)[0].getparent()
                     break
 
                 except AttributeError:
@@ -293,8 +412,8 @@ class StandardExtractorHTML(object):
             for xpath in META_CONTENT[self.meta_name]['table_links']:
                 try:
                     logger.debug(self.parsed_html)
-                    table_nodes_in_file_source = self.parsed_html.xpath(
-                        xpath.replace('TABLE_NAME', table_name))
+                    table_nodes_in_file_source = compiled_xpath(xpath)(
+                        self.parsed_html, table_name=table_name)
                     break
 
                 except AttributeError:
@@ -305,10 +424,7 @@ class StandardExtractorHTML(object):
                 except Exception:
                     raise Exception(
                         'Could not find table links for'
-                        ' {0} (last xpath: {1})'.format(
-                            table_name,
-                            xpath.replace('TABLE_NAME', table_name)
-                        ))
+                        ' {0} (last xpath: {1})'.format(table_name, xpath))
 
             logger.debug('Attempting to replace table at table links: {0}'
                          .format(table_name))
@@ -324,7 +440,7 @@ class StandardExtractorHTML(object):
         try:
             for xpath in META_CONTENT[self.meta_name]['head']:
                 try:
-                    self.parsed_html.xpath(xpath)
+                    compiled_xpath(xpath)(self.parsed_html)
                     break
 
                 except Exception:
@@ -366,6 +482,7 @@ class StandardExtractorXML(object):
         self.file_input = dict_item['ft_source']
         self.raw_xml = None
         self.parsed_xml = None
+        self.well_formed = False
         self.meta_name = "xml"
         self.data_factory = {
             'string': self.extract_string,
@@ -378,9 +495,10 @@ class StandardExtractorXML(object):
 
         Removes some text that has no relevance for XML files, such as HTML tags, LaTeX entities
 
-        Note that soupparser.fromstring is called by both open_xml and parse_xml.  
-        open_xml uses soupparser.fromstring because the html and LaTex cleanup needs a string, not a parse tree
-        
+        Well-formed files are parsed once with lxml, and the tree is kept for parse_xml.
+        soupparser is only used for the others, which are then parsed by both open_xml and parse_xml:
+        open_xml parses them because the html and LaTex cleanup needs a string, not a parse tree.
+
         :return: semi-parsed XML content
         """
         raw_xml = None
@@ -391,14 +509,23 @@ class StandardExtractorXML(object):
             with open(self.file_input, 'rb') as fp:
                 raw_xml = fp.read()
 
-            # use soupparser to properly encode file contents
-            #  it could be utf-8, iso-8859, etc.
-            parsed_content = soupparser.fromstring(raw_xml)
-            # convert to string for ease of clean-up, convert html and LaTeX entities
-            raw_xml = tostring(parsed_content)
-            raw_xml = re.sub('(<!-- body|endbody -->)', '', raw_xml)
-            raw_xml = edef.convertentities(raw_xml)
-            raw_xml = re.sub('<\?CDATA.+?\?>', '', raw_xml)
+            # use lxml, or soupparser when it is not well-formed, to properly
+            # encode file contents, it could be utf-8, iso-8859, etc.
+            parsed_content = parse_well_formed_xml(raw_xml)
+            self.well_formed = parsed_content is not None
+            if self.well_formed:
+                # there is nothing to clean-up, entities are already converted
+                self.parsed_xml = parsed_content
+                raw_xml = tostring(parsed_content, encoding=unicode)
+            else:
+                parsed_content = soupparser.fromstring(
+                    SOUP_CHARACTER_REFERENCES.sub(soup_character_reference,
+                                                  raw_xml))
+                # convert to string for ease of clean-up, convert html and LaTeX entities
+                raw_xml = tostring(parsed_content)
+                raw_xml = re.sub('(<!-- body|endbody -->)', '', raw_xml)
+                raw_xml = edef.convertentities(raw_xml)
+                raw_xml = re.sub('<\?CDATA.+?\?>', '', raw_xml)
 
             logger.debug('reading')
             logger.debug('Opened file, trying to massage the input.')
@@ -414,15 +541,19 @@ class StandardExtractorXML(object):
 
     def parse_xml(self):
         """
-        Parses the encoded string read from the opened XML file. Removes inline formula from each XML node.
+        Parses the encoded string read from the opened XML file, unless open_xml already parsed it.
+        Removes inline formula from each XML node.
 
         :return: parsed XML file
         """
 
-        parsed_content = soupparser.fromstring(self.raw_xml)
+        if self.well_formed:
+            parsed_content = self.parsed_xml
+        else:
+            parsed_content = soupparser.fromstring(self.raw_xml)
 
         # strip out the latex stuff (for now)
-        for e in parsed_content.xpath('//inline-formula'):
+        for e in compiled_xpath('//inline-formula')(parsed_content):
             e.getparent().remove(e)
 
         self.parsed_xml = parsed_content
@@ -446,7 +577,8 @@ class StandardExtractorXML(object):
         else:
             translate = False
 
-        text_content = self.parsed_xml.xpath(static_xpath)[0].text_content()
+        text_content = \
+            compiled_xpath(static_xpath)(self.parsed_xml)[0].text_content()
         old = text_content
         text_content = TextCleaner(text=text_content).run(
             decode=decode,
@@ -486,11 +618,11 @@ class StandardExtractorXML(object):
                          ' returning an empty list')
             return data_inner
 
-        text_content = self.parsed_xml.xpath(static_xpath)
+        text_content = compiled_xpath(static_xpath)(self.parsed_xml)
 
         for span in text_content:
             try:
-                text_content = span.attrib.get(span_content)
+                text_content = get_attribute(span, span_content)
                 text_content = TextCleaner(text=text_content).run(
                     decode=decode,
                     translate=translate,
@@ -635,7 +767,7 @@ class StandardElsevierExtractorXML(StandardExtractorXML):
             self.parsed_xml = super(StandardElsevierExtractorXML,
                                     self).parse_xml()
             logger.debug('Checking soupparser handled itself correctly')
-            check = self.parsed_xml.xpath('//body')[0].text_content()
+            check = compiled_xpath('//body')(self.parsed_xml)[0].text_content()
             # this may be better? //named-content[@content-type="dataset"]
 
         except:
@@ -772,18 +904,47 @@ class PDFExtractor(object):
         self.bibcode = kwargs.get('bibcode', None)
         self.provider = kwargs.get('provider', None)
         self.extract_pdf_script = proj_home + kwargs.get('extract_pdf_script', '/scripts/extract_pdf_with_pdftotext.sh')
+        # pdftotext is run directly instead of its script, see pdftotext.py
+        self.pdftotext = None
+        if kwargs.get('extract_pdf_script', pdftotext.PDFTOTEXT_SCRIPT) == pdftotext.PDFTOTEXT_SCRIPT:
+            self.pdftotext = kwargs.get('pdftotext', None)
+        # timeout and resource limits of the extractor
+        self.limits = kwargs.get('extract_pdf_limits', None) or {}
+        # large PDFs are extracted by page ranges in parallel with pdftotext,
+        # see pdftotext.split_pages for the settings
+        self.parallel = kwargs.get('extract_pdf_parallel', None) or {}
+        # pool of extraction servers used instead of the script, see pdfserver.py
+        self.pdf_server = kwargs.get('pdf_server', None)
 
         if not self.ft_source:
             raise Exception('Missing or non-existent source: %s', self.ft_source)
 
     def extract_multi_content(self, translate=False, decode=True):
-        p = Popen([self.extract_pdf_script, self.ft_source], stdout=PIPE, stderr=PIPE)
-        stdout, stderr = p.communicate()
-        if p.returncode != 0:
-            raise Exception(stderr)
-        fulltext = TextCleaner(text=stdout).run(translate=translate,
-                                          decode=decode,
-                                          normalise=True)
+        if self.pdf_server is not None:
+            stdout = self.pdf_server.extract(self.ft_source)
+            fulltext = TextCleaner(text=stdout).run(translate=translate,
+                                              decode=decode,
+                                              normalise=True)
+        else:
+            ranges = None
+            if self.pdftotext:
+                if not os.path.exists(self.ft_source):
+                    raise Exception('File not found: {0}'.format(self.ft_source))
+                ranges = pdftotext.split_pages(self.ft_source, **self.parallel)
+            if ranges:
+                logger.debug('Extracting %s in %s page ranges', self.ft_source, len(ranges))
+                fulltext, metrics = pdftotext.run_parallel(
+                    self.ft_source, ranges, self.pdftotext, translate=translate,
+                    decode=decode, normalise=True, **self.limits)
+            else:
+                if self.pdftotext:
+                    command = pdftotext.pdftotext_command(self.ft_source, self.pdftotext)
+                else:
+                    command = [self.extract_pdf_script, self.ft_source]
+                fulltext, metrics = pdftotext.run(command, translate=translate,
+                                                  decode=decode, normalise=True,
+                                                  **self.limits)
+            pdftotext.log_metrics(self.bibcode, self.ft_source, metrics)
         return  {
                     'fulltext': fulltext,
                 }
@@ -795,30 +956,24 @@ class GrobidPDFExtractor(object):
         self.provider = kwargs.get('provider', None)
         self.timeout = 120 # seconds
         self.grobid_service = kwargs.get('grobid_service', None)
+        # client of the service kept by the worker, see grobid.py
+        self.grobid_client = kwargs.get('grobid_client', None)
 
         if not self.ft_source:
             raise Exception('Missing or non-existent source: %s', self.ft_source)
 
     def extract_multi_content(self, translate=False, decode=True):
         grobid_xml = ""
-        if self.grobid_service is not None:
+        client = self.grobid_client
+        if client is None and self.grobid_service is not None:
+            client = grobid.GrobidClient(self.grobid_service, timeout=self.timeout)
+        if client is not None:
+            logger.debug("Contacting grobid service: %s", client.service)
             try:
-                with open(ft_source, 'r'):
-                    logger.debug("Contacting grobid service: %s", self.grobid_service)
-                    response = requests.post(url=self.grobid_service, files={'input': ft_source}, timeout=self.timeout)
-            except IOError, error:
-                logger.exception("Error opening file %s: %s", self.ft_source, error)
-            except requests.exceptions.Timeout:
-                logger.exception("Grobid service timeout after %d seconds", self.timeout)
-            except:
-                logger.exception("Grobid request exception")
-            else:
-                if response.status_code == 200:
-                    logger.debug("Successful response from grobid server (%d bytes)", len(response.content))
-                    logger.debug("Successful response from grobid server: %s", response.content)
-                    grobid_xml = response.text
-                else:
-                    logger.error("Grobid service response error (code %s): %s", response.status_code, response.text)
+                grobid_xml = client.process(self.ft_source)
+            finally:
+                if client is not self.grobid_client:
+                    client.close()
         else:
             logger.debug("Grobid service not defined")
         grobid_xml = TextCleaner(text=grobid_xml).run(translate=translate,
@@ -844,6 +999,12 @@ EXTRACTOR_FACTORY = {
 }
 
 
+# Arguments of extract_content given to the extractors with each record
+EXTRACTOR_SETTINGS = ('grobid_service', 'grobid_client', 'extract_pdf_script',
+                      'pdf_server', 'pdftotext', 'extract_pdf_limits',
+                      'extract_pdf_parallel')
+
+
 def extract_content(input_list, **kwargs):
     """
     accept a list of dictionaries that contain the relevant meta-data for an
@@ -853,7 +1014,13 @@ def extract_content(input_list, **kwargs):
     settings.py).
 
     :param input_list: dictionaries that contain meta-data of articles
-    :param kwargs: used to store grobid service URL
+    :param kwargs: used to store grobid service URL or client (see grobid.py),
+    the PDF extraction script
+    or server pool (see pdfserver.py), pdftotext, the limits of the PDF
+    extractors and the parallel extraction settings (see pdftotext.py), and
+    the output backend
+    (see storage.py) or the compression of the full text read back for
+    FORCE_TO_SEND
     :return: json formatted list of dictionaries now containing full text
     """
 
@@ -868,12 +1035,18 @@ def extract_content(input_list, **kwargs):
         recovered_content = None
         if 'UPDATE' in dict_item and dict_item['UPDATE'] == 'FORCE_TO_SEND':
             # Read previously extracted data
-            recovered_content = reader.read_content(dict_item)
+            if kwargs.get('storage', None) is not None:
+                recovered_content = kwargs['storage'].read(dict_item)
+            else:
+                recovered_content = reader.read_content(
+                    dict_item, compression=kwargs.get('compression', None))
 
         if recovered_content is not None and recovered_content['fulltext'] != "":
             for key, value in recovered_content.iteritems():
                 if key != 'UPDATE':
                     dict_item[key] = value
+            # stored text may have been cleaned by an older TextCleaner
+            dict_item.pop('cleaned', None)
             output_list.append(dict_item)
         else:
             try:
@@ -893,8 +1066,9 @@ def extract_content(input_list, **kwargs):
                 raise KeyError(msg, traceback.format_exc())
 
             try:
-                dict_item['grobid_service'] = kwargs.get('grobid_service', None)
-                dict_item['extract_pdf_script'] = kwargs.get('extract_pdf_script', None)
+                # settings of the extractors, removed in the finally below
+                for key in EXTRACTOR_SETTINGS:
+                    dict_item[key] = kwargs.get(key, None)
                 # get one or more files from ft_source and process
                 files = get_filenames(dict_item['ft_source'])
                 for f in files:
@@ -912,14 +1086,24 @@ def extract_content(input_list, **kwargs):
                         else:
                             dict_item[item] = parsed_content[item]
 
-                del dict_item['grobid_service']
-                del dict_item['extract_pdf_script']
+                # the extractors clean the text they return, but the text of
+                # several files is joined (spaces, normalisation across the
+                # boundaries) and needs to be cleaned again
+                if len(files) == 1:
+                    dict_item['cleaned'] = TEXT_CLEANER_VERSION
+                else:
+                    dict_item.pop('cleaned', None)
 
                 output_list.append(dict_item)
 
             except Exception:
                 logger.exception("Fulltext extraction failed for bibcode '{}': '{}'".format(dict_item['bibcode'], dict_item['ft_source']))
                 raise Exception(traceback.format_exc())
+            finally:
+                # the worker's client and server pool must not stay in the
+                # record if the extraction fails
+                for key in EXTRACTOR_SETTINGS:
+                    dict_item.pop(key, None)
 
             del extractor, parsed_content
 
@@ -0,0 +1,324 @@
+"""
+Batched Forwarding
+
+task_output_results forwards one FulltextUpdate per document to master. With
+OUTPUT_BATCH_COUNT > 1 (config.py) the updates of a worker process are
+accumulated by an UpdateBatcher instead, and forwarded as a single
+FulltextUpdateList message when the batch reaches OUTPUT_BATCH_COUNT updates or
+OUTPUT_BATCH_BYTES bytes, or when its oldest update has waited
+OUTPUT_BATCH_AGE seconds. What is left is forwarded when the worker process
+shuts down. Without FulltextUpdateList in adsmsg, the updates are forwarded
+one by one as before: batching them would not save a message.
+
+The updates are acknowledged to the broker before their batch is forwarded,
+so the batcher is the only copy of them until it is. A batch that could not
+be forwarded is kept, and forwarded again with the next flush (at the latest
+OUTPUT_BATCH_AGE seconds later). So that the updates are not lost if the
+worker process is killed before that, each update is also written to an
+UpdateJournal, a file of the process that is emptied only once its batch is
+forwarded. The journals left by processes that died are read by the next
+batcher created on the same host, which forwards their updates again.
+
+The batcher keeps counters of the batches forwarded (stats()), and logs the
+size and the latency of each flush.
+"""
+
+import os
+import json
+import errno
+import socket
+import time
+import threading
+from collections import Counter
+from adsputils import setup_logging
+
+logger = setup_logging(__name__)
+
+# Upper bounds of the batch size histogram buckets (number of updates)
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class UpdateJournal(object):
+    """
+    File of the updates of the batch of a worker process, one JSON record per
+    line. Records are flushed to the operating system when they are written,
+    so that they survive the process being killed (but not the host crashing,
+    they are not fsynced). The file is named after the host and the process.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: directory of the journals, created if needed
+        """
+
+        try:
+            os.makedirs(path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        self.path = path
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+        self.claimed = 0
+        self.file = None
+
+    def _name(self, pid, suffix=''):
+        return os.path.join(self.path, '{0}-{1}{2}.journal'.format(
+            self.host, pid, suffix))
+
+    def _pid(self, name):
+        """Process of a journal of this host, or None"""
+        prefix = self.host + '-'
+        if not name.startswith(prefix) or not name.endswith('.journal'):
+            return None
+        try:
+            return int(name[len(prefix):].split('.')[0])
+        except ValueError:
+            return None
+
+    def recover(self):
+        """
+        Reads and removes the journals of the processes of this host that are
+        not running any more, and any previous journal of this process. Each
+        journal is renamed first, so that only one process recovers it.
+
+        :return: list of the records recovered
+        """
+
+        records = []
+        for name in sorted(os.listdir(self.path)):
+            pid = self._pid(name)
+            if pid is None or (pid != self.pid and process_running(pid)):
+                continue
+            self.claimed += 1
+            claimed = self._name(self.pid, '.{0}'.format(self.claimed))
+            try:
+                os.rename(os.path.join(self.path, name), claimed)
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+                continue
+            with open(claimed) as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # written partially when the process was killed
+                        logger.warning('Ignoring a partial record of %s', name)
+            os.remove(claimed)
+        if records:
+            logger.info('Recovered %s updates not forwarded by previous '
+                        'worker processes', len(records))
+        return records
+
+    def append(self, record):
+        """
+        Writes a record
+
+        :param record: JSON serialisable record of an update
+        :return: no return
+        """
+
+        if self.file is None:
+            self.file = open(self._name(self.pid), 'a')
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def clear(self):
+        """Empties the journal, once its updates are forwarded"""
+        if self.file is not None:
+            self.file.seek(0)
+            self.file.truncate()
+
+    def close(self):
+        """Closes the journal, which is removed if it is empty"""
+        if self.file is not None:
+            empty = self.file.tell() == 0
+            self.file.close()
+            self.file = None
+            if empty:
+                os.remove(self._name(self.pid))
+
+
+def process_running(pid):
+    """Whether a process of this host is running"""
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+class UpdateBatcher(object):
+    """
+    Accumulates updates and forwards them in batches, see the module docstring
+    """
+
+    def __init__(self, forward, max_count=100, max_bytes=10 * 1024 * 1024,
+                 max_age=5.0, journal=None):
+        """
+        :param forward: called with the list of updates of a batch
+        :param max_count: maximum number of updates of a batch
+        :param max_bytes: maximum size of a batch, the sum of the sizes given
+        to add()
+        :param max_age: seconds after which a batch is forwarded even if it
+        is not full (0 waits until it is full), and after which a batch that
+        could not be forwarded is forwarded again
+        :param journal: UpdateJournal the records given to add() are written
+        to until their batch is forwarded, optional
+        """
+
+        self.forward = forward
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.journal = journal
+        self.lock = threading.RLock()
+        self.timer = None
+        self._reset()
+        self.metrics = {
+            'batches': 0,
+            'updates': 0,
+            'bytes': 0,
+            'failures': 0,
+            'max_batch_size': 0,
+            'flush_seconds': 0.,
+            'max_flush_seconds': 0.,
+            'flush_reasons': Counter(),
+            'batch_sizes': Counter(),
+        }
+
+    def _reset(self):
+        self.updates = []
+        self.size = 0
+        self.started = None
+
+    def add(self, update, size=0, record=None):
+        """
+        Adds an update to the batch, which is forwarded if it is then full.
+        Exceptions raised forwarding it are propagated, the update is kept in
+        the batch either way.
+
+        :param update: update to forward
+        :param size: its size in bytes
+        :param record: JSON serialisable form of the update, written to the
+        journal until the batch is forwarded
+        :return: no return
+        """
+
+        with self.lock:
+            if self.journal is not None and record is not None:
+                self.journal.append(record)
+            if not self.updates:
+                self.started = time.time()
+                self._schedule()
+            self.updates.append(update)
+            self.size += size
+            if len(self.updates) >= self.max_count:
+                self.flush(reason='count')
+            elif self.size >= self.max_bytes:
+                self.flush(reason='bytes')
+            elif self.max_age and time.time() - self.started >= self.max_age:
+                self.flush(reason='age')
+
+    def _schedule(self):
+        """Forwards the batch started when it is max_age seconds old"""
+        if self.max_age:
+            self.timer = threading.Timer(self.max_age, self._expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _expire(self):
+        try:
+            self.flush(reason='age')
+        except Exception:
+            # already logged, the batch is forwarded again later
+            pass
+
+    def flush(self, reason='explicit'):
+        """
+        Forwards the updates accumulated, if any. If it fails, they are kept
+        in the batch and in the journal, to be forwarded again by the next
+        flush (scheduled max_age seconds later), and the exception is raised.
+
+        :param reason: why the batch is forwarded, counted in the metrics
+        :return: number of updates forwarded
+        """
+
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.updates:
+                return 0
+            updates, size, started = self.updates, self.size, self.started
+
+            start = time.time()
+            try:
+                self.forward(updates)
+            except Exception as err:
+                self.metrics['failures'] += 1
+                logger.error('Could not forward a batch of %s updates, it is '
+                             'kept to be forwarded again: %s', len(updates), err)
+                self._schedule()
+                raise
+            latency = time.time() - start
+            self._reset()
+            if self.journal is not None:
+                self.journal.clear()
+
+            count = len(updates)
+            metrics = self.metrics
+            metrics['batches'] += 1
+            metrics['updates'] += count
+            metrics['bytes'] += size
+            metrics['max_batch_size'] = max(metrics['max_batch_size'], count)
+            metrics['flush_seconds'] += latency
+            metrics['max_flush_seconds'] = max(metrics['max_flush_seconds'], latency)
+            metrics['flush_reasons'][reason] += 1
+            metrics['batch_sizes'][batch_size_bucket(count)] += 1
+            logger.info('Forwarded a batch of %s updates (%s bytes, %s) in %.3fs,'
+                        ' %.3fs after the first one', count, size, reason,
+                        latency, time.time() - started)
+            return count
+
+    def close(self):
+        """
+        Forwards what is left. If it fails, the journal is kept for the next
+        worker process of the host and the exception is raised.
+        """
+        try:
+            self.flush(reason='close')
+        finally:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                if self.journal is not None:
+                    self.journal.close()
+
+    def stats(self):
+        """
+        Counters of the batches forwarded so far, with the mean batch size and
+        flush latency
+
+        :return: dict
+        """
+
+        with self.lock:
+            stats = dict(self.metrics)
+            stats['flush_reasons'] = dict(stats['flush_reasons'])
+            stats['batch_sizes'] = dict(stats['batch_sizes'])
+            stats['pending'] = len(self.updates)
+            batches = stats['batches']
+            stats['mean_batch_size'] = float(stats['updates']) / batches if batches else 0.
+            stats['mean_flush_seconds'] = stats['flush_seconds'] / batches if batches else 0.
+            return stats
+
+
+def batch_size_bucket(count):
+    """Upper bound of the histogram bucket of a batch of count updates"""
+    for bound in BATCH_SIZE_BUCKETS:
+        if count <= bound:
+            return bound
+    return float('inf')
@@ -0,0 +1,283 @@
+"""
+Grobid Client
+
+GrobidPDFExtractor sends the PDFs to the Grobid service (GROBID_SERVICE in
+config.py) with a GrobidClient, kept by each worker process:
+
+  1. the connections are kept alive and reused (requests.Session)
+  2. the PDF is streamed to the service, instead of being read in memory
+     to build the multipart request
+  3. at most GROBID_CONCURRENCY requests are sent at the same time by the
+     worker process, which should match the number of threads of the
+     service (divided among the worker processes)
+  4. the service answers 503 when all its threads are busy: the request is
+     sent again after an exponential backoff (or the delay the service asks
+     for with Retry-After), as it is when the service cannot be reached
+
+GrobidStage keeps a number of PDFs at the service at all times from a single
+process, see scripts/grobid_consumer.py.
+"""
+
+import os
+import time
+import uuid
+import Queue
+import random
+import threading
+from collections import Counter
+import requests
+from requests.adapters import HTTPAdapter
+from adsputils import setup_logging
+
+logger = setup_logging(__name__)
+
+CHUNK_SIZE = 1 << 16
+
+
+class GrobidError(Exception):
+    """The service could not process the PDF"""
+
+
+class MultipartUpload(object):
+    """
+    multipart/form-data body made of a single file, read from disk as it is
+    sent. Its length is known, so that it is not sent chunked.
+    """
+
+    def __init__(self, field, file_path, content_type='application/pdf'):
+        """
+        :param field: name of the form field
+        :param file_path: path of the file
+        :param content_type: type of the file
+        """
+
+        boundary = uuid.uuid4().hex
+        file_name = os.path.basename(file_path)
+        if isinstance(file_name, unicode):
+            file_name = file_name.encode('utf-8')
+        self.content_type = 'multipart/form-data; boundary={0}'.format(boundary)
+        self.head = ('--{0}\r\nContent-Disposition: form-data; name="{1}"; '
+                     'filename="{2}"\r\nContent-Type: {3}\r\n\r\n').format(
+            boundary, field, file_name.replace('"', '%22'), content_type)
+        self.tail = '\r\n--{0}--\r\n'.format(boundary)
+        self.file = open(file_path, 'rb')
+        self.length = len(self.head) + os.fstat(self.file.fileno()).st_size + len(self.tail)
+        self.parts = [self.head, self.file, self.tail]
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length
+        data = []
+        while size > 0 and self.parts:
+            part = self.parts[0]
+            if isinstance(part, str):
+                chunk, rest = part[:size], part[size:]
+                if rest:
+                    self.parts[0] = rest
+                else:
+                    self.parts.pop(0)
+            else:
+                chunk = part.read(size)
+                if len(chunk) < size:
+                    self.parts.pop(0)
+            data.append(chunk)
+            size -= len(chunk)
+        return ''.join(data)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+
+class GrobidClient(object):
+    """
+    Client of the Grobid service, see the module docstring. It can be used
+    by several threads.
+    """
+
+    def __init__(self, service, concurrency=1, timeout=120, connect_timeout=10,
+                 max_retries=5, backoff=1.0, max_backoff=60):
+        """
+        :param service: URL of the processFulltextDocument service
+        :param concurrency: maximum number of requests sent at the same time
+        :param timeout: seconds to wait for the response to a request
+        :param connect_timeout: seconds to wait for a connection
+        :param max_retries: number of times a request is sent again when the
+        service is busy or cannot be reached
+        :param backoff: seconds before the first retry, doubled for every
+        other one
+        :param max_backoff: maximum seconds between retries
+        """
+
+        self.service = service
+        self.timeout = (connect_timeout, timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def delay(self, attempt, response=None):
+        """Seconds to wait before sending a request again"""
+        if response is not None:
+            try:
+                return min(float(response.headers['Retry-After']), self.max_backoff)
+            except (KeyError, ValueError):
+                pass
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        return delay * random.uniform(0.5, 1)
+
+    def post(self, file_path):
+        """Sends the PDF to the service once"""
+        upload = MultipartUpload('input', file_path)
+        try:
+            with self.slots:
+                return self.session.post(self.service, data=upload, timeout=self.timeout,
+                                         headers={'Content-Type': upload.content_type})
+        finally:
+            upload.close()
+
+    def process(self, file_path):
+        """
+        Extracts the structured full text of a PDF
+
+        :param file_path: path of the PDF
+        :return: unicode, the TEI XML returned by the service
+        """
+
+        attempt = 0
+        while True:
+            try:
+                response = self.post(file_path)
+            except requests.exceptions.ConnectionError as error:
+                if attempt >= self.max_retries:
+                    raise GrobidError('Grobid service unreachable: {0}'.format(error))
+                delay = self.delay(attempt)
+                logger.warning('Grobid service unreachable, retrying in %.1fs: %s', delay, error)
+            except requests.exceptions.Timeout:
+                raise GrobidError('Grobid service timeout after {0} seconds'.format(self.timeout[1]))
+            else:
+                if response.status_code == 200:
+                    logger.debug('Successful response from grobid server (%d bytes)', len(response.content))
+                    return response.text
+                if response.status_code != 503 or attempt >= self.max_retries:
+                    raise GrobidError('Grobid service response error (code {0}): {1}'.format(
+                        response.status_code, response.text))
+                delay = self.delay(attempt, response)
+                logger.debug('Grobid service busy, retrying in %.1fs', delay)
+            attempt += 1
+            time.sleep(delay)
+
+    def close(self):
+        self.session.close()
+
+
+class GrobidStage(object):
+    """
+    Keeps up to in_flight documents at the Grobid service from one process.
+    The documents submitted are extracted by in_flight threads, each waiting
+    on one request to the service, and their results are written by a single
+    writer thread, so that neither the requests nor the writes hold up the
+    thread that submits the documents (this is what an asyncio event loop
+    would do, but Python 2 has none).
+    """
+
+    def __init__(self, extract, write, in_flight=4):
+        """
+        :param extract: function extracting a document, returning the list
+        of its results
+        :param write: function writing a result, run in the writer thread
+        :param in_flight: number of documents extracted at the same time
+        """
+
+        self.extract = extract
+        self.write = write
+        self.documents = Queue.Queue()
+        # the extraction threads wait when the writer is behind
+        self.results = Queue.Queue(maxsize=in_flight)
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.extractors = [threading.Thread(target=self._extract_loop,
+                                            name='grobid-extract-{0}'.format(i))
+                           for i in range(in_flight)]
+        self.writer = threading.Thread(target=self._write_loop, name='grobid-write')
+        for thread in self.extractors + [self.writer]:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, documents, done=None):
+        """
+        Queues documents to extract and write, without waiting
+
+        :param documents: list of documents
+        :param done: called, in the writer thread, with the number of
+        documents that failed once all of them are written or failed
+        :return: no return
+        """
+
+        batch = {'pending': len(documents), 'failed': 0, 'done': done}
+        if not documents and done is not None:
+            done(0)
+        for document in documents:
+            self.documents.put((document, batch))
+
+    def _extract_loop(self):
+        while True:
+            item = self.documents.get()
+            if item is None:
+                return
+            document, batch = item
+            try:
+                results = self.extract(document)
+            except Exception:
+                logger.exception("Grobid extraction failed for bibcode '%s'",
+                                 document.get('bibcode'))
+                results = None
+            self.results.put((document, results, batch))
+
+    def _write_loop(self):
+        while True:
+            item = self.results.get()
+            if item is None:
+                return
+            document, results, batch = item
+            failed = results is None
+            if not failed:
+                try:
+                    for result in results:
+                        self.write(result)
+                except Exception:
+                    logger.exception("Could not write the Grobid extraction of '%s'",
+                                     document.get('bibcode'))
+                    failed = True
+            self._finish(batch, failed)
+
+    def _finish(self, batch, failed):
+        with self.lock:
+            self.stats['failed' if failed else 'written'] += 1
+            batch['pending'] -= 1
+            batch['failed'] += failed
+            finished = batch['pending'] == 0
+        if finished and batch['done'] is not None:
+            batch['done'](batch['failed'])
+
+    def close(self):
+        """Waits for the documents submitted to be written, and stops the threads"""
+        for thread in self.extractors:
+            self.documents.put(None)
+        for thread in self.extractors:
+            thread.join()
+        self.results.put(None)
+        self.writer.join()
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Text, TIMESTAMP
+from sqlalchemy import Column, Integer, BigInteger, String, Text, TIMESTAMP, \
+    Boolean
 
 Base = declarative_base()
 
@@ -13,3 +14,84 @@ class KeyValue(Base):
     
     def toJSON(self):
         return {'key': self.key, 'value': self.value } 
+
+
+class ExtractionState(Base):
+    """Extraction state of a bibcode: what was extracted (the content of the
+    meta.json file) and the attributes of the source file at that time. It
+    allows the checker to decide if a bibcode needs to be extracted again
+    without opening meta.json"""
+    __tablename__ = 'extraction_state'
+    bibcode = Column(String(255), primary_key=True)
+    ft_source = Column(Text)
+    provider = Column(String(255))
+    source_mtime = Column(BigInteger)
+    source_size = Column(BigInteger)
+    index_date = Column(String(255))
+    file_format = Column(String(255))
+    fulltext_hash = Column(String(40))
+
+    def toJSON(self):
+        return {'bibcode': self.bibcode,
+                'ft_source': self.ft_source,
+                'provider': self.provider,
+                'source_mtime': self.source_mtime,
+                'source_size': self.source_size,
+                'index_date': self.index_date,
+                'file_format': self.file_format,
+                'fulltext_hash': self.fulltext_hash}
+
+
+class Segment(Base):
+    """Segment file of the segment store (see storage.py). A segment is only
+    appended to by the process that owns it, until it is sealed; only sealed
+    segments are compacted"""
+    __tablename__ = 'segment'
+    name = Column(String(255), primary_key=True)
+    owner = Column(String(255))
+    sealed = Column(Boolean, default=False)
+    size = Column(BigInteger, default=0)
+
+    def toJSON(self):
+        return {'name': self.name,
+                'owner': self.owner,
+                'sealed': self.sealed,
+                'size': self.size}
+
+
+class SegmentEntry(Base):
+    """Offset index of the segment store: where the last record written for
+    a bibcode is (kind is fulltext, or grobid for the grobid extraction),
+    with the sha1 of its bytes"""
+    __tablename__ = 'segment_entry'
+    bibcode = Column(String(255), primary_key=True)
+    kind = Column(String(32), primary_key=True)
+    segment = Column(String(255), index=True)
+    offset = Column(BigInteger)
+    length = Column(BigInteger)
+    hash = Column(String(40))
+    compression = Column(String(16))
+
+    def toJSON(self):
+        return {'bibcode': self.bibcode,
+                'kind': self.kind,
+                'segment': self.segment,
+                'offset': self.offset,
+                'length': self.length,
+                'hash': self.hash,
+                'compression': self.compression}
+
+
+class ForwardedUpdate(Base):
+    """Last FulltextUpdate forwarded to master for a bibcode: the hash of its
+    content and when it was forwarded (seconds since the epoch). The same
+    content is not forwarded again within OUTPUT_DEDUP_WINDOW"""
+    __tablename__ = 'forwarded_update'
+    bibcode = Column(String(255), primary_key=True)
+    content_hash = Column(String(40))
+    forwarded = Column(BigInteger)
+
+    def toJSON(self):
+        return {'bibcode': self.bibcode,
+                'content_hash': self.content_hash,
+                'forwarded': self.forwarded}
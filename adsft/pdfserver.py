@@ -0,0 +1,282 @@
+"""
+PDF Extraction Server
+
+Running scripts/extract_pdf_with_pdfbox.sh for every PDF starts a JVM and
+loads PDFBox for every PDF, which often costs more than the extraction. With
+EXTRACT_PDF_SERVER set (config.py), the PDFs are instead sent to long-lived
+extractors started in server mode (scripts/pdfbox_server.sh, see App.serve),
+kept in a PDFServerPool by each worker process.
+
+Protocol, over the stdin and stdout of the server:
+
+  request:  4 byte big-endian length, then the path of the PDF in UTF-8 (a
+            length of 0 is a ping)
+  response: 1 status byte ('O' or 'E'), 4 byte big-endian length, then the
+            text of the PDF or the error message in UTF-8 (a ping is answered
+            with 'O' and 'pong')
+
+A server is replaced when it dies, when it does not answer a request in time,
+after max_documents PDFs, or when its resident memory goes above max_rss.
+Servers idle for more than ping_interval seconds are pinged before being
+used.
+"""
+
+import os
+import time
+import errno
+import Queue
+import select
+import signal
+import struct
+import threading
+from subprocess import Popen, PIPE
+from adsputils import setup_logging
+
+logger = setup_logging(__name__)
+
+STATUS_OK = 'O'
+STATUS_ERROR = 'E'
+
+REQUEST_HEADER = struct.Struct('>I')
+RESPONSE_HEADER = struct.Struct('>cI')
+
+
+class ExtractionError(Exception):
+    """The server could not extract the PDF, but can be used again"""
+
+
+class ServerError(Exception):
+    """The server died, timed out or broke the protocol"""
+
+
+class PDFServer(object):
+    """
+    One extraction server process
+    """
+
+    def __init__(self, command, timeout=300):
+        """
+        :param command: list, the command starting the server
+        :param timeout: seconds to wait for the response to a request
+        """
+
+        self.command = command
+        self.timeout = timeout
+        self.documents = 0
+        self.process = Popen(command, stdin=PIPE, stdout=PIPE, close_fds=True)
+        self.last_used = time.time()
+        logger.info('Started PDF extraction server %s: %s', self.process.pid,
+                    ' '.join(command))
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def rss(self):
+        """
+        Resident memory of the server in bytes, or None if it is not known
+        (no /proc)
+        """
+        try:
+            with open('/proc/{0}/status'.format(self.process.pid)) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except (IOError, ValueError, IndexError):
+            pass
+        return None
+
+    def _read(self, size, deadline):
+        """Reads exactly size bytes of the response before the deadline"""
+        data = []
+        fd = self.process.stdout.fileno()
+        while size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise ServerError('No response from the PDF extraction server'
+                                  ' after {0} seconds'.format(self.timeout))
+            try:
+                ready, _, _ = select.select([fd], [], [], remaining)
+            except select.error as err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not ready:
+                continue
+            chunk = os.read(fd, min(size, 1 << 20))
+            if not chunk:
+                raise ServerError('The PDF extraction server exited (code {0})'
+                                  .format(self.process.poll()))
+            data.append(chunk)
+            size -= len(chunk)
+        return ''.join(data)
+
+    def request(self, payload):
+        """
+        Sends a request to the server and waits for its response
+
+        :param payload: str, the request
+        :return: tuple of the status and the response
+        """
+
+        try:
+            self.process.stdin.write(REQUEST_HEADER.pack(len(payload)) + payload)
+            self.process.stdin.flush()
+        except IOError as err:
+            raise ServerError('Could not send the request to the PDF extraction'
+                              ' server: {0}'.format(err))
+        deadline = time.time() + self.timeout
+        status, length = RESPONSE_HEADER.unpack(
+            self._read(RESPONSE_HEADER.size, deadline))
+        response = self._read(length, deadline)
+        if status not in (STATUS_OK, STATUS_ERROR):
+            raise ServerError('Unexpected response status from the PDF'
+                              ' extraction server: {0!r}'.format(status))
+        self.last_used = time.time()
+        return status, response
+
+    def ping(self):
+        """Whether the server answers"""
+        try:
+            return self.request('') == (STATUS_OK, 'pong')
+        except ServerError as err:
+            logger.warning('PDF extraction server %s failed the health check: %s',
+                           self.process.pid, err)
+            return False
+
+    def extract(self, file_path):
+        """
+        Extracts the text of a PDF
+
+        :param file_path: path of the PDF
+        :return: str, the UTF-8 encoded text
+        """
+
+        if isinstance(file_path, unicode):
+            file_path = file_path.encode('utf-8')
+        status, response = self.request(file_path)
+        self.documents += 1
+        if status == STATUS_ERROR:
+            raise ExtractionError(response.decode('utf-8', 'replace'))
+        return response
+
+    def close(self, wait=5):
+        """
+        Stops the server: closes its input, and kills it if it does not exit
+
+        :param wait: seconds to wait for the server to exit
+        """
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
+        deadline = time.time() + wait
+        while self.process.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        if self.process.poll() is None:
+            try:
+                os.kill(self.process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            self.process.wait()
+        self.process.stdout.close()
+        logger.info('Stopped PDF extraction server %s after %s documents',
+                    self.process.pid, self.documents)
+
+
+class PDFServerPool(object):
+    """
+    Up to size extraction servers, started when they are needed, see the
+    module docstring
+    """
+
+    def __init__(self, command, size=1, timeout=300, max_documents=500,
+                 max_rss=None, ping_interval=60):
+        """
+        :param command: list, the command starting a server
+        :param size: maximum number of servers
+        :param timeout: seconds to wait for the text of a PDF
+        :param max_documents: number of PDFs after which a server is replaced
+        :param max_rss: resident memory in bytes above which a server is
+        replaced (None for no limit)
+        :param ping_interval: servers idle for more seconds are pinged before
+        being used
+        """
+
+        self.command = command
+        self.timeout = timeout
+        self.max_documents = max_documents
+        self.max_rss = max_rss
+        self.ping_interval = ping_interval
+        self.slots = threading.Semaphore(size)
+        self.idle = Queue.LifoQueue()
+        self.started = 0
+        self.replaced = 0
+
+    def _checkout(self):
+        self.slots.acquire()
+        try:
+            while True:
+                try:
+                    server = self.idle.get_nowait()
+                except Queue.Empty:
+                    self.started += 1
+                    return PDFServer(self.command, timeout=self.timeout)
+                if server.alive() and (
+                        time.time() - server.last_used < self.ping_interval
+                        or server.ping()):
+                    return server
+                self._replace(server, 'it is not healthy', wait=0)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def _checkin(self, server, healthy=True):
+        try:
+            if not healthy:
+                self._replace(server, 'it failed', wait=0)
+            elif self.max_documents and server.documents >= self.max_documents:
+                self._replace(server, 'it extracted {0} documents'.format(server.documents))
+            elif self.max_rss and (server.rss() or 0) > self.max_rss:
+                self._replace(server, 'it uses more than {0} bytes'.format(self.max_rss))
+            else:
+                self.idle.put(server)
+        finally:
+            self.slots.release()
+
+    def _replace(self, server, reason, wait=5):
+        """Stops a server, a new one is started when one is needed"""
+        logger.info('Replacing PDF extraction server %s: %s',
+                    server.process.pid, reason)
+        self.replaced += 1
+        server.close(wait=wait)
+
+    def extract(self, file_path):
+        """
+        Extracts the text of a PDF with one of the servers. ServerError is
+        raised if the server failed (a new one is used for the next PDF),
+        ExtractionError if it could not extract the PDF.
+
+        :param file_path: path of the PDF
+        :return: str, the UTF-8 encoded text
+        """
+
+        server = self._checkout()
+        try:
+            text = server.extract(file_path)
+        except ExtractionError:
+            self._checkin(server)
+            raise
+        except Exception:
+            self._checkin(server, healthy=False)
+            raise
+        self._checkin(server)
+        return text
+
+    def close(self):
+        """Stops the idle servers"""
+        while True:
+            try:
+                server = self.idle.get_nowait()
+            except Queue.Empty:
+                return
+            server.close()
@@ -0,0 +1,397 @@
+"""
+Running the PDF Extractors
+
+PDFExtractor runs pdftotext directly when EXTRACT_PDF_SCRIPT is the pdftotext
+script (PDFTOTEXT in config.py), instead of forking bash to run it, and any
+other script as before. Either way the extractor runs:
+
+  1. under a wall-clock timeout, after which it is killed with the processes
+     it started
+  2. under RLIMIT_AS (memory) and RLIMIT_CPU limits
+  3. with its output cleaned page by page (pages end with a form feed) as it
+     is read, instead of buffering all of it before cleaning it. The cleaning
+     is the same (TextCleaner does not change, add or remove form feeds, nor
+     combine characters across them)
+
+run() returns the timing and the size of each extraction, PDFExtractor logs
+them as metrics.
+
+Large PDFs (EXTRACT_PDF_PARALLEL_SIZE bytes, or EXTRACT_PDF_PARALLEL_PAGES
+pages if it is set) are split in page ranges, counted with pdfinfo, extracted
+by concurrent pdftotext processes, see run_parallel. pdftotext ends every page
+with a form feed, so the texts of the ranges joined in order are the text of
+the PDF.
+"""
+
+import os
+import time
+import json
+import errno
+import select
+import signal
+import resource
+import tempfile
+from subprocess import Popen, PIPE
+from adsputils import setup_logging
+
+from adsft.utils import TextCleaner
+
+logger = setup_logging(__name__)
+
+# The script replaced by running pdftotext directly
+PDFTOTEXT_SCRIPT = '/scripts/extract_pdf_with_pdftotext.sh'
+
+PAGE_BREAK = '\f'
+
+
+class ExtractionTimeout(Exception):
+    """The extractor did not finish in time and was killed"""
+
+
+def pdftotext_command(file_path, pdftotext='/usr/bin/pdftotext',
+                      first_page=None, last_page=None):
+    """
+    The pdftotext command run by the pdftotext script, optionally for a range
+    of pages only
+
+    :param file_path: path of the PDF
+    :param pdftotext: path of pdftotext
+    :param first_page: first page to extract (starting at 1)
+    :param last_page: last page to extract
+    :return: list, the command
+    """
+
+    command = [pdftotext, '-enc', 'UTF-8', '-eol', 'unix', '-q']
+    if first_page is not None:
+        command += ['-f', str(first_page)]
+    if last_page is not None:
+        command += ['-l', str(last_page)]
+    return command + [file_path, '-']
+
+
+def page_count(file_path, pdfinfo='/usr/bin/pdfinfo', timeout=60):
+    """
+    Number of pages of a PDF, read with pdfinfo
+
+    :param file_path: path of the PDF
+    :param pdfinfo: path of pdfinfo
+    :param timeout: seconds after which pdfinfo is killed
+    :return: number of pages, or None if pdfinfo failed
+    """
+
+    try:
+        info, metrics = run([pdfinfo, file_path], timeout=timeout,
+                            translate=False, decode=True, normalise=False,
+                            trim=False)
+    except Exception as err:
+        logger.warning('Could not count the pages of %s: %s', file_path, err)
+        return None
+    for line in info.splitlines():
+        if line.startswith('Pages:'):
+            try:
+                return int(line.split(':', 1)[1])
+            except ValueError:
+                break
+    return None
+
+
+def page_ranges(pages, processes):
+    """
+    Splits pages in up to processes ranges of consecutive pages
+
+    :param pages: number of pages
+    :param processes: number of ranges
+    :return: list of tuples of the first and last page of each range
+    """
+
+    size = max(1, -(-pages // processes))
+    return [(first, min(first + size - 1, pages))
+            for first in range(1, pages + 1, size)]
+
+
+def split_pages(file_path, processes=1, pages=None, size=None,
+                pdfinfo='/usr/bin/pdfinfo'):
+    """
+    Page ranges to extract the PDF in, if it is large enough to be extracted
+    in parallel
+
+    :param file_path: path of the PDF
+    :param processes: number of concurrent extractions
+    :param pages: PDFs with at least this many pages are split (None to only
+    split on size, without counting the pages of every PDF)
+    :param size: PDFs of at least this many bytes are split
+    :param pdfinfo: path of pdfinfo
+    :return: list of page ranges (see page_ranges), or None
+    """
+
+    if processes <= 1 or (pages is None and size is None):
+        return None
+    large = size is not None and os.path.getsize(file_path) >= size
+    if not large and pages is None:
+        return None
+    count = page_count(file_path, pdfinfo)
+    if count is None or count < 2:
+        return None
+    if large or count >= pages:
+        return page_ranges(count, processes)
+    return None
+
+
+def limit_resources(max_memory=None, max_cpu=None):
+    """
+    Function run in the extractor process before the extractor: puts it in
+    its own process group, so that the processes it starts are killed with
+    it, and sets its resource limits
+
+    :param max_memory: RLIMIT_AS in bytes
+    :param max_cpu: RLIMIT_CPU in seconds
+    :return: function
+    """
+
+    def preexec():
+        os.setsid()
+        if max_memory:
+            resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+        if max_cpu:
+            # SIGXCPU at the limit, SIGKILL a second later if it is ignored
+            resource.setrlimit(resource.RLIMIT_CPU, (max_cpu, max_cpu + 1))
+    return preexec
+
+
+def kill(process):
+    """Kills the process and the processes it started"""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    process.wait()
+
+
+class Extraction(object):
+    """
+    An extractor process, and the pages of its output cleaned as they are
+    read (pages end with a form feed)
+    """
+
+    def __init__(self, command, max_memory=None, max_cpu=None, **clean):
+        """
+        :param command: list, the command printing the text of the PDF
+        :param max_memory: RLIMIT_AS of the extractor in bytes
+        :param max_cpu: RLIMIT_CPU of the extractor in seconds
+        :param clean: arguments of TextCleaner.run
+        """
+
+        self.command = command
+        self.max_cpu = max_cpu
+        self.clean = clean
+        self.pages = []
+        self.page = []
+        self.output_bytes = 0
+        self.cpu_seconds = None
+        self.stderr = tempfile.TemporaryFile()
+        try:
+            self.process = Popen(command, stdout=PIPE, stderr=self.stderr, close_fds=True,
+                                 preexec_fn=limit_resources(max_memory, max_cpu))
+        except:
+            self.stderr.close()
+            raise
+        self.fd = self.process.stdout.fileno()
+
+    def read(self, chunk_size):
+        """
+        Reads and cleans the next chunk of the output
+
+        :param chunk_size: size of the read
+        :return: False at the end of the output, True otherwise
+        """
+
+        chunk = os.read(self.fd, chunk_size)
+        if not chunk:
+            self.pages.append(TextCleaner(text=''.join(self.page)).run(**self.clean))
+            self.page = []
+            return False
+        self.output_bytes += len(chunk)
+        if PAGE_BREAK in chunk:
+            parts = chunk.split(PAGE_BREAK)
+            self.page.append(parts[0])
+            self.pages.append(TextCleaner(text=''.join(self.page)).run(**self.clean))
+            self.pages.extend(TextCleaner(text=part).run(**self.clean)
+                              for part in parts[1:-1])
+            self.page = [parts[-1]]
+        else:
+            self.page.append(chunk)
+        return True
+
+    def reap(self):
+        """
+        Collects the exit status and the CPU time of the process, if it has
+        exited
+
+        :return: whether it has exited
+        """
+
+        if self.process.returncode is not None:
+            return True
+        try:
+            pid, status, usage = os.wait4(self.process.pid, os.WNOHANG)
+        except OSError as err:
+            if err.errno == errno.EINTR:
+                return False
+            raise
+        if pid == 0:
+            return False
+        if os.WIFSIGNALED(status):
+            self.process.returncode = -os.WTERMSIG(status)
+        else:
+            self.process.returncode = os.WEXITSTATUS(status)
+        self.cpu_seconds = usage.ru_utime + usage.ru_stime
+        return True
+
+    def kill(self):
+        """Kills the process, if it is still running, and closes its output"""
+        if self.process.returncode is None:
+            kill(self.process)
+        self.close()
+
+    def close(self):
+        self.process.stdout.close()
+        self.stderr.close()
+
+    def result(self):
+        """
+        The text extracted, once the process has exited
+
+        :return: tuple of the cleaned text, and a dict of metrics
+        (cpu_seconds, output_bytes, pages)
+        """
+
+        self.stderr.seek(0)
+        message = self.stderr.read()
+        self.close()
+        returncode = self.process.returncode
+        if returncode != 0:
+            if returncode == -signal.SIGXCPU:
+                message = '{0} went over its CPU limit of {1} seconds. {2}'.format(
+                    self.command[0], self.max_cpu, message)
+            raise Exception(message or '{0} failed (code {1})'.format(
+                self.command[0], returncode))
+
+        pages = self.pages
+        metrics = {
+            'cpu_seconds': self.cpu_seconds,
+            'output_bytes': self.output_bytes,
+            'pages': len(pages) - 1 if len(pages) > 1 and not pages[-1] else len(pages),
+        }
+        return PAGE_BREAK.join(pages), metrics
+
+
+def run_all(commands, timeout=None, max_memory=None, max_cpu=None,
+            chunk_size=1 << 16, **clean):
+    """
+    Runs extractors at the same time, cleaning their output as it is read,
+    see the module docstring. They are all started and read from the calling
+    thread: starting processes from several threads is not safe (preexec_fn)
+
+    :param commands: list of the commands printing the text of a PDF
+    :param timeout: wall-clock seconds after which the extractors still
+    running are killed
+    :param max_memory: RLIMIT_AS of each extractor in bytes
+    :param max_cpu: RLIMIT_CPU of each extractor in seconds
+    :param chunk_size: size of the reads of the output
+    :param clean: arguments of TextCleaner.run
+    :return: list of the results of Extraction.result, in order
+    """
+
+    deadline = time.time() + timeout if timeout else None
+    extractions = []
+    try:
+        for command in commands:
+            extractions.append(Extraction(command, max_memory, max_cpu, **clean))
+
+        reading = dict((extraction.fd, extraction) for extraction in extractions)
+        while reading:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise ExtractionTimeout('{0} did not finish in {1} seconds'
+                                            .format(commands[0][0], timeout))
+            try:
+                ready, _, _ = select.select(list(reading), [], [], remaining)
+            except select.error as err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                if not reading[fd].read(chunk_size):
+                    del reading[fd]
+
+        for extraction in extractions:
+            while not extraction.reap():
+                if deadline is not None and time.time() >= deadline:
+                    raise ExtractionTimeout('{0} did not finish in {1} seconds'
+                                            .format(commands[0][0], timeout))
+                time.sleep(0.01)
+    except:
+        for extraction in extractions:
+            extraction.kill()
+        raise
+
+    try:
+        return [extraction.result() for extraction in extractions]
+    finally:
+        for extraction in extractions:
+            extraction.close()
+
+
+def run(command, **kwargs):
+    """
+    Runs an extractor, cleaning its output as it is read, see the module
+    docstring
+
+    :param command: list, the command printing the text of the PDF
+    :param kwargs: arguments of run_all
+    :return: tuple of the cleaned text, and a dict of metrics (seconds,
+    cpu_seconds, output_bytes, pages)
+    """
+
+    start = time.time()
+    text, metrics = run_all([command], **kwargs)[0]
+    metrics['seconds'] = time.time() - start
+    return text, metrics
+
+
+def log_metrics(bibcode, file_path, metrics):
+    """Logs the metrics of an extraction, with the size of the PDF"""
+    metrics = dict(metrics, bibcode=bibcode, file=file_path)
+    try:
+        metrics['pdf_bytes'] = os.path.getsize(file_path)
+    except OSError:
+        pass
+    logger.info('PDF extraction metrics: %s', json.dumps(metrics, sort_keys=True))
+
+
+def run_parallel(file_path, ranges, pdftotext='/usr/bin/pdftotext', **kwargs):
+    """
+    Extracts the page ranges of a PDF with concurrent pdftotext processes
+    (see run_all), and joins their text in order
+
+    :param file_path: path of the PDF
+    :param ranges: list of the first and last page of each range
+    :param pdftotext: path of pdftotext
+    :param kwargs: arguments of run_all, the limits apply to each process
+    :return: tuple of the cleaned text, and the metrics of run() for the
+    whole extraction, with the number of ranges
+    """
+
+    start = time.time()
+    results = run_all([pdftotext_command(file_path, pdftotext, *page_range)
+                       for page_range in ranges], **kwargs)
+
+    metrics = {
+        'seconds': time.time() - start,
+        'ranges': len(ranges),
+    }
+    for key in ('cpu_seconds', 'output_bytes', 'pages'):
+        metrics[key] = sum(result[1][key] for result in results)
+    return u''.join(result[0] for result in results), metrics
@@ -9,36 +9,43 @@ import json
 from adsputils import setup_logging
 
 from adsft.rules import META_CONTENT
+from adsft.utils import decompress, file_compression, find_stored_file
 logger = setup_logging(__name__)
 
 
 def read_file(input_filename, json_format=True):
     """
-    Read file
+    Read file, decompressing it if its extension is the one of a compression
+    (see utils.FULLTEXT_COMPRESSIONS)
 
     :param input_filename: File name to be read
     :param json_format: whether the given content is in json format
     :return: File content
     """
 
-    with open(input_filename, 'r') as input_file:
+    with open(input_filename, 'rb') as input_file:
         if json_format:
             content = json.load(input_file)
         else:
-            content = input_file.read().decode('utf-8')
+            content = decompress(input_file.read(),
+                                 file_compression(input_filename))
+            content = content.decode('utf-8')
 
     logger.debug('Read file name: {0}'.format(input_filename))
 
     return content
 
 
-def read_content(payload_dictionary):
+def read_content(payload_dictionary, compression=None):
     """
     Function that reads previously extracted data. It expects a json-type
-    payload that has been converted into a Python dictionary.
+    payload that has been converted into a Python dictionary. The full text
+    is read whatever the compression it was stored with.
 
     :param payload_dictionary: the complete extracted content and meta-data of
     the document payload
+    :param compression: compression the full text is expected to have, it is
+    looked for first
     :return: modified dictionary with recovered content or None if files do not exist
     """
 
@@ -48,6 +55,8 @@ def read_content(payload_dictionary):
         full_text_output_file_path = os.path.join(bibcode_pair_tree_path, 'grobid_fulltext.xml')
     else:
         full_text_output_file_path = os.path.join(bibcode_pair_tree_path, 'fulltext.txt')
+    full_text_output_file_path = find_stored_file(full_text_output_file_path,
+                                                  compression)
 
     content = {}
     if os.path.exists(meta_output_file_path):
@@ -55,7 +64,7 @@ def read_content(payload_dictionary):
         for key, value in meta_dict.iteritems():
             content[key] = value
 
-        if os.path.exists(full_text_output_file_path):
+        if full_text_output_file_path is not None:
             fulltext = read_file(full_text_output_file_path, json_format=False)
             content['fulltext'] = fulltext
         else:
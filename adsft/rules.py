@@ -1,3 +1,5 @@
+from lxml.etree import XPath
+
 META_CONTENT = {
     'xml': {
         'fulltext': {
@@ -75,7 +77,7 @@ META_CONTENT = {
             '//table'
         ],
         'table_links': [
-            '//a[contains(@href, "TABLE_NAME")]'
+            '//a[contains(@href, $table_name)]'
         ],
         'head': [
             '//head'
@@ -87,3 +89,39 @@ META_CONTENT = {
     'pdf': {'fulltext': ['']},
     'pdf-grobid': {'grobid_fulltext': ['']},
 }
+
+
+# Compiled XPath of every rule above. Parameterised rules use XPath variables,
+# which are given when calling the compiled XPath, e.g.,
+#   compiled_xpath(xpath)(element, table_name='tableE.1.html')
+XPATHS = {}
+
+
+def compiled_xpath(xpath):
+    """
+    Returns the compiled version of the XPath, compiling and keeping it in the
+    registry if it is not one of the rules
+
+    :param xpath: XPath expression
+    :return: lxml.etree.XPath
+    """
+    if xpath not in XPATHS:
+        XPATHS[xpath] = XPath(xpath)
+    return XPATHS[xpath]
+
+
+def compile_rules(meta_content):
+    """
+    Compiles the XPath of all the rules given into the registry
+
+    :param meta_content: rules, in the format of META_CONTENT
+    :return: no return
+    """
+    for file_format_rules in meta_content.values():
+        for rule in file_format_rules.values():
+            for xpath in (rule['xpath'] if isinstance(rule, dict) else rule):
+                if xpath:
+                    compiled_xpath(xpath)
+
+
+compile_rules(META_CONTENT)
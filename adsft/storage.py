@@ -0,0 +1,482 @@
+"""
+Output Backends
+
+The extracted content of the documents can be stored in two ways (OUTPUT_BACKEND
+in config.py):
+
+  1. pairtree (default): a directory per bibcode (see ptree.id2ptree) holding
+     the meta.json file, the full text and the custom extractions, written by
+     writer.py and read back by reader.py
+  2. segments: append-only segment files holding one record per document, and
+     an offset index (bibcode -> segment, offset, length, hash) kept in the
+     local database (SQLALCHEMY_URL), see SegmentStorage
+
+Both backends have the same interface, write() and read(). The checker only
+looks for meta.json and full text files when the backend has them
+(has_files), otherwise it relies on the extraction state store.
+"""
+
+import os
+import json
+import errno
+import socket
+import hashlib
+import threading
+from datetime import datetime
+from adsputils import setup_logging
+
+from adsft import writer, reader
+from adsft.utils import check_compression, compress, decompress
+
+logger = setup_logging(__name__)
+
+OUTPUT_BACKENDS = ('pairtree', 'segments')
+
+# Size from which the segment appended to is sealed, and a new one started
+SEGMENT_MAX_SIZE = 1 << 30
+
+# Compaction rewrites the sealed segments with less live data than this ratio
+COMPACTION_LIVE_RATIO = 0.5
+
+
+class PairtreeStorage(object):
+    """
+    One directory per bibcode, see writer.write_content and
+    reader.read_content
+    """
+
+    name = 'pairtree'
+    has_files = True
+
+    def __init__(self, fsync=writer.FSYNC_NONE, compression=None):
+        """
+        :param fsync: fsync policy, one of writer.FSYNC_POLICIES
+        :param compression: compression of the full text, one of
+        utils.FULLTEXT_COMPRESSIONS
+        """
+
+        check_compression(compression)
+        self.fsync = fsync
+        self.compression = compression
+
+    def write(self, payload_dictionary, state_store=None):
+        """
+        Writes the extracted content of a document
+
+        :param payload_dictionary: the complete extracted content and meta-data
+        of the document payload
+        :param state_store: extraction state store (see app.py), optional
+        :return: whether the stored content changed
+        """
+
+        return writer.write_content(payload_dictionary, state_store=state_store,
+                             fsync=self.fsync, compression=self.compression)
+
+    def read(self, payload_dictionary):
+        """
+        Reads the previously extracted content of a document
+
+        :param payload_dictionary: the meta-data of the document
+        :return: dictionary with the content, or None if it was not extracted
+        """
+
+        return reader.read_content(payload_dictionary,
+                                   compression=self.compression)
+
+    def close(self):
+        pass
+
+
+class SegmentStorage(object):
+    """
+    Append-only segment files. Each document is a record, made of a header
+    line (bibcode, kind, length and sha1 of the data) followed by the data
+    and a new line. The data is the content reader.read_content would return,
+    in json, compressed with the configured compression. The kind is
+    'fulltext', or 'grobid' for the grobid extraction.
+
+    Each process appends to its own segment, and seals it once it reaches
+    max_segment_size (or when the storage is closed). The index (see
+    app.py) holds where the last record of each bibcode is: a record written
+    again leaves dead data behind, that compact() reclaims from the sealed
+    segments. check() verifies that the index and the segments agree.
+    """
+
+    name = 'segments'
+    has_files = False
+
+    def __init__(self, path, index, fsync=writer.FSYNC_NONE, compression=None,
+                 max_segment_size=SEGMENT_MAX_SIZE):
+        """
+        :param path: directory of the segment files
+        :param index: the segment store index, see app.py
+        :param fsync: fsync policy, one of writer.FSYNC_POLICIES
+        :param compression: compression of the records, one of
+        utils.FULLTEXT_COMPRESSIONS
+        :param max_segment_size: size from which a segment is sealed
+        """
+
+        if fsync not in writer.FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy: {0}'.format(fsync))
+        check_compression(compression)
+
+        self.path = path
+        self.index = index
+        self.fsync = fsync
+        self.compression = compression
+        self.max_segment_size = max_segment_size
+
+        self.lock = threading.Lock()
+        self.segment = None
+        self.segment_file = None
+        self.segment_size = 0
+        self.pid = None
+
+    @staticmethod
+    def record_kind(payload_dictionary):
+        """Kind of the record of the document"""
+        if payload_dictionary['file_format'] == 'pdf-grobid':
+            return 'grobid'
+        return 'fulltext'
+
+    def segment_path(self, name):
+        return os.path.join(self.path, name)
+
+    def _open_segment(self):
+        """Starts a new segment, owned by this process"""
+
+        try:
+            os.makedirs(self.path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+        owner = '{0}-{1}'.format(socket.gethostname(), os.getpid())
+        name = '{0}-{1}.seg'.format(
+            datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'), owner)
+        fd = os.open(self.segment_path(name),
+                     os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND,
+                     writer.FILE_MODE)
+        if self.fsync == writer.FSYNC_FILE_AND_DIR:
+            writer.fsync_directory(self.path)
+
+        self.index.update_segment({'name': name, 'owner': owner,
+                                   'sealed': False, 'size': 0})
+        self.segment = name
+        self.segment_file = os.fdopen(fd, 'ab')
+        self.segment_size = 0
+        self.pid = os.getpid()
+        logger.info('Started segment: {0}'.format(name))
+
+    def _seal(self):
+        """Seals the segment appended to, it can then be compacted"""
+
+        self.segment_file.close()
+        self.index.update_segment({'name': self.segment, 'sealed': True,
+                                   'size': self.segment_size})
+        logger.info('Sealed segment: {0} ({1} bytes)'.format(
+            self.segment, self.segment_size))
+        self.segment = None
+        self.segment_file = None
+
+    def append(self, bibcode, kind, data, compression=None):
+        """
+        Appends a record to the segment of this process
+
+        :param bibcode: bibcode of the document
+        :param kind: kind of the record
+        :param data: data of the record, already compressed
+        :param compression: compression of the data
+        :return: the index entry of the record
+        """
+
+        digest = hashlib.sha1(data).hexdigest()
+        header = '{0}\t{1}\t{2}\t{3}\n'.format(
+            bibcode, kind, len(data), digest).encode('utf-8')
+        with self.lock:
+            if self.segment_file is None or self.pid != os.getpid():
+                # a segment inherited from the parent process is not ours
+                self._open_segment()
+
+            self.segment_file.write(header + data + '\n')
+            self.segment_file.flush()
+            if self.fsync != writer.FSYNC_NONE:
+                os.fsync(self.segment_file.fileno())
+
+            entry = {'bibcode': bibcode, 'kind': kind,
+                     'segment': self.segment,
+                     'offset': self.segment_size + len(header),
+                     'length': len(data), 'hash': digest,
+                     'compression': compression}
+            self.segment_size += len(header) + len(data) + 1
+            if self.segment_size >= self.max_segment_size:
+                self._seal()
+
+        return entry
+
+    def write(self, payload_dictionary, state_store=None):
+        """
+        Writes the extracted content of a document as a new record, and points
+        the index to it. Nothing is written if the last record of the document
+        has the same content hash and source file.
+
+        :param payload_dictionary: the complete extracted content and meta-data
+        of the document payload
+        :param state_store: extraction state store (see app.py), optional
+        :return: whether the stored content changed
+        """
+
+        bibcode = payload_dictionary['bibcode']
+        kind = self.record_kind(payload_dictionary)
+        entry = self.index.get_segment_entry(bibcode, kind)
+
+        if payload_dictionary.get('UPDATE') == 'FORCE_TO_SEND' and \
+                entry is not None:
+            # Data was already extracted and saved
+            return False
+
+        if kind == 'grobid':
+            # the meta-data is the one of the regular PDF extraction
+            content = {'content_hash': writer.content_hash(payload_dictionary)}
+        else:
+            content = writer.meta_content(payload_dictionary)
+
+        if entry is not None and payload_dictionary.get('fulltext'):
+            previous = self._read_content(bibcode, kind, entry=entry)
+            if previous.get('content_hash') == content['content_hash'] \
+                    and previous.get('ft_source') == content.get('ft_source'):
+                logger.info('Content of {0} is unchanged, not writing it'
+                            .format(bibcode))
+                if kind != 'grobid' and state_store is not None:
+                    state_store.update_extraction_state(
+                        writer.extraction_state(payload_dictionary))
+                return False
+
+        content['fulltext'] = payload_dictionary.get('fulltext', '')
+
+        data = compress(json.dumps(content), self.compression)
+        entry = self.append(bibcode, kind, data, compression=self.compression)
+        self.index.update_segment_entry(entry)
+        logger.debug('Wrote {0} record of {1} to segment {2}'.format(
+            kind, bibcode, entry['segment']))
+
+        if kind != 'grobid' and state_store is not None:
+            state_store.update_extraction_state(
+                writer.extraction_state(payload_dictionary))
+        return True
+
+    def read_record(self, entry):
+        """
+        Reads the data of a record, and checks its hash
+
+        :param entry: index entry of the record
+        :return: the data of the record, still compressed
+        """
+
+        with open(self.segment_path(entry['segment']), 'rb') as segment_file:
+            segment_file.seek(entry['offset'])
+            data = segment_file.read(entry['length'])
+
+        if len(data) != entry['length'] \
+                or hashlib.sha1(data).hexdigest() != entry['hash']:
+            raise IOError('Corrupted {0} record of {1} in segment {2}'.format(
+                entry['kind'], entry['bibcode'], entry['segment']))
+        return data
+
+    def _read_content(self, bibcode, kind, entry=None):
+        if entry is None:
+            entry = self.index.get_segment_entry(bibcode, kind)
+        if entry is None:
+            return None
+        try:
+            data = self.read_record(entry)
+        except IOError as err:
+            # the segment may have been compacted since the index was read
+            if err.errno != errno.ENOENT:
+                raise
+            entry = self.index.get_segment_entry(bibcode, kind)
+            data = self.read_record(entry)
+        return json.loads(decompress(data, entry['compression']))
+
+    def read(self, payload_dictionary):
+        """
+        Reads the previously extracted content of a document
+
+        :param payload_dictionary: the meta-data of the document
+        :return: dictionary with the content, or None if it was not extracted
+        """
+
+        content = self._read_content(payload_dictionary['bibcode'], 'fulltext')
+        if content is None:
+            return None
+
+        if self.record_kind(payload_dictionary) == 'grobid':
+            grobid = self._read_content(payload_dictionary['bibcode'], 'grobid')
+            content['fulltext'] = grobid['fulltext'] if grobid else ''
+        return content
+
+    def close(self):
+        """Seals the segment appended to by this process"""
+
+        with self.lock:
+            if self.segment_file is not None and self.pid == os.getpid():
+                self._seal()
+
+    def compact(self, live_ratio=COMPACTION_LIVE_RATIO):
+        """
+        Rewrites the live records of the sealed segments that have less live
+        data than the given ratio into a new segment, and removes them. An
+        index entry is only moved if the record was not written again in the
+        meantime.
+
+        :param live_ratio: ratio of live data below which a segment is
+        compacted (1 compacts every segment with dead data)
+        :return: dictionary with the number of segments compacted, records
+        moved, and bytes freed
+        """
+
+        report = {'segments': 0, 'records': 0, 'freed': 0}
+        for segment in self.index.get_segments():
+            if not segment['sealed'] or segment['name'] == self.segment:
+                continue
+            if segment['size'] and \
+                    segment['live'] >= live_ratio * segment['size']:
+                continue
+
+            for entry in self.index.get_segment_entries(segment['name']):
+                data = self.read_record(entry)
+                moved = self.append(entry['bibcode'], entry['kind'], data,
+                                    compression=entry['compression'])
+                if self.index.move_segment_entry(moved, segment['name'],
+                                                 entry['offset']):
+                    report['records'] += 1
+
+            if self.index.get_segment_entries(segment['name']):
+                logger.warning('Segment {0} still has live records'.format(
+                    segment['name']))
+                continue
+
+            try:
+                os.remove(self.segment_path(segment['name']))
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+            self.index.delete_segment(segment['name'])
+            report['segments'] += 1
+            report['freed'] += segment['size']
+            logger.info('Compacted segment: {0}'.format(segment['name']))
+
+        self.close()
+        return report
+
+    def scan(self, name):
+        """
+        Reads the records of a segment in order
+
+        :param name: name of the segment
+        :return: generator of (bibcode, kind, offset, data, hash), IOError is
+        raised if the segment ends with a truncated record
+        """
+
+        with open(self.segment_path(name), 'rb') as segment_file:
+            position = 0
+            while True:
+                header = segment_file.readline()
+                if not header:
+                    return
+                fields = header[:-1].split('\t')
+                if not header.endswith('\n') or len(fields) != 4 \
+                        or not fields[2].isdigit():
+                    raise IOError('Truncated record at {0} in segment {1}'
+                                  .format(position, name))
+                bibcode, kind, length, digest = fields
+                data = segment_file.read(int(length))
+                if len(data) != int(length) or segment_file.read(1) != '\n':
+                    raise IOError('Truncated record at {0} in segment {1}'
+                                  .format(position, name))
+                yield bibcode, kind, position + len(header), data, digest
+                position += len(header) + len(data) + 1
+
+    def check(self):
+        """
+        Checks that the index and the segment files agree: every index entry
+        points to a record of the same bibcode and kind whose data matches its
+        hash, every segment of the index exists and is not truncated, and
+        there are no segment files unknown to the index.
+
+        :return: dictionary with the problems found, and the number of records
+        that are live, and dead (written again, or not in the index)
+        """
+
+        report = {'segments': 0, 'live': 0, 'dead': 0, 'missing': [],
+                  'truncated': [], 'corrupted': [], 'unknown': []}
+
+        try:
+            files = set(name for name in os.listdir(self.path)
+                        if name.endswith('.seg'))
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            files = set()
+
+        for segment in self.index.get_segments():
+            report['segments'] += 1
+            files.discard(segment['name'])
+            entries = dict(((entry['bibcode'], entry['kind']), entry) for entry
+                           in self.index.get_segment_entries(segment['name']))
+            found = set()
+            try:
+                for bibcode, kind, offset, data, digest in \
+                        self.scan(segment['name']):
+                    entry = entries.get((bibcode, kind))
+                    if entry is None or entry['offset'] != offset:
+                        report['dead'] += 1
+                        continue
+                    found.add((bibcode, kind))
+                    if entry['length'] != len(data) or entry['hash'] != digest \
+                            or hashlib.sha1(data).hexdigest() != digest:
+                        report['corrupted'].append((bibcode, kind))
+                    else:
+                        report['live'] += 1
+            except IOError as err:
+                if err.errno == errno.ENOENT:
+                    report['missing'].append(segment['name'])
+                    continue
+                logger.error(err)
+                report['truncated'].append(segment['name'])
+
+            for key in set(entries) - found:
+                report['corrupted'].append(key)
+
+        report['unknown'] = sorted(files)
+        return report
+
+
+def get_storage(config, index=None):
+    """
+    Output backend selected by the configuration (OUTPUT_BACKEND)
+
+    :param config: configuration of the application
+    :param index: extraction state store (see app.py), required by the
+    segment store for its index
+    :return: PairtreeStorage or SegmentStorage
+    """
+
+    backend = config.get('OUTPUT_BACKEND', 'pairtree')
+    fsync = config.get('WRITE_FSYNC', writer.FSYNC_NONE)
+    compression = config.get('FULLTEXT_COMPRESSION', None)
+
+    if backend == 'pairtree':
+        return PairtreeStorage(fsync=fsync, compression=compression)
+
+    if backend == 'segments':
+        if index is None:
+            raise ValueError('The segment store needs SQLALCHEMY_URL for its'
+                             ' index')
+        path = config.get('SEGMENT_STORE_PATH', None) or \
+            os.path.join(config['FULLTEXT_EXTRACT_PATH'], 'segments')
+        return SegmentStorage(
+            path, index, fsync=fsync, compression=compression,
+            max_segment_size=config.get('SEGMENT_MAX_SIZE', SEGMENT_MAX_SIZE))
+
+    raise ValueError('Unknown output backend: {0}'.format(backend))
@@ -2,10 +2,16 @@ from __future__ import absolute_import, unicode_literals
 from adsputils import get_date, exceptions
 import adsft.app as app_module
 from kombu import Queue
-from adsft import extraction, checker, writer
+from celery.signals import worker_process_shutdown
+from adsft import extraction, checker, storage, forwarding, pdfserver, grobid
+import adsmsg
 from adsmsg import FulltextUpdate
 import os
-from adsft.utils import TextCleaner
+import json
+import tempfile
+import hashlib
+from multiprocessing.pool import ThreadPool
+from adsft.utils import TextCleaner, TEXT_CLEANER_VERSION
 
 # ============================= INITIALIZATION ==================================== #
 
@@ -25,6 +31,154 @@ app.conf.CELERY_QUEUES = (
 # ============================= TASKS ============================================= #
 
 
+def extraction_state_store():
+    """
+    The app keeps the extraction state of every bibcode in a local database
+    when EXTRACTION_STATE_STORE and SQLALCHEMY_URL are set, otherwise the
+    meta.json files are used.
+    """
+    if app.extraction_state_enabled():
+        return app
+    return None
+
+
+_output_storage = {}
+
+def output_storage():
+    """
+    The output backend selected by OUTPUT_BACKEND (see storage.py), created
+    once per worker process. The segment store keeps its index in the local
+    database (SQLALCHEMY_URL).
+    """
+    backend = app.conf.get('OUTPUT_BACKEND', 'pairtree')
+    if backend not in _output_storage:
+        _output_storage[backend] = storage.get_storage(
+            app.conf, index=app if app.database_enabled() else None)
+    return _output_storage[backend]
+
+
+@worker_process_shutdown.connect
+def close_output_storage(**kwargs):
+    """Seals the segment the worker process was appending to"""
+    for output in _output_storage.values():
+        output.close()
+
+
+_pdf_server_pool = []
+
+def pdf_server_pool():
+    """
+    The pool of PDF extraction servers (see pdfserver.py), created once per
+    worker process, or None if EXTRACT_PDF_SERVER is not set (the
+    EXTRACT_PDF_SCRIPT is run for every PDF).
+    """
+    if not app.conf.get('EXTRACT_PDF_SERVER', None):
+        return None
+    if not _pdf_server_pool:
+        _pdf_server_pool.append(pdfserver.PDFServerPool(
+            [proj_home + app.conf['EXTRACT_PDF_SERVER']],
+            size=app.conf.get('EXTRACT_PDF_SERVER_POOL_SIZE', 1),
+            timeout=app.conf.get('EXTRACT_PDF_SERVER_TIMEOUT', 300),
+            max_documents=app.conf.get('EXTRACT_PDF_SERVER_MAX_DOCUMENTS', 500),
+            max_rss=app.conf.get('EXTRACT_PDF_SERVER_MAX_RSS', None),
+            ping_interval=app.conf.get('EXTRACT_PDF_SERVER_PING_INTERVAL', 60)))
+    return _pdf_server_pool[0]
+
+
+_grobid_client = []
+
+def grobid_client():
+    """
+    The client of the Grobid service (see grobid.py), created once per worker
+    process.
+    """
+    if not _grobid_client:
+        _grobid_client.append(grobid.GrobidClient(
+            app.conf['GROBID_SERVICE'],
+            concurrency=app.conf.get('GROBID_CONCURRENCY', 1),
+            timeout=app.conf.get('GROBID_TIMEOUT', 120),
+            max_retries=app.conf.get('GROBID_MAX_RETRIES', 5),
+            backoff=app.conf.get('GROBID_BACKOFF', 1.0)))
+    return _grobid_client[0]
+
+
+@worker_process_shutdown.connect
+def close_grobid_client(**kwargs):
+    """Closes the connections to the Grobid service"""
+    for client in _grobid_client:
+        client.close()
+
+
+@worker_process_shutdown.connect
+def close_pdf_server_pool(**kwargs):
+    """Stops the PDF extraction servers of the worker process"""
+    for pool in _pdf_server_pool:
+        pool.close()
+
+
+_output_batcher = []
+
+def output_batcher():
+    """
+    The batcher of the updates forwarded to master (see forwarding.py),
+    created once per worker process, or None if OUTPUT_BATCH_COUNT is not
+    greater than 1 or adsmsg has no FulltextUpdateList to forward a batch as
+    a single message. Its updates are journaled in OUTPUT_BATCH_JOURNAL_PATH
+    (default: output_batches in the temporary directory of the host), and the
+    updates left in the journals of the worker processes of the host that
+    died are added to it.
+    """
+    if app.conf.get('OUTPUT_BATCH_COUNT', 1) <= 1:
+        return None
+    if not _output_batcher:
+        if getattr(adsmsg, 'FulltextUpdateList', None) is None:
+            logger.warning('OUTPUT_BATCH_COUNT is ignored, adsmsg has no '
+                           'FulltextUpdateList to forward a batch with')
+            _output_batcher.append(None)
+            return None
+        journal = forwarding.UpdateJournal(
+            app.conf.get('OUTPUT_BATCH_JOURNAL_PATH', None) or
+            os.path.join(tempfile.gettempdir(), 'output_batches'))
+        batcher = forwarding.UpdateBatcher(
+            forward_updates,
+            max_count=app.conf['OUTPUT_BATCH_COUNT'],
+            max_bytes=app.conf.get('OUTPUT_BATCH_BYTES', 10485760),
+            max_age=app.conf.get('OUTPUT_BATCH_AGE', 5.0),
+            journal=journal)
+        _output_batcher.append(batcher)
+        for msg in journal.recover():
+            rec = FulltextUpdate(**msg)
+            try:
+                batcher.add(rec, size=rec.ByteSize(), record=msg)
+            except Exception:
+                # already logged, the batch is kept to be forwarded again
+                pass
+    return _output_batcher[0]
+
+
+def forward_updates(updates):
+    """
+    Forwards a batch of FulltextUpdate to master as a single
+    FulltextUpdateList message
+    """
+    app.forward_message(adsmsg.FulltextUpdateList(
+        fulltext_updates=[rec.toJSON() for rec in updates]))
+
+
+@worker_process_shutdown.connect
+def flush_output_batcher(**kwargs):
+    """Forwards the updates left in the batch"""
+    for batcher in _output_batcher:
+        if batcher is None:
+            continue
+        try:
+            batcher.close()
+        except Exception:
+            logger.exception('Could not forward the last batch, its updates are '
+                             'left in the journal for the next worker process')
+        logger.info('Forwarding stats: %s', batcher.stats())
+
+
 @app.task(queue='check-if-extract')
 def task_check_if_extract(message):
     """
@@ -37,7 +191,11 @@ def task_check_if_extract(message):
 
     logger.debug("Calling 'check_if_extract' with message '%s' and path '%s'", message, app.conf['FULLTEXT_EXTRACT_PATH'])
 
-    results = checker.check_if_extract(message, app.conf['FULLTEXT_EXTRACT_PATH'])
+    results = checker.check_if_extract(message, app.conf['FULLTEXT_EXTRACT_PATH'],
+                                       concurrency=app.conf.get('CHECK_IF_EXTRACT_CONCURRENCY', 1),
+                                       state_store=extraction_state_store(),
+                                       compression=app.conf.get('FULLTEXT_COMPRESSION', None),
+                                       has_files=output_storage().has_files)
     logger.debug('Results: %s', results)
     if results:
         for key in results:
@@ -62,29 +220,46 @@ def task_extract(message):
     if not isinstance(message, list):
         message = [message]
 
-    results = extraction.extract_content(message, extract_pdf_script=app.conf['EXTRACT_PDF_SCRIPT'])
+    results = extraction.extract_content(message, extract_pdf_script=app.conf['EXTRACT_PDF_SCRIPT'],
+                                         pdf_server=pdf_server_pool(),
+                                         pdftotext=app.conf.get('PDFTOTEXT', None),
+                                         extract_pdf_limits={
+                                             'timeout': app.conf.get('EXTRACT_PDF_TIMEOUT', None),
+                                             'max_memory': app.conf.get('EXTRACT_PDF_MAX_MEMORY', None),
+                                             'max_cpu': app.conf.get('EXTRACT_PDF_MAX_CPU', None),
+                                             },
+                                         extract_pdf_parallel={
+                                             'processes': app.conf.get('EXTRACT_PDF_PARALLEL', 1),
+                                             'pages': app.conf.get('EXTRACT_PDF_PARALLEL_PAGES', None),
+                                             'size': app.conf.get('EXTRACT_PDF_PARALLEL_SIZE', None),
+                                             'pdfinfo': app.conf.get('PDFINFO', '/usr/bin/pdfinfo'),
+                                             },
+                                         storage=output_storage())
     logger.debug('Results: %s', results)
     for r in results:
         logger.debug("Calling 'write_content' with '%s'", str(r))
         # Write locally to filesystem
-        writer.write_content(r)
+        changed = output_storage().write(r, state_store=extraction_state_store())
+
+        if changed is False and r.get('UPDATE') != 'FORCE_TO_SEND' \
+                and not app.conf.get('FORWARD_UNCHANGED_FULLTEXT', True):
+            # Master already has this content, do not make it reindex it
+            logger.info("Not forwarding the unchanged content of '%s'", r['bibcode'])
+            continue
 
         # Send results to master
         msg = {
                 'bibcode': r['bibcode'],
                 'body': r['fulltext'],
                 }
-        for x in ('acknowledgements', 'dataset'):
+        for x in ('acknowledgements', 'dataset', 'cleaned'):
             if x in r and r[x]:
                 msg[x] = r[x]
 
-        logger.debug("Calling 'task_output_results' with '%s'", msg)
-        task_output_results.delay(msg)
-
         # Send results to master only if fulltext is not an empty string
         if r['fulltext'] != "":
             logger.debug("Calling 'task_output_results' with '%s'", msg)
-            task_output_results.delay(msg)
+            task_output_results.delay(msg, force=r.get('UPDATE') == 'FORCE_TO_SEND')
 
 
 if app.conf['GROBID_SERVICE'] is not None:
@@ -101,26 +276,55 @@ if app.conf['GROBID_SERVICE'] is not None:
         for msg in message:
             msg['file_format'] += "-grobid"
 
-        results = extraction.extract_content(message, grobid_service=app.conf['GROBID_SERVICE'])
+        # the documents of the batch are sent to the service at the same
+        # time, up to GROBID_CONCURRENCY. The documents extracted are written
+        # even if others failed, then the task fails if any did
+        failed = []
+        def extract(msg):
+            try:
+                return extraction.extract_content([msg], grobid_client=grobid_client())
+            except Exception:
+                logger.exception("Grobid extraction failed for bibcode '%s'", msg['bibcode'])
+                failed.append(msg['bibcode'])
+                return []
+
+        concurrency = min(app.conf.get('GROBID_CONCURRENCY', 1), len(message))
+        if concurrency > 1:
+            pool = ThreadPool(concurrency)
+            try:
+                results = sum(pool.map(extract, message), [])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = sum(map(extract, message), [])
         logger.debug('Grobid results: %s', results)
         for r in results:
             logger.debug("Calling 'write_content' with '%s'", str(r))
             # Write locally to filesystem
-            writer.write_content(r)
+            output_storage().write(r)
 
             ## Send results to master
             #if r['grobid_fulltext'] != "":
                 #logger.debug("Calling 'task_output_results' with '%s'", msg)
                 #task_output_results.delay(msg)
 
+        if failed:
+            raise Exception('Grobid extraction failed for {0} of {1} documents: {2}'.format(
+                len(failed), len(message), ', '.join(failed)))
+
 
 @app.task(queue='output-results')
-def task_output_results(msg):
+def task_output_results(msg, force=False):
     """
     This worker will forward results to the outside
     exchange (typically an ADSMasterPipeline) to be
     incorporated into the storage
 
+    An update with the same content as the last one forwarded for the bibcode
+    less than OUTPUT_DEDUP_WINDOW seconds ago is dropped (redelivered or
+    resubmitted messages), unless force is set.
+
     :param msg: contains the bibliographic metadata
 
             {'bibcode': '....',
@@ -128,17 +332,47 @@ def task_output_results(msg):
              'title': '.....',
              .....
             }
+
+            and 'cleaned', the TextCleaner version the body was
+            cleaned with, if it was (see utils.TEXT_CLEANER_VERSION)
+    :param force: forward even if the same update was just forwarded
     :return: no return
     """
     
     # Ensure we send unicode normalized trimmed text. Extractors already do this,
-    # but we still have some file saved extraction that weren't cleaned.
-    msg['body'] = TextCleaner(text=msg['body']).run(translate=False, decode=True, normalise=True, trim=True)
+    # and mark the text they cleaned, but we still have some file saved
+    # extraction that weren't cleaned.
+    if msg.pop('cleaned', None) != TEXT_CLEANER_VERSION:
+        msg['body'] = TextCleaner(text=msg['body']).run(translate=False, decode=True, normalise=True, trim=True)
     
+    window = app.conf.get('OUTPUT_DEDUP_WINDOW', 0)
+    content_hash = None
+    if window and not force:
+        content_hash = hashlib.sha1(json.dumps(msg, sort_keys=True)).hexdigest()
+        if not app.claim_forward(msg['bibcode'], content_hash, window):
+            logger.info("Not forwarding '%s', the same update was forwarded less than %s seconds ago",
+                        msg['bibcode'], window)
+            return
+
     logger.debug('Will forward this record: %s', msg)
     rec = FulltextUpdate(**msg)
+
+    batcher = output_batcher()
+    if batcher is not None:
+        logger.debug("Adding '%s' to the batch forwarded to master", msg['bibcode'])
+        # kept by the batcher until it is forwarded, the claim of the update
+        # is not released if forwarding fails
+        batcher.add(rec, size=rec.ByteSize(), record=msg)
+        return
+
     logger.debug("Calling 'app.forward_message' with '%s'", str(rec))
-    app.forward_message(rec)
+    try:
+        app.forward_message(rec)
+    except Exception:
+        if content_hash is not None:
+            # let the retried message through
+            app.release_forward(msg['bibcode'], content_hash)
+        raise
 
 if __name__ == '__main__':
     app.start()
@@ -0,0 +1,110 @@
+"""
+Stand-in for the Grobid service, for the tests of the Grobid client. It
+answers the PDFs posted as the 'input' field of a multipart/form-data request
+with a TEI document giving their size and sha1, and records the requests it
+got. It can also be made to answer 503 (busy) and to be slow.
+
+Run on its own as:
+   python adsft/tests/grobid_stub.py [port]
+"""
+
+import sys
+import cgi
+import time
+import hashlib
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+TEI = '<TEI><teiHeader/><text><body>{0} bytes, sha1 {1}</body></text></TEI>'
+
+
+def tei(data):
+    """The document the stub answers a PDF with"""
+    return TEI.format(len(data), hashlib.sha1(data).hexdigest())
+
+
+class GrobidStubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, code, body, headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+                                environ={'REQUEST_METHOD': 'POST',
+                                         'CONTENT_TYPE': self.headers['Content-Type']})
+        with server.lock:
+            server.requests.append({
+                'path': self.path,
+                'content_length': self.headers.get('Content-Length'),
+                'transfer_encoding': self.headers.get('Transfer-Encoding'),
+                'connection': self.client_address,
+            })
+            busy = server.busy > 0
+            if busy:
+                server.busy -= 1
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            if busy:
+                self.respond(503, 'busy', server.busy_headers)
+                return
+            if 'input' not in form or not form['input'].filename:
+                self.respond(400, 'no input file')
+                return
+            time.sleep(server.delay)
+            self.respond(200, tei(form['input'].value))
+        finally:
+            with server.lock:
+                server.active -= 1
+
+
+class GrobidStubServer(ThreadingMixIn, HTTPServer):
+    """
+    The stub service, on localhost. Set busy to the number of requests to
+    answer 503, and delay to the seconds to take to answer a PDF.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), GrobidStubHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.busy = 0
+        self.busy_headers = {}
+        self.delay = 0
+        self.active = 0
+        self.max_active = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/api/processFulltextDocument'.format(self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    server = GrobidStubServer(int(sys.argv[1]) if len(sys.argv) > 1 else 8070)
+    print 'Grobid stub listening on {0}'.format(server.url)
+    server.serve_forever()
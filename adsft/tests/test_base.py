@@ -190,6 +190,12 @@ class TestUnit(unittest.TestCase):
         self.test_stub_ocr = \
             os.path.join(PROJ_HOME,
                          'tests/test_unit/stub_data/test.ocr')
+        self.test_stub_pdf = \
+            os.path.join(PROJ_HOME,
+                         'tests/test_integration/stub_data/full_test.pdf')
+        self.test_stub_pdf_server = \
+            os.path.join(PROJ_HOME,
+                         'tests/test_unit/stub_data/pdf_server_stub.py')
 
         self.test_functional_stub =\
             os.path.join(PROJ_HOME,
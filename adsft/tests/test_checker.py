@@ -2,7 +2,12 @@ import unittest
 import os
 import re
 
-from adsft import utils, checker
+import shutil
+import sqlite3
+import threading
+import tempfile
+from mock import patch
+from adsft import utils, checker, app, writer
 from adsft.tests import test_base
 
 class TestCheckIfExtracted(test_base.TestUnit):
@@ -342,6 +347,211 @@ class TestCheckIfExtracted(test_base.TestUnit):
         self.assertTrue(len(payload_false['PDF']) != 0)
 
 
+    def test_stat_cache(self):
+        """
+        Tests the StatCache class. Every path should only be stat'ed once,
+        and check_if_extract should not stat any path more than once per
+        batch.
+
+        :return: no return
+        """
+
+        cache = checker.StatCache()
+        self.assertTrue(cache.exists(self.test_stub_text))
+        self.assertTrue(cache.isfile(self.test_stub_text))
+        self.assertEqual(cache.size(self.test_stub_text),
+                         os.stat(self.test_stub_text).st_size)
+        self.assertFalse(cache.exists(self.test_stub_text + '.missing'))
+        self.assertRaises(OSError, cache.mtime,
+                          self.test_stub_text + '.missing')
+        self.assertEqual(cache.calls, 2)
+        self.assertEqual(cache.saved(), 3)
+
+        FileInputStream = utils.FileInputStream(self.test_file_exists)
+        FileInputStream.extract()
+
+        with patch('os.stat', wraps=os.stat) as stat:
+            payload = checker.check_if_extract(
+                FileInputStream.payload + FileInputStream.payload,
+                self.app.conf['FULLTEXT_EXTRACT_PATH']
+            )
+            paths = [call[0][0] for call in stat.call_args_list]
+
+        self.assertEqual(len(payload['PDF']), 2)
+        self.assertEqual(len(paths), len(set(paths)))
+
+    def test_concurrent_check_keeps_order(self):
+        """
+        Tests the check_if_extract function with a thread pool. The output
+        should be the same as when the records are checked one at a time.
+
+        :return: no return
+        """
+
+        links_file = os.path.join(self.proj_home, 'tests/test_integration/stub_data/fulltext_range_of_formats.links')
+
+        results = []
+        for concurrency in (1, 4):
+            FileInputStream = utils.FileInputStream(links_file)
+            FileInputStream.extract()
+            payload = checker.check_if_extract(
+                FileInputStream.payload,
+                self.app.conf['FULLTEXT_EXTRACT_PATH'],
+                concurrency=concurrency
+            )
+            results.append(dict(
+                (key, [(m['bibcode'], m['UPDATE'], m['file_format'])
+                       for m in payload[key]])
+                for key in payload))
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(len(results[1]['Standard']), 5)
+        self.assertEqual(len(results[1]['PDF']), 1)
+
+    def test_extraction_state_store(self):
+        """
+        Tests the check_if_extract function with an extraction state store.
+        Once the writer recorded the state of a bibcode, it should not be
+        extracted again until its source file changes.
+
+        :return: no return
+        """
+
+        db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        db_file.close()
+        self.addCleanup(os.remove, db_file.name)
+        state_store = app.ADSFulltextCelery('test', proj_home=self.proj_home, local_config=\
+            {
+            'SQLALCHEMY_URL': 'sqlite:///{0}'.format(db_file.name),
+            })
+        # the database alone does not enable it
+        self.assertTrue(state_store.database_enabled())
+        self.assertFalse(state_store.extraction_state_enabled())
+        state_store.conf['EXTRACTION_STATE_STORE'] = True
+        self.assertTrue(state_store.extraction_state_enabled())
+
+        message = {'bibcode': 'test_state', 'provider': 'MNRAS',
+                   'ft_source': self.test_stub_text}
+        self.assertEqual(state_store.get_extraction_state('test_state'), None)
+
+        payload = checker.check_if_extract(
+            [dict(message)], self.app.conf['FULLTEXT_EXTRACT_PATH'],
+            state_store=state_store
+        )
+        self.assertEqual(payload['Standard'][0]['UPDATE'], 'NOT_EXTRACTED_BEFORE')
+
+        state = writer.extraction_state(dict(payload['Standard'][0], fulltext=u'text'))
+        state_store.update_extraction_state(state)
+        self.assertEqual(state_store.get_extraction_state('test_state'), state)
+
+        with patch('adsft.checker.load_meta_file') as load_meta_file:
+            payload = checker.check_if_extract(
+                [dict(message)], self.app.conf['FULLTEXT_EXTRACT_PATH'],
+                state_store=state_store
+            )
+            self.assertFalse(load_meta_file.called)
+        self.assertEqual(payload['Standard'], [])
+
+        state_store.update_extraction_state({'bibcode': 'test_state', 'source_size': 0})
+        payload = checker.check_if_extract(
+            [dict(message)], self.app.conf['FULLTEXT_EXTRACT_PATH'],
+            state_store=state_store
+        )
+        self.assertEqual(payload['Standard'][0]['UPDATE'], 'STALE_CONTENT')
+
+        message['ft_source'] = self.test_stub_ocr
+        payload = checker.check_if_extract(
+            [dict(message)], self.app.conf['FULLTEXT_EXTRACT_PATH'],
+            state_store=state_store
+        )
+        self.assertEqual(payload['Standard'][0]['UPDATE'], 'DIFFERING_FULL_TEXT')
+        state_store.close_app()
+
+    def test_extraction_state_store_locked(self):
+        """
+        Tests that a SQLite extraction state store is used in WAL mode, and
+        that a write is tried again while another process holds the database
+        locked for longer than the busy timeout.
+
+        :return: no return
+        """
+
+        db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        db_file.close()
+        self.addCleanup(os.remove, db_file.name)
+        state_store = app.ADSFulltextCelery('test', proj_home=self.proj_home, local_config=\
+            {
+            'SQLALCHEMY_URL': 'sqlite:///{0}'.format(db_file.name),
+            'SQLITE_BUSY_TIMEOUT': 0.1,
+            })
+        self.addCleanup(state_store.close_app)
+        self.assertEqual(state_store.get_extraction_state('test_state'), None)
+        self.assertEqual(state_store._engine.execute('PRAGMA journal_mode').scalar(), 'wal')
+
+        other = sqlite3.connect(db_file.name, isolation_level=None,
+                                check_same_thread=False)
+        other.execute('BEGIN EXCLUSIVE')
+        release = threading.Timer(0.3, other.execute, ['COMMIT'])
+        release.start()
+        try:
+            state_store.update_extraction_state({'bibcode': 'test_state', 'source_size': 1})
+        finally:
+            release.join()
+            other.close()
+        self.assertEqual(state_store.get_extraction_state('test_state')['source_size'], 1)
+
+    def test_compressed_fulltext_is_not_stale(self):
+        """
+        Tests the check_if_extract function when the full text is stored
+        compressed. The document should not be extracted again, whatever the
+        compression the checker expects.
+
+        :return: no return
+        """
+
+        extract_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, extract_path)
+        message = {'bibcode': 'test_compressed', 'provider': 'MNRAS',
+                   'ft_source': self.test_stub_text}
+
+        payload = checker.check_if_extract([dict(message)], extract_path)
+        self.assertEqual(payload['Standard'][0]['UPDATE'], 'NOT_EXTRACTED_BEFORE')
+        writer.write_content(dict(payload['Standard'][0], fulltext=u'text'),
+                             compression='gzip')
+        self.assertTrue(os.path.exists(payload['Standard'][0]['meta_path']
+                                       .replace('meta.json', 'fulltext.txt.gz')))
+
+        for compression in (None, 'gzip'):
+            payload = checker.check_if_extract([dict(message)], extract_path,
+                                               compression=compression)
+            self.assertEqual(payload['Standard'], [], msg=compression)
+
+    def test_fulltext_not_recorded_in_meta_is_stale(self):
+        """
+        Tests the check_if_extract function when the full text on disk is not
+        the one meta.json was written with, e.g. the writer died while
+        publishing the document. It should be extracted again.
+
+        :return: no return
+        """
+
+        extract_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, extract_path)
+        message = {'bibcode': 'test_recorded', 'provider': 'MNRAS',
+                   'ft_source': self.test_stub_text}
+
+        payload = checker.check_if_extract([dict(message)], extract_path)
+        writer.write_content(dict(payload['Standard'][0], fulltext=u'text'))
+        payload = checker.check_if_extract([dict(message)], extract_path)
+        self.assertEqual(payload['Standard'], [])
+
+        fulltext_path = checker.create_meta_path(message, extract_path) \
+            .replace('meta.json', 'fulltext.txt')
+        with open(fulltext_path, 'w') as f:
+            f.write('partial')
+        payload = checker.check_if_extract([dict(message)], extract_path)
+        self.assertEqual(payload['Standard'][0]['UPDATE'], 'STALE_CONTENT')
+
 
 if __name__ == '__main__':
     unittest.main()
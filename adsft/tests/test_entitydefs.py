@@ -0,0 +1,58 @@
+import unittest
+import re
+
+from mock import patch
+from adsft import entitydefs as edef
+
+
+class TestConvertEntities(unittest.TestCase):
+    """
+    Tests the conversion of HTML and LaTeX entities.
+    """
+
+    def test_convertentities_uses_entitydefs(self):
+        """
+        Tests that the entities are converted as entitymap would do for each
+        of them, and that the ones in entitydefs are replaced.
+        """
+
+        texts = ['', 'no entities', '&alpha;&beta; &#8212; &#x3b2; &amp;',
+                 '&unknown; a&b; & ; &;', '&&alpha;;', u'caf\xe9 &le; 1',
+                 '&Sigma;' * 1000]
+        for text in texts:
+            expected = re.sub('&(#\d+|#x[0-9a-fA-F]+|\w+);', edef.entitymap,
+                              text)
+            self.assertEqual(edef.convertentities(text), expected)
+
+        self.assertEqual(edef.convertentities('a &alpha; b'), u'a \u03b1 b')
+        self.assertIsNone(edef.convertentities(None))
+
+    def test_convertentities_numeric_and_unknown(self):
+        """
+        Tests that decimal and hexadecimal character references are
+        converted, and that unknown entities are kept. References to markup
+        characters, or to characters not allowed in XML, are kept too.
+        """
+
+        self.assertEqual(edef.convertentities('&#8212; &#x3b2; &#X3b2; &#65;'),
+                         u'\u2014 \u03b2 &#X3b2; A')
+        self.assertEqual(edef.convertentities('&foo; &amp; &lt; A&amp;A'),
+                         '&foo; &amp; &lt; A&amp;A')
+        self.assertEqual(edef.convertentities('&#38; &#60; &#x3c; &#0; &#xd800; &#99999999;'),
+                         '&#38; &#60; &#x3c; &#0; &#xd800; &#99999999;')
+        self.assertEqual(edef.convertentities('&#9;&#10;&#x1F600;'),
+                         u'\t\n\U0001f600')
+
+    def test_convertentities_astral_on_narrow_builds(self):
+        """
+        Tests that references above sys.maxunicode are converted into a
+        surrogate pair, as narrow builds hold such characters.
+        """
+
+        with patch.object(edef.sys, 'maxunicode', 0xFFFF):
+            self.assertEqual(edef.convertentities('&#x1D400;&#1114111;'),
+                             u'\ud835\udc00\udbff\udfff')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,7 @@ from adsft import extraction, rules, utils
 from adsft.tests import test_base
 import unittest
 import httpretty
+from mock import patch
 from requests.exceptions import HTTPError
 
 class TestXMLExtractor(test_base.TestUnit):
@@ -74,6 +75,58 @@ class TestXMLExtractor(test_base.TestUnit):
 
         self.assertEqual(article_number, '483879')
 
+    def test_well_formed_xml_is_parsed_once_with_lxml(self):
+        """
+        Well-formed XML is parsed with lxml instead of soupparser, and the
+        content extracted must be the same as the one soupparser gives.
+
+        :return: no return
+        """
+
+        for ft_source, file_format in [(self.test_stub_xml, 'xml'),
+                                       (self.test_stub_teixml, 'teixml')]:
+            dict_item = {'ft_source': ft_source, 'bibcode': 'TEST'}
+            extractor = extraction.EXTRACTOR_FACTORY[file_format](dict_item)
+            with patch.object(extraction.soupparser, 'fromstring') as soup:
+                content = extractor.extract_multi_content()
+                self.assertFalse(soup.called)
+            self.assertTrue(extractor.well_formed)
+            # the tree parsed by open_xml is used, instead of parsing again
+            tree = extractor.parsed_xml
+            self.assertIs(extractor.parse_xml(), tree)
+
+            with patch.object(extraction, 'parse_well_formed_xml',
+                              return_value=None):
+                extractor = extraction.EXTRACTOR_FACTORY[file_format](dict_item)
+                self.assertEqual(content, extractor.extract_multi_content())
+            self.assertFalse(extractor.well_formed)
+
+    def test_xml_needing_soupparser(self):
+        """
+        XML that lxml and soupparser would read differently, such as entities
+        defined in the DTD, is parsed with soupparser.
+
+        :return: no return
+        """
+
+        self.assertIsNone(extraction.parse_well_formed_xml(
+            '<article><body>&alpha;</body></article>'))
+        self.assertIsNone(extraction.parse_well_formed_xml(
+            '<article><body><![CDATA[a & b]]></body></article>'))
+        self.assertIsNone(extraction.parse_well_formed_xml(
+            '<article><body>not closed</article>'))
+        # character references that BeautifulSoup would keep as text
+        self.assertEqual(extraction.SOUP_CHARACTER_REFERENCES.sub(
+            extraction.soup_character_reference, 'it&apos;s &#x3b2; &#xd800;'),
+            'it&#39;s &#946; &#xd800;')
+
+        root = extraction.parse_well_formed_xml(
+            '<Article xmlns="http://x" xmlns:xlink="http://www.w3.org/1999/xlink">'
+            '<BODY>  <p xlink:href="a&amp;amp;b">it&apos;s</p></BODY></Article>')
+        self.assertEqual(root.xpath('//body')[0].text, ' ')
+        self.assertEqual(root.xpath('//p')[0].text, "it's")
+        self.assertEqual(extraction.get_attribute(root.xpath('//p')[0], 'xlink:href'), 'a&b')
+
     def test_multi_file(self):
         """
         some entries in fulltext/all.links specify multiple files 
@@ -90,6 +143,32 @@ class TestXMLExtractor(test_base.TestUnit):
         content = extraction.extract_content([self.dict_item])
         # does the fulltext contain two copies of the file's contents
         self.assertEqual(2, content[0]['fulltext'].count('Entry 1'))
+        self.assertNotIn('cleaned', content[0])
+
+    def test_extracted_text_is_marked_cleaned(self):
+        """
+        Tests that the extracted full text is marked with the version of the
+        TextCleaner, and that cleaning it again as task_output_results did
+        does not change it.
+
+        :return: no return
+        """
+
+        for ft_source, file_format, provider in (
+                (self.test_stub_xml, 'xml', 'MNRAS'),
+                (self.test_stub_iso8859, 'xml', 'MNRAS'),
+                (self.test_stub_exml, 'xml', 'Elsevier'),
+                (self.test_stub_html, 'html', 'MNRAS'),
+                (self.test_stub_text, 'txt', 'MNRAS'),
+                (self.test_stub_ocr, 'ocr', 'MNRAS')):
+            content = extraction.extract_content([{
+                'ft_source': ft_source, 'file_format': file_format,
+                'provider': provider, 'bibcode': 'test'}])[0]
+            self.assertEqual(content['cleaned'], utils.TEXT_CLEANER_VERSION)
+            self.assertEqual(
+                utils.TextCleaner(text=content['fulltext']).run(
+                    translate=False, decode=True, normalise=True, trim=True),
+                content['fulltext'], ft_source)
 
 
     def test_that_we_can_extract_using_settings_template(self):
@@ -479,6 +558,26 @@ class TestHTMLExtractor(test_base.TestUnit):
             self.assertTrue(table_content[key].xpath('//table'))
             self.assertTrue(self.extractor.parsed_html.xpath('//h2'))
 
+    def test_that_the_rules_are_compiled(self):
+        """
+        Tests that the XPath of the rules are compiled once, and that the
+        table links XPath finds the links to the table given as a variable.
+
+        :return: no return
+        """
+
+        for xpaths in rules.META_CONTENT['html'].values():
+            for xpath in xpaths:
+                self.assertIs(rules.compiled_xpath(xpath), rules.XPATHS[xpath])
+
+        raw_html = self.extractor.open_html()
+        parsed_html = self.extractor.parse_html()
+        table_name = os.path.basename(self.test_stub_html_table)
+        table_links = rules.compiled_xpath(
+            rules.META_CONTENT['html']['table_links'][0])
+        self.assertTrue(table_links(parsed_html, table_name=table_name))
+        self.assertFalse(table_links(parsed_html, table_name='no_table.html'))
+
     def test_that_we_can_extract_using_settings_template(self):
         """
         Tests the extract_mutli_content. This checks that the full text that was
@@ -0,0 +1,156 @@
+import unittest
+import os
+import time
+import shutil
+import tempfile
+
+from mock import patch
+from adsft import forwarding
+
+
+class TestUpdateBatcher(unittest.TestCase):
+    """
+    Tests that the updates are forwarded in batches bounded in count, size and
+    age, and the metrics of the batches forwarded.
+    """
+
+    def setUp(self):
+        self.batches = []
+        self.batcher = forwarding.UpdateBatcher(
+            self.batches.append, max_count=3, max_bytes=100, max_age=0)
+
+    def test_count_and_size(self):
+        """
+        Tests that a batch is forwarded when it is full.
+
+        :return: no return
+        """
+
+        for i in range(7):
+            self.batcher.add(i, size=1)
+        self.assertEqual(self.batches, [[0, 1, 2], [3, 4, 5]])
+        self.batcher.add('big', size=200)
+        self.assertEqual(self.batches[-1], [6, 'big'])
+        self.assertEqual(self.batcher.flush(), 0)
+
+        self.batcher.add('last', size=1)
+        self.batcher.close()
+        self.assertEqual(self.batches[-1], ['last'])
+
+        stats = self.batcher.stats()
+        self.assertEqual((stats['batches'], stats['updates'], stats['bytes']), (4, 9, 208))
+        self.assertEqual(stats['max_batch_size'], 3)
+        self.assertEqual(stats['mean_batch_size'], 9 / 4.)
+        self.assertEqual(stats['batch_sizes'], {1: 1, 2: 1, 5: 2})
+        self.assertEqual(stats['flush_reasons'], {'count': 2, 'bytes': 1, 'close': 1})
+        self.assertEqual(stats['pending'], 0)
+
+    def test_age(self):
+        """
+        Tests that a batch that is not full is forwarded after max_age
+        seconds.
+
+        :return: no return
+        """
+
+        self.batcher.max_age = 0.05
+        self.batcher.add('first')
+        self.assertEqual(self.batches, [])
+        for i in range(100):
+            if self.batches:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.batches, [['first']])
+        self.assertEqual(self.batcher.stats()['flush_reasons'], {'age': 1})
+
+    def test_failure(self):
+        """
+        Tests that a batch that could not be forwarded is kept, with its
+        journal, and forwarded again by the next flush.
+
+        :return: no return
+        """
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.batcher.journal = forwarding.UpdateJournal(path)
+        forward = self.batcher.forward
+        def broker_down(updates):
+            raise IOError('broker is down')
+        self.batcher.forward = broker_down
+
+        self.batcher.add(1, record={'bibcode': 'a'})
+        self.batcher.add(2, record={'bibcode': 'b'})
+        self.assertRaises(IOError, self.batcher.add, 3, record={'bibcode': 'c'})
+        stats = self.batcher.stats()
+        self.assertEqual((stats['failures'], stats['batches'], stats['pending']), (1, 0, 3))
+        journal_file = os.path.join(path, os.listdir(path)[0])
+        with open(journal_file) as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+        # the journal is kept if the last flush fails too
+        self.assertRaises(IOError, self.batcher.close)
+        self.assertTrue(os.path.getsize(journal_file) > 0)
+
+        self.batcher.forward = forward
+        self.batcher.add(4, record={'bibcode': 'd'})
+        self.assertEqual(self.batches, [[1, 2, 3, 4]])
+        self.assertEqual(os.path.getsize(journal_file), 0)
+        self.assertEqual(self.batcher.stats()['pending'], 0)
+
+        # forwarded again by the timer when no other update comes
+        failures = []
+        def fails_once(updates):
+            if not failures:
+                failures.append(updates)
+                raise IOError('broker is down')
+            forward(updates)
+        self.batcher.forward = fails_once
+        self.batcher.max_age = 0.05
+        self.batcher.add(5, record={'bibcode': 'e'})
+        for i in range(100):
+            if len(self.batches) > 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(failures, [[5]])
+        self.assertEqual(self.batches[-1], [5])
+
+    def test_journal(self):
+        """
+        Tests that the updates are journaled until their batch is forwarded,
+        and that the journal of a process that died is recovered.
+
+        :return: no return
+        """
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        journal = forwarding.UpdateJournal(path)
+        self.batcher.journal = journal
+
+        self.batcher.add(1, record={'bibcode': 'a'})
+        self.batcher.add(2, record={'bibcode': 'b'})
+        journal_file = os.path.join(path, os.listdir(path)[0])
+        with open(journal_file) as f:
+            self.assertEqual(len(f.readlines()), 2)
+        self.batcher.add(3, record={'bibcode': 'c'})
+        self.assertEqual(os.path.getsize(journal_file), 0)
+
+        # the worker process is killed with an update in its batch
+        self.batcher.add(4, record={'bibcode': 'd'})
+        journal.file.close()
+        with open(journal_file, 'a') as f:
+            f.write('{"bibcode": "partial')
+        dead = os.path.join(path, '{0}-999999999.journal'.format(journal.host))
+        os.rename(journal_file, dead)
+
+        other = forwarding.UpdateJournal(path)
+        with patch.object(forwarding, 'process_running', return_value=True):
+            self.assertEqual(other.recover(), [])
+        self.assertEqual(other.recover(), [{'bibcode': 'd'}])
+        self.assertEqual(os.listdir(path), [])
+        self.assertEqual(other.recover(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+import unittest
+import threading
+
+from adsft import extraction, grobid
+from adsft.tests import test_base
+from adsft.tests.grobid_stub import GrobidStubServer, tei
+
+
+class TestGrobidClient(test_base.TestUnit):
+    """
+    Tests the Grobid client against a local stand-in for the service (see
+    grobid_stub.py).
+    """
+
+    def setUp(self):
+        super(TestGrobidClient, self).setUp()
+        self.server = GrobidStubServer().start()
+        self.addCleanup(self.server.stop)
+        self.client = grobid.GrobidClient(self.server.url, concurrency=2,
+                                          timeout=10, backoff=0.01)
+        self.addCleanup(self.client.close)
+        self.pdf = self.test_stub_pdf
+        with open(self.pdf, 'rb') as f:
+            self.expected = tei(f.read())
+
+    def test_process(self):
+        """
+        Tests that the PDF is uploaded with its length, and that the
+        connection is reused.
+
+        :return: no return
+        """
+
+        self.assertEqual(self.client.process(self.pdf), self.expected)
+        self.assertEqual(self.client.process(self.pdf), self.expected)
+        first, second = self.server.requests
+        self.assertIsNone(first['transfer_encoding'])
+        self.assertEqual(int(first['content_length']),
+                         len(grobid.MultipartUpload('input', self.pdf)))
+        self.assertEqual(first['connection'], second['connection'])
+
+    def test_backoff(self):
+        """
+        Tests that the requests answered 503 are sent again, up to
+        max_retries times.
+
+        :return: no return
+        """
+
+        self.server.busy = 2
+        self.assertEqual(self.client.process(self.pdf), self.expected)
+        self.assertEqual(len(self.server.requests), 3)
+
+        self.server.busy = 10
+        self.server.busy_headers = {'Retry-After': '0'}
+        self.client.max_retries = 3
+        self.assertRaises(grobid.GrobidError, self.client.process, self.pdf)
+        self.assertEqual(len(self.server.requests), 7)
+
+        self.assertEqual(self.client.delay(0, type('Response', (), {'headers': {'Retry-After': '120'}})), 60)
+        self.assertTrue(0.005 <= self.client.delay(1) <= 0.02)
+
+    def test_unreachable(self):
+        """
+        Tests that an unreachable service raises a GrobidError once the
+        retries are exhausted.
+
+        :return: no return
+        """
+
+        url = self.server.url
+        self.server.stop()
+        client = grobid.GrobidClient(url, max_retries=1, backoff=0.01)
+        self.assertRaises(grobid.GrobidError, client.process, self.pdf)
+
+    def test_concurrency(self):
+        """
+        Tests that no more than concurrency requests are sent at the same
+        time.
+
+        :return: no return
+        """
+
+        self.server.delay = 0.1
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.client.process(self.pdf)))
+                   for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [self.expected] * 6)
+        self.assertEqual(self.server.max_active, 2)
+
+    def test_extractor(self):
+        """
+        Tests that the Grobid extractor uses the client.
+
+        :return: no return
+        """
+
+        content = extraction.extract_content(
+            [{'ft_source': self.pdf, 'file_format': 'pdf-grobid',
+              'provider': 'MNRAS', 'bibcode': 'test'}],
+            grobid_client=self.client)
+        self.assertEqual(content[0]['fulltext'], self.expected)
+        self.assertNotIn('grobid_client', content[0])
+
+        # without a client, one is made for the service
+        content = extraction.extract_content(
+            [{'ft_source': self.pdf, 'file_format': 'pdf-grobid',
+              'provider': 'MNRAS', 'bibcode': 'test'}],
+            grobid_service=self.server.url)
+        self.assertEqual(content[0]['fulltext'], self.expected)
+
+
+class TestGrobidStage(test_base.TestUnit):
+    """
+    Tests the Grobid stage of scripts/grobid_consumer.py against the stand-in
+    for the service.
+    """
+
+    def setUp(self):
+        super(TestGrobidStage, self).setUp()
+        self.server = GrobidStubServer().start()
+        self.addCleanup(self.server.stop)
+        self.pdf = self.test_stub_pdf
+        self.client = grobid.GrobidClient(self.server.url, concurrency=4,
+                                          timeout=10, backoff=0.01)
+        self.addCleanup(self.client.close)
+        self.written = []
+        self.finished = []
+
+    def extract(self, msg):
+        if msg['bibcode'] == 'missing':
+            raise grobid.GrobidError('no such PDF')
+        return extraction.extract_content([msg], grobid_client=self.client)
+
+    def write(self, result):
+        self.written.append((result['bibcode'], threading.current_thread().name))
+
+    def document(self, bibcode):
+        return {'ft_source': self.pdf, 'file_format': 'pdf-grobid',
+                'provider': 'MNRAS', 'bibcode': bibcode}
+
+    def test_in_flight(self):
+        """
+        Tests that in_flight PDFs are at the service at the same time, that
+        the results are written by the writer thread, and that every batch
+        is reported done with its failures.
+
+        :return: no return
+        """
+
+        self.server.delay = 0.1
+        stage = grobid.GrobidStage(self.extract, self.write, in_flight=4)
+        stage.submit([self.document('a{0}'.format(i)) for i in range(3)],
+                     done=lambda failed: self.finished.append(('a', failed)))
+        stage.submit([self.document('b0'), self.document('missing')],
+                     done=lambda failed: self.finished.append(('b', failed)))
+        stage.submit([], done=lambda failed: self.finished.append(('c', failed)))
+        stage.close()
+
+        self.assertEqual(self.server.max_active, 4)
+        self.assertEqual(sorted(bibcode for bibcode, thread in self.written),
+                         ['a0', 'a1', 'a2', 'b0'])
+        self.assertEqual(set(thread for bibcode, thread in self.written),
+                         set(['grobid-write']))
+        self.assertEqual(sorted(self.finished), [('a', 0), ('b', 1), ('c', 0)])
+        self.assertEqual(stage.stats, {'written': 4, 'failed': 1})
+
+    def test_write_failure(self):
+        """
+        Tests that a failed write counts as a failed document and does not
+        stop the writer.
+
+        :return: no return
+        """
+
+        def write(result):
+            if result['bibcode'] == 'a0':
+                raise IOError('disk full')
+            self.write(result)
+
+        stage = grobid.GrobidStage(self.extract, write, in_flight=2)
+        stage.submit([self.document('a0'), self.document('a1')],
+                     done=lambda failed: self.finished.append(failed))
+        stage.close()
+        self.assertEqual([bibcode for bibcode, thread in self.written], ['a1'])
+        self.assertEqual(self.finished, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+import os
+import sys
+import time
+
+from mock import patch
+from adsft import extraction, pdfserver
+from adsft.tests import test_base
+
+
+class TestPDFServerPool(test_base.TestUnit):
+    """
+    Tests the pool of PDF extraction servers against a stand-in server that
+    speaks the same protocol (see tests/test_unit/stub_data/pdf_server_stub.py).
+    """
+
+    def setUp(self):
+        super(TestPDFServerPool, self).setUp()
+        self.pool = pdfserver.PDFServerPool(
+            [sys.executable, self.test_stub_pdf_server], size=1, timeout=1,
+            max_documents=3)
+        self.addCleanup(self.pool.close)
+
+    def server(self):
+        """The idle server of the pool"""
+        server = self.pool.idle.get_nowait()
+        self.pool.idle.put(server)
+        return server
+
+    def test_server_is_reused(self):
+        """
+        Tests that the PDFs are extracted by the same server, until it has
+        extracted max_documents PDFs.
+
+        :return: no return
+        """
+
+        self.assertEqual(self.pool.extract(u'/a.pdf'), 'text of /a.pdf')
+        pid = self.server().process.pid
+        self.assertEqual(self.pool.extract('/b.pdf'), 'text of /b.pdf')
+        self.assertEqual(len(self.pool.extract('/big.pdf')), 3 << 20)
+        self.assertEqual(self.pool.started, 1)
+
+        # replaced after 3 documents
+        self.assertEqual(self.pool.idle.qsize(), 0)
+        self.assertEqual(self.pool.extract('/c.pdf'), 'text of /c.pdf')
+        self.assertNotEqual(self.server().process.pid, pid)
+        self.assertEqual((self.pool.started, self.pool.replaced), (2, 1))
+
+    def test_extraction_error(self):
+        """
+        Tests that a server that could not extract a PDF is used again.
+
+        :return: no return
+        """
+
+        self.assertRaises(pdfserver.ExtractionError, self.pool.extract, '/error.pdf')
+        self.assertEqual(self.pool.extract('/a.pdf'), 'text of /a.pdf')
+        self.assertEqual(self.pool.started, 1)
+
+    def test_failures(self):
+        """
+        Tests that a server that dies or does not answer in time is replaced.
+
+        :return: no return
+        """
+
+        self.assertRaises(pdfserver.ServerError, self.pool.extract, '/crash.pdf')
+        self.assertEqual(self.pool.extract('/a.pdf'), 'text of /a.pdf')
+
+        start = time.time()
+        self.assertRaises(pdfserver.ServerError, self.pool.extract, '/hang.pdf')
+        self.assertLess(time.time() - start, 3)
+        self.assertEqual(self.pool.extract('/a.pdf'), 'text of /a.pdf')
+        self.assertEqual((self.pool.started, self.pool.replaced), (3, 2))
+
+    def test_health_check(self):
+        """
+        Tests that idle servers are pinged, and replaced if they died or are
+        using too much memory.
+
+        :return: no return
+        """
+
+        self.pool.extract('/a.pdf')
+        server = self.server()
+        self.pool.ping_interval = 0
+        with patch.object(pdfserver.PDFServer, 'ping', return_value=True) as ping:
+            self.pool.extract('/b.pdf')
+            self.assertTrue(ping.called)
+        self.assertTrue(server.ping())
+
+        server.process.kill()
+        server.process.wait()
+        self.assertEqual(self.pool.extract('/c.pdf'), 'text of /c.pdf')
+        self.assertEqual(self.pool.replaced, 1)
+
+        if self.server().rss() is not None:
+            self.pool.max_rss = 1
+            self.pool.extract('/d.pdf')
+            self.assertEqual(self.pool.idle.qsize(), 0)
+            self.assertEqual(self.pool.replaced, 2)
+
+    def test_pdf_extractor(self):
+        """
+        Tests that the PDF extractor uses the pool instead of the script.
+
+        :return: no return
+        """
+
+        content = extraction.extract_content([{
+            'ft_source': '/proj/ads/articles/a.pdf', 'file_format': 'pdf',
+            'provider': 'MNRAS', 'bibcode': 'test'}],
+            extract_pdf_script='/scripts/extract_pdf_with_pdftotext.sh',
+            pdf_server=self.pool)
+        self.assertEqual(content[0]['fulltext'], u'text of /proj/ads/articles/a.pdf')
+        self.assertNotIn('pdf_server', content[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+import unittest
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+from mock import patch
+from adsft import extraction, pdftotext
+from adsft.utils import TextCleaner
+from adsft.tests import test_base
+
+
+class TestRunExtractor(test_base.TestUnit):
+    """
+    Tests running the PDF extractors: cleaning their output as it is read,
+    the timeout and the resource limits.
+    """
+
+    def setUp(self):
+        super(TestRunExtractor, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def python(self, code):
+        return [sys.executable, '-c', code]
+
+    def test_output_is_cleaned_as_a_whole(self):
+        """
+        Tests that cleaning the output page by page, as it is read, gives the
+        same text as cleaning all of it.
+
+        :return: no return
+        """
+
+        output = u'Introﬁ café\n\n  two  spaces\f{0} long\f́mark\f\f'.format(
+            u'x' * 250).encode('utf-8') + '\xff invalid\f'
+        output_file = os.path.join(self.path, 'output')
+        with open(output_file, 'wb') as f:
+            f.write(output)
+
+        command = self.python('import sys; sys.stdout.write(open({0!r}, "rb").read())'.format(output_file))
+        for chunk_size in (1, 7, 1 << 16):
+            text, metrics = pdftotext.run(command, chunk_size=chunk_size,
+                                          translate=False, decode=True, normalise=True)
+            self.assertEqual(text, TextCleaner(text=output).run(translate=False, decode=True, normalise=True))
+        self.assertEqual(metrics['output_bytes'], len(output))
+        self.assertEqual(metrics['pages'], 5)
+
+    def test_failure(self):
+        """
+        Tests that an extractor failure raises its error output.
+
+        :return: no return
+        """
+
+        with self.assertRaisesRegexp(Exception, 'Bad PDF'):
+            pdftotext.run(self.python('import sys; sys.stderr.write("Bad PDF"); sys.exit(1)'))
+
+    def test_timeout(self):
+        """
+        Tests that an extractor running for too long is killed, with the
+        processes it started.
+
+        :return: no return
+        """
+
+        start = time.time()
+        self.assertRaises(pdftotext.ExtractionTimeout, pdftotext.run,
+                          ['sh', '-c', 'echo started; sleep 30; echo done'], timeout=0.5)
+        self.assertLess(time.time() - start, 5)
+
+    def test_resource_limits(self):
+        """
+        Tests that an extractor using too much memory or CPU fails.
+
+        :return: no return
+        """
+
+        with self.assertRaisesRegexp(Exception, 'MemoryError'):
+            pdftotext.run(self.python('x = "x" * (1 << 30)'), max_memory=256 << 20)
+        with self.assertRaisesRegexp(Exception, 'CPU limit'):
+            pdftotext.run(self.python('while True: pass'), max_cpu=1, timeout=30)
+
+    def test_pdftotext_is_run_directly(self):
+        """
+        Tests that the PDF extractor runs pdftotext instead of the pdftotext
+        script, with the page range given.
+
+        :return: no return
+        """
+
+        self.assertEqual(pdftotext.pdftotext_command('/a.pdf', '/bin/pdftotext', 2, 3),
+                         ['/bin/pdftotext', '-enc', 'UTF-8', '-eol', 'unix', '-q',
+                          '-f', '2', '-l', '3', '/a.pdf', '-'])
+
+        fake_pdftotext = os.path.join(self.path, 'pdftotext')
+        with open(fake_pdftotext, 'w') as f:
+            f.write('#!/bin/sh\necho "$@"\n')
+        os.chmod(fake_pdftotext, 0755)
+        pdf = os.path.join(self.path, 'test.pdf')
+        open(pdf, 'w').close()
+
+        dict_item = {'ft_source': pdf, 'file_format': 'pdf', 'provider': 'MNRAS',
+                     'bibcode': 'test'}
+        content = extraction.extract_content(
+            [dict(dict_item)], extract_pdf_script=pdftotext.PDFTOTEXT_SCRIPT,
+            pdftotext=fake_pdftotext, extract_pdf_limits={'timeout': 10})
+        self.assertEqual(content[0]['fulltext'], u'-enc UTF-8 -eol unix -q {0} -\n'.format(pdf))
+        self.assertNotIn('extract_pdf_limits', content[0])
+
+        missing = dict(dict_item, ft_source=pdf + '.missing')
+        self.assertRaises(Exception, extraction.extract_content, [missing],
+                          extract_pdf_script=pdftotext.PDFTOTEXT_SCRIPT,
+                          pdftotext=fake_pdftotext, grobid_client=object())
+        # the settings given to the extractors are not left in a failed record
+        for key in extraction.EXTRACTOR_SETTINGS:
+            self.assertNotIn(key, missing)
+
+
+class TestParallelExtraction(test_base.TestUnit):
+    """
+    Tests extracting large PDFs by page ranges, with stand-ins for pdftotext
+    and pdfinfo that know of a 10 page PDF.
+    """
+
+    def setUp(self):
+        super(TestParallelExtraction, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.pdftotext = os.path.join(self.path, 'pdftotext')
+        with open(self.pdftotext, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'first=1; last=10\n'
+                    'while [ $# -gt 2 ]; do\n'
+                    '  case $1 in -f) first=$2; shift;; -l) last=$2; shift;; esac; shift\n'
+                    'done\n'
+                    'for page in `seq $first $last`; do printf "page  $page\\n\\014"; done\n')
+        self.pdfinfo = os.path.join(self.path, 'pdfinfo')
+        with open(self.pdfinfo, 'w') as f:
+            f.write('#!/bin/sh\nprintf "Title: test\\nPages:          10\\n"\n')
+        for script in (self.pdftotext, self.pdfinfo):
+            os.chmod(script, 0755)
+        self.pdf = os.path.join(self.path, 'test.pdf')
+        with open(self.pdf, 'w') as f:
+            f.write('x' * 1000)
+
+    def test_split_pages(self):
+        """
+        Tests that only the PDFs above the page or size thresholds are split.
+
+        :return: no return
+        """
+
+        self.assertEqual(pdftotext.page_ranges(10, 4), [(1, 3), (4, 6), (7, 9), (10, 10)])
+        self.assertEqual(pdftotext.page_ranges(2, 4), [(1, 1), (2, 2)])
+        self.assertEqual(pdftotext.page_count(self.pdf, self.pdfinfo), 10)
+        self.assertIsNone(pdftotext.page_count(self.pdf, '/does/not/exist'))
+
+        for processes, pages, size, expected in (
+                (1, 5, None, None),
+                (2, 5, None, [(1, 5), (6, 10)]),
+                (2, 11, None, None),
+                (2, None, 1000, [(1, 5), (6, 10)]),
+                (2, 11, 1001, None),
+                (2, None, None, None)):
+            self.assertEqual(pdftotext.split_pages(self.pdf, processes=processes, pages=pages,
+                                                   size=size, pdfinfo=self.pdfinfo), expected)
+
+        # pdfinfo is only run for the PDFs large enough
+        with patch.object(pdftotext, 'page_count') as page_count:
+            self.assertIsNone(pdftotext.split_pages(self.pdf, processes=2, size=1001,
+                                                    pdfinfo=self.pdfinfo))
+            self.assertFalse(page_count.called)
+
+    def test_parallel_extraction(self):
+        """
+        Tests that the text of the page ranges joined is the text of the PDF.
+
+        :return: no return
+        """
+
+        clean = dict(translate=False, decode=True, normalise=True)
+        text, metrics = pdftotext.run(pdftotext.pdftotext_command(self.pdf, self.pdftotext), **clean)
+        for processes in (2, 3, 10):
+            parallel_text, parallel_metrics = pdftotext.run_parallel(
+                self.pdf, pdftotext.page_ranges(10, processes), self.pdftotext, **clean)
+            self.assertEqual(parallel_text, text)
+            self.assertEqual(parallel_metrics['pages'], 10)
+            self.assertEqual(parallel_metrics['output_bytes'], metrics['output_bytes'])
+        self.assertEqual(text.count(u'page 1'), 2)
+
+        # the processes are all started from the calling thread
+        threads = set()
+        popen = pdftotext.Popen
+        def start(*args, **kwargs):
+            threads.add(threading.current_thread())
+            return popen(*args, **kwargs)
+        with patch.object(pdftotext, 'Popen', side_effect=start):
+            pdftotext.run_parallel(self.pdf, pdftotext.page_ranges(10, 4), self.pdftotext, **clean)
+        self.assertEqual(threads, set([threading.current_thread()]))
+
+        # the CPU time of each process is its own
+        busy = [sys.executable, '-c', 'import time\nstart = time.clock()\nwhile time.clock() - start < 0.3: pass']
+        results = pdftotext.run_all([busy, busy], **clean)
+        for result in results:
+            self.assertGreater(result[1]['cpu_seconds'], 0.25)
+            self.assertLess(result[1]['cpu_seconds'], 0.5)
+
+        start = time.time()
+        self.assertRaises(pdftotext.ExtractionTimeout, pdftotext.run_all,
+                          [pdftotext.pdftotext_command(self.pdf, self.pdftotext), ['sleep', '30']],
+                          timeout=0.5, **clean)
+        self.assertLess(time.time() - start, 5)
+
+        with patch.object(pdftotext, 'run_parallel', wraps=pdftotext.run_parallel) as run_parallel:
+            content = extraction.extract_content(
+                [{'ft_source': self.pdf, 'file_format': 'pdf', 'provider': 'MNRAS', 'bibcode': 'test'}],
+                extract_pdf_script=pdftotext.PDFTOTEXT_SCRIPT, pdftotext=self.pdftotext,
+                extract_pdf_parallel={'processes': 4, 'pages': 5, 'pdfinfo': self.pdfinfo})
+            self.assertEqual(run_parallel.call_args[0][1], [(1, 3), (4, 6), (7, 9), (10, 10)])
+        self.assertEqual(content[0]['fulltext'], text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+import os
+
+from adsft import utils
+from adsft.tests import test_base
+from mock import patch
+import run
+
+
+class TestRun(test_base.TestUnit):
+    """
+    Tests the publishing of the links file by run.py, without a broker: the
+    messages sent to the CheckIfExtract queue are recorded.
+    """
+
+    def setUp(self):
+        super(TestRun, self).setUp()
+        self.links_file = os.path.join(
+            self.proj_home,
+            'tests/test_integration/stub_data/fulltext_range_of_formats.links')
+        self.records = list(utils.FileInputStream(self.links_file).stream())
+        patcher = patch.object(run.tasks.task_check_if_extract, 'delay')
+        self.delay = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def published(self):
+        """The messages sent, as lists of records"""
+        messages = [call[0][0] for call in self.delay.call_args_list]
+        return [message if isinstance(message, list) else [message]
+                for message in messages]
+
+    def test_stream_links_from_file(self):
+        """
+        Tests that the records of the links file are streamed in packets of
+        at most packet_size records.
+
+        :return: no return
+        """
+
+        packets = list(run.stream_links_from_file(self.links_file, packet_size=4))
+        self.assertEqual([len(packet) for packet in packets], [4, 2])
+        self.assertEqual(sum(packets, []), self.records)
+
+    def test_publish_packet(self):
+        """
+        Tests that a packet of one record is sent as the record itself, and
+        a larger packet as a list.
+
+        :return: no return
+        """
+
+        run.publish_packet(self.records[:1], 1)
+        run.publish_packet(self.records[1:3], 3)
+        self.assertEqual(self.delay.call_args_list[0][0][0], self.records[0])
+        self.assertEqual(self.delay.call_args_list[1][0][0], self.records[1:3])
+
+    def test_run(self):
+        """
+        Tests that every record is published in packets, and that
+        max_queue_size limits the number of records published, truncating
+        the last packet.
+
+        :return: no return
+        """
+
+        run.run(self.links_file, packet_size=4)
+        self.assertEqual(sum(self.published(), []), self.records)
+
+        self.delay.reset_mock()
+        run.run(self.links_file, packet_size=2, max_queue_size=3)
+        self.assertEqual(self.published(), [self.records[:2], self.records[2:3]])
+
+    def test_run_snapshot(self):
+        """
+        Tests that only the records changed since the snapshot are published,
+        unless the extraction or the sending is forced, and that forced runs
+        still update the snapshot.
+
+        :return: no return
+        """
+
+        snapshot_file = os.path.join(self.proj_home, 'tests/test_unit/stub_data/run.snapshot')
+        self.addCleanup(lambda: os.path.exists(snapshot_file) and os.remove(snapshot_file))
+
+        run.run(self.links_file, snapshot=snapshot_file)
+        self.assertEqual(sum(self.published(), []), self.records)
+
+        self.delay.reset_mock()
+        run.run(self.links_file, snapshot=snapshot_file)
+        self.assertEqual(self.published(), [])
+
+        os.remove(snapshot_file)
+        for force in ('force_extract', 'force_send'):
+            self.delay.reset_mock()
+            run.run(self.links_file, snapshot=snapshot_file, **{force: True})
+            self.assertEqual([record['bibcode'] for record in sum(self.published(), [])],
+                             [record['bibcode'] for record in self.records])
+
+        snapshot = utils.LinksSnapshot(snapshot_file)
+        self.assertEqual(snapshot.load(), len(self.records))
+
+
+if __name__ == '__main__':
+    unittest.main()
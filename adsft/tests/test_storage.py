@@ -0,0 +1,177 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from adsft import app, checker, storage
+from adsft.tests import test_base
+
+
+class TestSegmentStorage(test_base.TestUnit):
+    """
+    Tests the segment store output backend: writing and reading documents,
+    compaction and the consistency check.
+    """
+
+    def setUp(self):
+        """
+        Creates a segment store in a temporary directory, with its index in a
+        temporary database.
+
+        :return: no return
+        """
+        super(TestSegmentStorage, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.index = app.ADSFulltextCelery('test', proj_home=self.proj_home, local_config=\
+            {
+            'SQLALCHEMY_URL': 'sqlite:///{0}'.format(os.path.join(self.path, 'index.db')),
+            })
+        self.addCleanup(self.index.close_app)
+        self.store = storage.get_storage(
+            {'OUTPUT_BACKEND': 'segments', 'FULLTEXT_EXTRACT_PATH': self.path,
+             'FULLTEXT_COMPRESSION': 'gzip'}, index=self.index)
+        self.dict_item = {
+            'meta_path': os.path.join(self.path, 'te/st/1/meta.json'),
+            'fulltext': u'caf\xe9 full text',
+            'acknowledgements': u'thanks',
+            'file_format': 'xml',
+            'ft_source': self.test_stub_xml,
+            'bibcode': 'TEST2014',
+            'provider': 'MNRAS',
+            'UPDATE': 'NOT_EXTRACTED_BEFORE',
+        }
+
+    def test_write_and_read(self):
+        """
+        Tests that a document written is read back as the pairtree reader
+        would, for the regular and the grobid extraction, and that nothing is
+        written in the pairtree directory.
+
+        :return: no return
+        """
+
+        self.assertIsNone(self.store.read(self.dict_item))
+        self.store.write(self.dict_item, state_store=self.index)
+
+        content = self.store.read(self.dict_item)
+        self.assertEqual(content['fulltext'], self.dict_item['fulltext'])
+        self.assertEqual(content['acknowledgements'], u'thanks')
+        self.assertEqual(content['bibcode'], 'TEST2014')
+        self.assertFalse(os.path.exists(os.path.dirname(self.dict_item['meta_path'])))
+        self.assertEqual(self.index.get_extraction_state('TEST2014')['ft_source'],
+                         self.test_stub_xml)
+
+        grobid = dict(self.dict_item, file_format='pdf-grobid', fulltext=u'<TEI/>')
+        self.assertEqual(self.store.read(grobid)['fulltext'], '')
+        self.store.write(grobid)
+        content = self.store.read(grobid)
+        self.assertEqual(content['fulltext'], u'<TEI/>')
+        self.assertEqual(content['bibcode'], 'TEST2014')
+
+        # already extracted documents are not written again when forced to send
+        entry = self.index.get_segment_entry('TEST2014', 'fulltext')
+        self.store.write(dict(self.dict_item, UPDATE='FORCE_TO_SEND', fulltext=u'new'))
+        self.assertEqual(self.index.get_segment_entry('TEST2014', 'fulltext'), entry)
+
+        report = self.store.check()
+        self.assertEqual((report['live'], report['dead']), (2, 0))
+        self.assertEqual(report['corrupted'] + report['missing'] + report['truncated'], [])
+
+    def test_unchanged_content_is_not_written(self):
+        """
+        Tests that a document with the same content hash is not written again.
+
+        :return: no return
+        """
+
+        self.assertTrue(self.store.write(self.dict_item))
+        entry = self.index.get_segment_entry('TEST2014', 'fulltext')
+        self.assertFalse(self.store.write(dict(self.dict_item, UPDATE='STALE_CONTENT')))
+        self.assertEqual(self.index.get_segment_entry('TEST2014', 'fulltext'), entry)
+        self.assertTrue(self.store.write(dict(self.dict_item, fulltext=u'new')))
+        self.assertNotEqual(self.index.get_segment_entry('TEST2014', 'fulltext'), entry)
+
+    def test_compaction(self):
+        """
+        Tests that the sealed segments with dead records are compacted, and
+        that the documents are still read afterwards.
+
+        :return: no return
+        """
+
+        for i in range(3):
+            self.store.write(dict(self.dict_item, fulltext=u'version {0}'.format(i)))
+        self.store.write(dict(self.dict_item, bibcode='OTHER2014'))
+        self.assertEqual(self.store.check()['dead'], 2)
+
+        # the segment appended to is not compacted until it is sealed
+        self.assertEqual(self.store.compact()['segments'], 0)
+        self.store.close()
+        old_segments = [s['name'] for s in self.index.get_segments()]
+        report = self.store.compact()
+        self.assertEqual(report['segments'], 1)
+        self.assertEqual(report['records'], 2)
+
+        self.assertEqual(self.store.read(self.dict_item)['fulltext'], u'version 2')
+        self.assertEqual(self.store.read(dict(self.dict_item, bibcode='OTHER2014'))['fulltext'],
+                         self.dict_item['fulltext'])
+        for name in old_segments:
+            self.assertFalse(os.path.exists(self.store.segment_path(name)))
+        report = self.store.check()
+        self.assertEqual((report['segments'], report['live'], report['dead']), (1, 2, 0))
+
+    def test_consistency_check(self):
+        """
+        Tests that corrupted and truncated records are detected.
+
+        :return: no return
+        """
+
+        self.store.write(self.dict_item)
+        entry = self.index.get_segment_entry('TEST2014', 'fulltext')
+        segment_file = self.store.segment_path(entry['segment'])
+
+        with open(segment_file, 'r+b') as f:
+            f.seek(entry['offset'] + 5)
+            byte = f.read(1)
+            f.seek(entry['offset'] + 5)
+            f.write(chr(ord(byte) ^ 0xff))
+        self.assertRaises(IOError, self.store.read, self.dict_item)
+        self.assertEqual(self.store.check()['corrupted'], [('TEST2014', 'fulltext')])
+
+        with open(segment_file, 'ab') as f:
+            f.write('OTHER2014\tfulltext\t100\t')
+        self.assertEqual(self.store.check()['truncated'], [entry['segment']])
+
+        os.remove(segment_file)
+        open(os.path.join(self.store.path, 'unknown.seg'), 'w').close()
+        report = self.store.check()
+        self.assertEqual(report['missing'], [entry['segment']])
+        self.assertEqual(report['unknown'], ['unknown.seg'])
+
+    def test_checker_without_files(self):
+        """
+        Tests that the checker relies on the extraction state store only when
+        the output backend does not write files.
+
+        :return: no return
+        """
+
+        message = {'bibcode': 'TEST2014', 'provider': 'MNRAS',
+                   'ft_source': self.test_stub_xml}
+        payload = checker.check_if_extract(
+            [dict(message)], self.path, state_store=self.index,
+            has_files=self.store.has_files)
+        self.assertEqual(payload['Standard'][0]['UPDATE'], 'NOT_EXTRACTED_BEFORE')
+
+        self.store.write(dict(payload['Standard'][0], fulltext=u'text'),
+                         state_store=self.index)
+        payload = checker.check_if_extract(
+            [dict(message)], self.path, state_store=self.index,
+            has_files=self.store.has_files)
+        self.assertEqual(payload['Standard'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
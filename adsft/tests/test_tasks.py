@@ -1,10 +1,12 @@
 import sys
 import os
 import json
+import shutil
+import tempfile
 
 from mock import patch
 import unittest
-from adsft import app, tasks
+from adsft import app, tasks, utils
 from adsmsg import FulltextUpdate
 import httpretty
 
@@ -82,8 +84,24 @@ class TestWorkers(unittest.TestCase):
                 self.assertEqual(u'\nI.INTRODUCTION\nINTRODUCTION GOES HERE\n\n\nManual Entry\n\n', actual['fulltext'])
                 self.assertEqual(u'\nAcknowledgments\nWE ACKNOWLEDGE.', actual['acknowledgements'])
                 self.assertEqual([u'ADS/Sa.CXO#Obs/11458'], actual['dataset'])
-                self.assertTrue(task_output_results.called)
-
+                self.assertEqual(task_output_results.call_count, 1)
+
+
+    def test_task_extract_unchanged_content(self):
+        msg = {'bibcode': 'fta', 'file_format': 'xml',
+                    'index_date': '2017-06-30T22:45:47.800112Z',
+                    'UPDATE': 'STALE_CONTENT',
+                    'meta_path': u'{}/ft/a/meta.json'.format(self.app.conf['FULLTEXT_EXTRACT_PATH']),
+                    'ft_source': '{}/tests/test_integration/stub_data/full_test.xml'.format(self.proj_home),
+                    'provider': 'MNRAS'}
+        with patch('adsft.writer.write_content', return_value=False):
+            for forward, update, called in ((True, 'STALE_CONTENT', True),
+                                            (False, 'STALE_CONTENT', False),
+                                            (False, 'FORCE_TO_SEND', True)):
+                self.app.conf['FORWARD_UNCHANGED_FULLTEXT'] = forward
+                with patch.object(tasks.task_output_results, 'delay', return_value=None) as task_output_results:
+                    tasks.task_extract(dict(msg, UPDATE=update))
+                    self.assertEqual(task_output_results.called, called)
 
     def test_task_extract_pdf(self):
         if self.grobid_service is not None:
@@ -124,5 +142,107 @@ class TestWorkers(unittest.TestCase):
             self.assertEqual(actual.bibcode, msg['bibcode'])
             self.assertEqual(actual.body, msg['body'])
 
+    def test_task_output_results_cleaned(self):
+        msg = {
+                'bibcode': 'fta',
+                'body': u'Introduction\nTHIS IS AN INTERESTING TITLE\n'
+                }
+        with patch('adsft.app.ADSFulltextCelery.forward_message', return_value=None) as forward_message:
+            with patch('adsft.utils.TextCleaner.run', return_value=u'cleaned') as run:
+                # only the text that the extractors did not clean is cleaned
+                tasks.task_output_results(dict(msg, cleaned=utils.TEXT_CLEANER_VERSION))
+                self.assertFalse(run.called)
+                self.assertEqual(forward_message.call_args[0][0].body, msg['body'])
+                tasks.task_output_results(dict(msg, bibcode='ftb', cleaned=utils.TEXT_CLEANER_VERSION - 1))
+                self.assertEqual(run.call_count, 1)
+                tasks.task_output_results(dict(msg, bibcode='ftc'))
+                self.assertEqual(run.call_count, 2)
+                self.assertEqual(forward_message.call_args[0][0].body, u'cleaned')
+
+        msg = {'bibcode': 'fta', 'file_format': 'xml',
+                    'index_date': '2017-06-30T22:45:47.800112Z',
+                    'UPDATE': 'NOT_EXTRACTED_BEFORE',
+                    'meta_path': u'{}/ft/a/meta.json'.format(self.app.conf['FULLTEXT_EXTRACT_PATH']),
+                    'ft_source': '{}/tests/test_integration/stub_data/full_test.xml'.format(self.proj_home),
+                    'provider': 'MNRAS'}
+        with patch('adsft.writer.write_content', return_value=True):
+            with patch.object(tasks.task_output_results, 'delay', return_value=None) as task_output_results:
+                tasks.task_extract(msg)
+                self.assertEqual(task_output_results.call_args[0][0]['cleaned'], utils.TEXT_CLEANER_VERSION)
+
+    def test_task_output_results_dedup(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        db_app = app.ADSFulltextCelery('test', proj_home=self.proj_home, local_config=\
+            {
+            'SQLALCHEMY_URL': 'sqlite:///{0}'.format(os.path.join(path, 'state.db')),
+            })
+        self.addCleanup(db_app.close_app)
+        msg = {
+                'bibcode': 'fta',
+                'body': 'Introduction\nTHIS IS AN INTERESTING TITLE\n'
+                }
+        # forwarded updates recorded in this process, then in the database
+        for test_app in (self.app, db_app):
+            tasks.app = test_app
+            test_app.conf['OUTPUT_DEDUP_WINDOW'] = 3600
+            with patch('adsft.app.ADSFulltextCelery.forward_message', return_value=None) as forward_message:
+                tasks.task_output_results(dict(msg))
+                tasks.task_output_results(dict(msg))
+                self.assertEqual(forward_message.call_count, 1)
+                tasks.task_output_results(dict(msg, body='New body'))
+                self.assertEqual(forward_message.call_count, 2)
+                tasks.task_output_results(dict(msg, body='New body'), force=True)
+                self.assertEqual(forward_message.call_count, 3)
+
+            # the same update is forwarded again once the window has passed
+            self.assertTrue(test_app.claim_forward('other', 'a', 60, now=1000))
+            self.assertFalse(test_app.claim_forward('other', 'a', 60, now=1059))
+            self.assertTrue(test_app.claim_forward('other', 'a', 60, now=1060))
+
+            # an update that could not be forwarded is not dropped when retried
+            with patch('adsft.app.ADSFulltextCelery.forward_message', side_effect=IOError) as forward_message:
+                self.assertRaises(IOError, tasks.task_output_results, dict(msg, body='Other body'))
+            with patch('adsft.app.ADSFulltextCelery.forward_message', return_value=None) as forward_message:
+                tasks.task_output_results(dict(msg, body='Other body'))
+                self.assertTrue(forward_message.called)
+
+    def test_task_output_results_batched(self):
+        self.app.conf['OUTPUT_BATCH_COUNT'] = 2
+        self.app.conf['OUTPUT_BATCH_AGE'] = 0
+        self.app.conf['OUTPUT_BATCH_JOURNAL_PATH'] = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.app.conf['OUTPUT_BATCH_JOURNAL_PATH'])
+        self.addCleanup(tasks._output_batcher.__delitem__, slice(None))
+        msg = {
+                'bibcode': 'fta',
+                'body': 'Introduction\nTHIS IS AN INTERESTING TITLE\n'
+                }
+        # without a list type in adsmsg, each update is forwarded on its own
+        with patch('adsft.app.ADSFulltextCelery.forward_message', return_value=None) as forward_message:
+            with patch.object(tasks.adsmsg, 'FulltextUpdateList', None, create=True):
+                tasks.task_output_results(dict(msg))
+                self.assertEqual(forward_message.call_count, 1)
+                self.assertEqual(forward_message.call_args[0][0].bibcode, 'fta')
+                self.assertIsNone(tasks.output_batcher())
+        del tasks._output_batcher[:]
+
+        # otherwise as a single message per batch
+        with patch('adsft.app.ADSFulltextCelery.forward_message', return_value=None) as forward_message:
+            with patch('adsmsg.FulltextUpdateList', create=True) as update_list:
+                tasks.task_output_results(dict(msg))
+                self.assertFalse(forward_message.called)
+                tasks.task_output_results(dict(msg, bibcode='ftb'))
+                self.assertEqual(forward_message.call_count, 1)
+                tasks.task_output_results(dict(msg, bibcode='ftc'))
+                tasks.flush_output_batcher()
+                self.assertEqual(forward_message.call_count, 2)
+                batches = [[u['bibcode'] for u in c[1]['fulltext_updates']]
+                           for c in update_list.call_args_list]
+                self.assertEqual(batches, [['fta', 'ftb'], ['ftc']])
+
+                stats = tasks.output_batcher().stats()
+                self.assertEqual((stats['batches'], stats['updates']), (2, 3))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -50,6 +50,66 @@ class TestFileStreamInput(test_base.TestUnit):
         )
         self.assertIn('MNRAS', FileInputStream.provider)
 
+    def test_file_stream_input_stream(self):
+        """
+        Tests the stream and stream_packets methods. They should yield the
+        same payloads as extract, without loading the whole file first.
+
+        :return: no return
+        """
+
+        FileInputStream = utils.FileInputStream(self.test_file)
+        FileInputStream.extract(force_extract=True)
+        expected = FileInputStream.payload
+
+        stream = utils.FileInputStream(self.test_file).stream(
+            force_extract=True)
+        self.assertFalse(isinstance(stream, list))
+        self.assertEqual(list(stream), expected)
+
+        packets = list(utils.FileInputStream(self.test_file).stream_packets(
+            2, force_extract=True))
+        self.assertTrue(all([len(packet) <= 2 for packet in packets]))
+        self.assertEqual([payload for packet in packets
+                          for payload in packet], expected)
+        self.assertTrue(all(['UPDATE' in payload for payload in expected]))
+
+    def test_links_snapshot(self):
+        """
+        Tests that the links snapshot only lets through records that are new
+        or changed since the previous run, and that it detects removed ones.
+
+        :return: no return
+        """
+
+        snapshot_file = os.path.join(self.proj_home, 'tests/test_unit/stub_data/links.snapshot')
+        self.addCleanup(lambda: os.path.exists(snapshot_file) and os.remove(snapshot_file))
+        links_file = os.path.join(self.proj_home, 'tests/test_integration/stub_data/fulltext_range_of_formats.links')
+        records = list(utils.FileInputStream(links_file).stream())
+
+        snapshot = utils.LinksSnapshot(snapshot_file)
+        self.assertEqual(snapshot.load(), 0)
+        changed = list(snapshot.changed(iter(records)))
+        self.assertEqual(changed, records)
+        snapshot.published(changed)
+        self.assertEqual(snapshot.save(), len(records))
+
+        # Nothing changed since the previous run
+        snapshot = utils.LinksSnapshot(snapshot_file)
+        self.assertEqual(snapshot.load(), len(records))
+        self.assertEqual(list(snapshot.changed(iter(records))), [])
+        self.assertEqual(snapshot.unchanged, len(records))
+
+        # One record changes provider and another one disappears
+        modified = dict(records[0], provider='OTHER')
+        snapshot = utils.LinksSnapshot(snapshot_file)
+        snapshot.load()
+        changed = list(snapshot.changed(iter([modified] + records[2:])))
+        self.assertEqual(changed, [modified])
+        self.assertEqual(snapshot.removed, [records[1]['bibcode']])
+        snapshot.published(changed)
+        self.assertEqual(snapshot.save(), len(records) - 1)
+
     
     def test_trim(self):
         """
@@ -66,6 +126,60 @@ class TestFileStreamInput(test_base.TestUnit):
             r = utils.TextCleaner(x).run(translate=False, decode=True, normalise=True, trim=True)
             self.assertEqual(r, u'a b')
 
+    def test_trim_skips_texts_without_long_words(self):
+        """
+        Tests that checking for long words before searching for them does not
+        change the result of removing the long words and collapsing spaces.
+        """
+        word = 'x' * 20
+        texts = [u'', u' ', u'  a  ', u'a ' + word + u' b', word,
+                 word + u'  ' + word + u' a', u'a  ' + word + u'  b ',
+                 u'a\n' + word + u'\nb', u'a.' + word + u'.b', u'a\t ' + word,
+                 u'ab' + word + u'  c', u' ' + word + u'-' + word + u' ']
+        for text in texts:
+            expected = re.sub(r'\S{20,}\b', '', text)
+            expected = re.sub('  +', ' ', expected)
+            cleaner = utils.TextCleaner(text)
+            cleaner.trimwords(maxlength=20)
+            self.assertEqual(cleaner.text, expected, repr(text))
+
+    def test_translation_maps_are_shared(self):
+        """
+        Tests that the translation maps are built once, and still remove the
+        control characters.
+        """
+        a = utils.TextCleaner(u'a')
+        b = utils.TextCleaner(u'b')
+        self.assertIs(a.Unicode_translation_map, b.Unicode_translation_map)
+        self.assertIs(a.ASCII_translation_map, b.ASCII_translation_map)
+
+        r = utils.TextCleaner(u'a\x00b\ud800c\ufffed\n').run(translate=True, decode=True, normalise=True, trim=True)
+        self.assertEqual(r, u'abcd\n')
+        text = u''.join(unichr(i) for i in range(0x2000)) + u'\U0010ffff'
+        self.assertEqual(utils.TextCleaner(text).run(translate=True, decode=False, normalise=False, trim=False),
+                         text.translate(utils.UNICODE_TRANSLATION_MAP))
+        r = utils.TextCleaner('a\x00b\x0bc\n').run(translate=True, decode=True, normalise=True, trim=True)
+        self.assertEqual(r, u'a b c\n')
+
+    def test_translation_map_paths(self):
+        """
+        Tests that the shared map cannot be changed, and that another map
+        gives the same text as unicode.translate.
+        """
+        text = u''.join(unichr(i) for i in range(0x2000)) + u'a]\\-^b'
+
+        with self.assertRaises(TypeError):
+            utils.UNICODE_TRANSLATION_MAP[ord(u'a')] = None
+
+        translation_map = dict(utils.UNICODE_TRANSLATION_MAP)
+        translation_map[ord(u'b')] = u'c'
+        cleaner = utils.TextCleaner(text)
+        cleaner.Unicode_translation_map = translation_map
+        cleaner.translate()
+        self.assertEqual(cleaner.text, text.translate(translation_map))
+        self.assertEqual(utils.TextCleaner(text).run(translate=True, decode=False, normalise=False, trim=False),
+                         text.translate(utils.UNICODE_TRANSLATION_MAP))
+
     def test_get_filenames(self):
         """test code that breaks up file name strings"""
 
@@ -89,6 +203,28 @@ class TestFileStreamInput(test_base.TestUnit):
         files = utils.get_filenames(file_string)
         self.assertEqual(['/proj/ads/foo', '/proj/ads/ba,r', '/proj/ads/baz/,,/qu,ux'], files)
 
+    def test_compression(self):
+        """test the storage of the full text with a compression"""
+
+        data = u'caf\xe9 '.encode('utf-8') * 1000
+        compressed = utils.compress(data, 'gzip')
+        self.assertLess(len(compressed), len(data))
+        self.assertEqual(utils.decompress(compressed, 'gzip'), data)
+        self.assertEqual(utils.compress(data, None), data)
+        self.assertRaises(ValueError, utils.compress, data, 'bzip2')
+
+        self.assertEqual(utils.stored_file_names('/a/fulltext.txt', 'gzip'),
+                         ['/a/fulltext.txt.gz', '/a/fulltext.txt',
+                          '/a/fulltext.txt.zst'])
+        self.assertEqual(utils.file_compression('/a/fulltext.txt.gz'), 'gzip')
+        self.assertEqual(utils.file_compression('/a/fulltext.txt.zst'), 'zstd')
+        self.assertIsNone(utils.file_compression('/a/fulltext.txt'))
+        self.assertEqual(utils.find_stored_file(
+            '/a/fulltext.txt', exists=lambda name: name.endswith('.zst')),
+            '/a/fulltext.txt.zst')
+        self.assertIsNone(utils.find_stored_file('/a/fulltext.txt',
+                                                 exists=lambda name: False))
+
 
 if __name__ == '__main__':
     unittest.main()
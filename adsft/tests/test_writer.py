@@ -1,7 +1,9 @@
 import unittest
 import os
+import stat
 
-from adsft import writer
+from mock import patch
+from adsft import writer, reader
 from adsft.tests import test_base
 import json
 
@@ -283,6 +285,222 @@ class TestWriteMetaFileWorker(test_base.TestUnit):
         self.assertFalse(os.path.exists(temp_file_name))
         self.assertTrue(os.path.exists(self.meta_file))
 
+    def test_temporary_file_is_renamed_in_place(self):
+        """
+        Tests that the temporary file replaces the existing file with a rename
+        in the same directory, and that it is given the file mode first.
+
+        :return: no return
+        """
+
+        writer.write_content(self.dict_item)
+        inode = os.stat(self.full_text_file).st_ino
+
+        temp_file_name = writer.write_to_temp_file(
+            'new full text', self.bibcode_pair_tree, json_format=False)
+        temp_inode = os.stat(temp_file_name).st_ino
+        writer.move_temp_file_to_file(temp_file_name, self.full_text_file)
+
+        file_stat = os.stat(self.full_text_file)
+        self.assertEqual(file_stat.st_ino, temp_inode)
+        self.assertNotEqual(file_stat.st_ino, inode)
+        self.assertEqual(stat.S_IMODE(file_stat.st_mode), writer.FILE_MODE)
+        with open(self.full_text_file) as f:
+            self.assertEqual(f.read(), 'new full text')
+        self.assertEqual(
+            [name for name in os.listdir(self.bibcode_pair_tree)
+             if name.startswith('tmp')], [])
+
+    def test_fsync_policies(self):
+        """
+        Tests that the files, and then their directory, are flushed to disk
+        depending on the fsync policy.
+
+        :return: no return
+        """
+
+        expected = {
+            writer.FSYNC_NONE: 0,
+            writer.FSYNC_FILE: 3,
+            writer.FSYNC_FILE_AND_DIR: 4,
+        }
+        self.dict_item['acknowledgements'] = 'thanks'
+        self.addCleanup(self._remove, self.acknowledgement_file)
+        for policy in writer.FSYNC_POLICIES:
+            self.dict_item['fulltext'] = 'written with fsync ' + policy
+            with patch.object(writer.os, 'fsync') as fsync:
+                writer.write_content(self.dict_item, fsync=policy)
+                self.assertEqual(fsync.call_count, expected[policy],
+                                 msg=policy)
+
+        with self.assertRaises(ValueError):
+            writer.write_content(self.dict_item, fsync='always')
+
+    def test_document_is_written_in_a_single_session(self):
+        """
+        Tests that the files of a document are published together: none of
+        them is written if one fails, and no temporary file is left behind.
+
+        :return: no return
+        """
+
+        self.dict_item['acknowledgements'] = 'thanks'
+        self.dict_item['index_date'] = object() # cannot be written in json
+        if not os.path.exists(self.bibcode_pair_tree):
+            os.makedirs(self.bibcode_pair_tree)
+        files = os.listdir(self.bibcode_pair_tree)
+        with self.assertRaises(TypeError):
+            writer.write_content(self.dict_item)
+        self.assertEqual(os.listdir(self.bibcode_pair_tree), files)
+        self.assertFalse(os.path.exists(self.full_text_file))
+
+        del self.dict_item['index_date']
+        self.addCleanup(self._remove, self.acknowledgement_file)
+        with patch.object(writer.os, 'makedirs',
+                          side_effect=os.makedirs) as makedirs:
+            writer.write_content(self.dict_item)
+            self.assertEqual(makedirs.call_count, 1)
+        for file_name in (self.acknowledgement_file, self.full_text_file,
+                          self.meta_file):
+            self.assertTrue(os.path.exists(file_name), msg=file_name)
+        self.assertEqual(
+            [name for name in os.listdir(self.bibcode_pair_tree)
+             if name.startswith('.tmp')], [])
+
+    def test_meta_file_is_published_last(self):
+        """
+        Tests that meta.json is renamed after the other files of a document,
+        that it records the full text published with it, and that the
+        document directory is not listed.
+
+        :return: no return
+        """
+
+        real_rename = os.rename
+        renamed = []
+        def rename(source, destination):
+            renamed.append(os.path.basename(destination))
+            real_rename(source, destination)
+        with patch.object(writer.os, 'rename', side_effect=rename), \
+                patch.object(writer.os, 'listdir') as listdir:
+            writer.write_content(self.dict_item)
+            self.assertFalse(listdir.called)
+        self.assertEqual(renamed[-1], writer.COMMIT_FILE)
+        self.assertIn('fulltext.txt', renamed)
+
+        with open(self.meta_file) as f:
+            meta_dict = json.load(f)
+        self.assertEqual(meta_dict['fulltext_file'],
+                         writer.file_fingerprint(self.full_text_file))
+        self.assertIsNone(meta_dict['fulltext_compression'])
+
+    def test_stale_temp_files_are_removed(self):
+        """
+        Tests that the maintenance pass removes the staged files left by a
+        writer that died, but not the recent ones.
+
+        :return: no return
+        """
+
+        if not os.path.exists(self.bibcode_pair_tree):
+            os.makedirs(self.bibcode_pair_tree)
+        stale_file = os.path.join(self.bibcode_pair_tree,
+                                  writer.TEMP_FILE_PREFIX + 'stale')
+        recent_file = os.path.join(self.bibcode_pair_tree,
+                                   writer.TEMP_FILE_PREFIX + 'recent')
+        for file_name in (stale_file, recent_file):
+            with open(file_name, 'w') as f:
+                f.write('partial')
+            self.addCleanup(self._remove, file_name)
+        os.utime(stale_file, (1000000000, 1000000000))
+
+        self.assertEqual(
+            writer.remove_stale_temp_files(self.bibcode_pair_tree), 1)
+        self.assertFalse(os.path.exists(stale_file))
+        self.assertTrue(os.path.exists(recent_file))
+
+    def test_unchanged_content_is_not_rewritten(self):
+        """
+        Tests that the full text is not written again when the content hash
+        is the same, and that the document is not stale afterwards.
+
+        :return: no return
+        """
+
+        self.assertTrue(writer.write_content(self.dict_item))
+        with open(self.meta_file) as f:
+            self.assertEqual(json.load(f)['content_hash'],
+                             writer.content_hash(self.dict_item))
+        inode = os.stat(self.full_text_file).st_ino
+        os.utime(self.full_text_file, (1000000000, 1000000000))
+
+        self.dict_item['UPDATE'] = 'STALE_CONTENT'
+        self.assertFalse(writer.write_content(self.dict_item))
+        self.assertEqual(os.stat(self.full_text_file).st_ino, inode)
+        self.assertEqual(os.stat(self.full_text_file).st_mtime, 1000000000)
+        with open(self.meta_file) as f:
+            meta_dict = json.load(f)
+        self.assertEqual(meta_dict['UPDATE'], 'STALE_CONTENT')
+        self.assertEqual(meta_dict['fulltext_file'],
+                         writer.file_fingerprint(self.full_text_file))
+
+        self.dict_item['fulltext'] = 'new full text'
+        self.assertTrue(writer.write_content(self.dict_item))
+        self.assertNotEqual(os.stat(self.full_text_file).st_ino, inode)
+
+        # content extracted by a previous version is written again
+        inode = os.stat(self.full_text_file).st_ino
+        with patch.object(writer, 'CONTENT_VERSION', writer.CONTENT_VERSION + 1):
+            self.assertTrue(writer.write_content(self.dict_item))
+        self.assertNotEqual(os.stat(self.full_text_file).st_ino, inode)
+
+    def test_fulltext_is_stored_compressed(self):
+        """
+        Tests that the full text can be stored compressed, that it replaces the
+        full text stored without compression, and that it is read back.
+
+        :return: no return
+        """
+
+        compressed_file = self.full_text_file + '.gz'
+        self.addCleanup(self._remove, compressed_file)
+        self.dict_item['fulltext'] = u'caf\xe9 full text ' * 100
+
+        writer.write_content(self.dict_item)
+        self.assertTrue(os.path.exists(self.full_text_file))
+
+        writer.write_content(self.dict_item, compression='gzip')
+        self.assertFalse(os.path.exists(self.full_text_file))
+        self.assertTrue(os.path.exists(compressed_file))
+        with open(self.meta_file) as f:
+            self.assertEqual(json.load(f)['fulltext_compression'], 'gzip')
+        self.assertLess(os.path.getsize(compressed_file),
+                        len(self.dict_item['fulltext']))
+        for compression in (None, 'gzip'):
+            content = reader.read_content(self.dict_item,
+                                          compression=compression)
+            self.assertEqual(content['fulltext'], self.dict_item['fulltext'])
+
+        # the migration keeps the modification time of the full text
+        os.utime(compressed_file, (1000000000, 1000000000))
+        self.assertEqual(writer.migrate_fulltext(self.bibcode_pair_tree,
+                                                 compression=None)[1],
+                         len(self.dict_item['fulltext'].encode('utf-8')))
+        self.assertFalse(os.path.exists(compressed_file))
+        self.assertEqual(os.path.getmtime(self.full_text_file), 1000000000)
+        self.assertIsNone(writer.migrate_fulltext(self.bibcode_pair_tree,
+                                                  compression=None))
+
+        with self.assertRaises(ValueError):
+            writer.write_content(self.dict_item, compression='bzip2')
+
+    @staticmethod
+    def _remove(file_name):
+        try:
+            os.remove(file_name)
+        except OSError:
+            pass
+
     def test_write_worker_returns_content(self):
         """
         Tests the extract_content method. Checks that the payload that the
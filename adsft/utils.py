@@ -15,11 +15,22 @@ __license__ = 'GPLv3'
 
 import sys
 import os
+import collections
 import logging
 import string
 import unicodedata
 import re
 import json
+import io
+import gzip
+import zlib
+import tempfile
+
+try:
+    import zstandard
+except ImportError:
+    # only needed to store the full text compressed with zstd
+    zstandard = None
 
 
 
@@ -53,58 +64,331 @@ class FileInputStream(object):
         print 'Provider: {0}'.format(self.provider)
         print 'Payload content: {0}'.format(self.payload)
 
-    def extract(self, force_extract=False, force_send=False):
+    @staticmethod
+    def parse_line(line, force_extract=False, force_send=False):
         """
-        Opens the file and parses the content depending on the type of input
+        Parses a single line of the links file into a payload dictionary
+        :param line: tab separated line containing bibcode, path and provider
         :param force_extract: boolean decides if the normal checks should
         be ignored and extracted regardless
         :param force_send: boolean decides if the normal checks should
         be ignored and send regardless
-        :return: the bibcode, full text path, provider, and payload content
+        :return: payload dictionary, or None for an empty line
+        """
+
+        l = [i for i in line.strip().split('\t') if i != '']
+        if len(l) == 0:
+            return None
+
+        payload_dictionary = {
+            'bibcode': l[0],
+            'ft_source': l[1],
+            'provider': l[2]
+        }
+
+        if force_extract:
+            payload_dictionary['UPDATE'] = \
+                'FORCE_TO_EXTRACT'
+
+        if force_send and not force_extract:
+            payload_dictionary['UPDATE'] = \
+                'FORCE_TO_SEND'
+
+        return payload_dictionary
+
+    def stream(self, force_extract=False, force_send=False):
+        """
+        Lazily reads the file and yields one payload dictionary per line,
+        without keeping the content of the whole file in memory
+        :param force_extract: boolean decides if the normal checks should
+        be ignored and extracted regardless
+        :param force_send: boolean decides if the normal checks should
+        be ignored and send regardless
+        :return: generator of payload dictionaries
         """
 
         in_file = self.input_stream
         try:
             with open(in_file, 'r') as f:
-
-                raw = []
-                bibcode, full_text_path, provider = [], [], []
                 for line in f:
-
-                    l = [i for i in line.strip().split('\t') if i != '']
-                    if len(l) == 0:
+                    payload_dictionary = self.parse_line(
+                        line,
+                        force_extract=force_extract,
+                        force_send=force_send
+                    )
+                    if payload_dictionary is None:
                         continue
-                    bibcode.append(l[0])
-                    full_text_path.append(l[1])
-                    provider.append(l[2])
-                    payload_dictionary = {
-                        'bibcode': bibcode[-1],
-                        'ft_source': full_text_path[-1],
-                        'provider': provider[-1]
-                    }
-
-                    if force_extract:
-                        payload_dictionary['UPDATE'] = \
-                            'FORCE_TO_EXTRACT'
-
-                    if force_send and not force_extract:
-                        payload_dictionary['UPDATE'] = \
-                            'FORCE_TO_SEND'
-
-                    raw.append(payload_dictionary)
-
-            self.bibcode = bibcode
-            self.full_text_path = full_text_path
-            self.provider = provider
-            self.payload = raw
+                    yield payload_dictionary
 
         except IOError:
             print in_file, sys.exc_info()
 
+    def stream_packets(self, packet_size, force_extract=False,
+                       force_send=False):
+        """
+        Lazily reads the file and yields lists of at most packet_size
+        payload dictionaries
+        :param packet_size: maximum number of payloads per list
+        :param force_extract: boolean decides if the normal checks should
+        be ignored and extracted regardless
+        :param force_send: boolean decides if the normal checks should
+        be ignored and send regardless
+        :return: generator of lists of payload dictionaries
+        """
+
+        return make_packets(self.stream(force_extract=force_extract,
+                                        force_send=force_send),
+                            packet_size)
+
+    def extract(self, force_extract=False, force_send=False):
+        """
+        Opens the file and parses the content depending on the type of input
+        :param force_extract: boolean decides if the normal checks should
+        be ignored and extracted regardless
+        :param force_send: boolean decides if the normal checks should
+        be ignored and send regardless
+        :return: the bibcode, full text path, provider, and payload content
+        """
+
+        raw = []
+        bibcode, full_text_path, provider = [], [], []
+        for payload_dictionary in self.stream(force_extract=force_extract,
+                                              force_send=force_send):
+            bibcode.append(payload_dictionary['bibcode'])
+            full_text_path.append(payload_dictionary['ft_source'])
+            provider.append(payload_dictionary['provider'])
+            raw.append(payload_dictionary)
+
+        self.bibcode = bibcode
+        self.full_text_path = full_text_path
+        self.provider = provider
+        self.payload = raw
+
         return self.bibcode, self.full_text_path, self.provider, self.payload
 
 
 
+def make_packets(records, packet_size):
+    """
+    Groups the records of an iterable into lists of at most packet_size
+    elements, consuming the iterable lazily
+    :param records: iterable of payload dictionaries
+    :param packet_size: maximum number of payloads per list
+    :return: generator of lists of payload dictionaries
+    """
+
+    packet = []
+    for record in records:
+        packet.append(record)
+        if len(packet) >= packet_size:
+            yield packet
+            packet = []
+
+    if packet:
+        yield packet
+
+
+class LinksSnapshot(object):
+    """
+    Compact index of the links file as it was published during the previous
+    run. Each line of the snapshot file contains the bibcode, full text path,
+    provider, and the modification time and size of the full text source,
+    sorted by bibcode. It is used to only publish the records that were added
+    or changed since the last run.
+    """
+
+    def __init__(self, snapshot_file):
+        """
+        Initialisation (constructor) method of the class
+        :param snapshot_file: path to the snapshot of the previous run, it does
+        not need to exist
+        :return: no return
+        """
+
+        self.snapshot_file = snapshot_file
+        self.index = {}
+        self.pending = {}
+        self.seen = set()
+        self.complete = False
+        self.unchanged = 0
+        self.removed = []
+
+    def load(self):
+        """
+        Loads the snapshot of the previous run, if there is one
+        :return: number of entries loaded
+        """
+
+        self.index = {}
+        if not os.path.isfile(self.snapshot_file):
+            return 0
+
+        with open(self.snapshot_file, 'r') as f:
+            for line in f:
+                l = line.rstrip('\n').split('\t')
+                if len(l) != 5:
+                    continue
+                self.index[l[0]] = (l[1], l[2], int(l[3]), int(l[4]))
+
+        return len(self.index)
+
+    @staticmethod
+    def source_signature(ft_source):
+        """
+        Stats the full text source(s) to find their latest modification time
+        and total size. Missing files have a signature of -1.
+        :param ft_source: full text path as given in the links file
+        :return: tuple of modification time (seconds) and size (bytes)
+        """
+
+        mtime, size = 0, 0
+        try:
+            for file_name in get_filenames(ft_source):
+                stat = os.stat(file_name)
+                mtime = max(mtime, int(stat.st_mtime))
+                size += stat.st_size
+        except (OSError, ValueError):
+            return -1, -1
+
+        return mtime, size
+
+    def changed(self, records, force=False):
+        """
+        Filters the records and only yields those that are new or differ from
+        the previous snapshot (path, provider, source modification time or
+        size). Once the records are exhausted, the bibcodes that disappeared
+        from the links file are stored in the removed attribute.
+        :param records: iterable of payload dictionaries
+        :param force: yield every record, the snapshot is still updated with
+        those published
+        :return: generator of payload dictionaries
+        """
+
+        for record in records:
+            bibcode = record['bibcode']
+            self.seen.add(bibcode)
+            entry = (record['ft_source'], record['provider']) + \
+                self.source_signature(record['ft_source'])
+
+            if not force and self.index.get(bibcode) == entry:
+                self.unchanged += 1
+                continue
+
+            self.pending[bibcode] = entry
+            yield record
+
+        self.removed = sorted(set(self.index.keys()) - self.seen)
+        self.complete = True
+
+    def published(self, records):
+        """
+        Marks the records as published, so that they are stored in the
+        snapshot of this run
+        :param records: list of payload dictionaries
+        :return: no return
+        """
+
+        for record in records:
+            bibcode = record['bibcode']
+            if bibcode in self.pending:
+                self.index[bibcode] = self.pending.pop(bibcode)
+
+    def save(self):
+        """
+        Writes the snapshot of this run to disk. Records that were not
+        published keep their previous entry and removed bibcodes are only
+        dropped if the whole links file was read. The file is replaced
+        atomically.
+        :return: number of entries written
+        """
+
+        if self.complete:
+            for bibcode in self.removed:
+                self.index.pop(bibcode, None)
+
+        snapshot_path = os.path.dirname(os.path.abspath(self.snapshot_file))
+        with tempfile.NamedTemporaryFile(mode='w', dir=snapshot_path,
+                                         delete=False) as temp_file:
+            for bibcode in sorted(self.index):
+                ft_source, provider, mtime, size = self.index[bibcode]
+                temp_file.write('{0}\t{1}\t{2}\t{3:d}\t{4:d}\n'.format(
+                    bibcode, ft_source, provider, mtime, size))
+
+        os.rename(temp_file.name, self.snapshot_file)
+
+        return len(self.index)
+
+
+# Translation maps used by TextCleaner.translate (see TextCleaner.__init__).
+# They are built once at import time rather than for every piece of text
+# cleaned, which matters for the many short strings (one per XPath hit).
+ASCII_TRANSLATION_MAP = string.maketrans(
+    ''.join([chr(i) for i in range(0, 32)]),
+    ''.join([chr(i) if i in [9, 10] else ' ' for i in range(0, 32)]))
+
+UNICODE_CONTROL_NUMBERS = ((0x00, 0x08), (0x0B, 0x1F), (0x7F, 0x84),
+                           (0x86, 0x9F), (0xD800, 0xDFFF), (0xFDD0, 0xFDDF),
+                           (0xFFFE, 0xFFFF),
+                           (0x1FFFE, 0x1FFFF), (0x2FFFE, 0x2FFFF),
+                           (0x3FFFE, 0x3FFFF), (0x4FFFE, 0x4FFFF),
+                           (0x5FFFE, 0x5FFFF), (0x6FFFE, 0x6FFFF),
+                           (0x7FFFE, 0x7FFFF), (0x8FFFE, 0x8FFFF),
+                           (0x9FFFE, 0x9FFFF), (0xAFFFE, 0xAFFFF),
+                           (0xBFFFE, 0xBFFFF), (0xCFFFE, 0xCFFFF),
+                           (0xDFFFE, 0xDFFFF), (0xEFFFE, 0xEFFFF),
+                           (0xFFFFE, 0xFFFFF), (0x10FFFE, 0x10FFFF))
+
+
+class ReadOnlyMap(collections.Mapping):
+    """
+    Mapping that cannot be changed once built, for the module-level
+    translation maps shared by every TextCleaner. It can be given to
+    unicode.translate like a dict.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._map = dict(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self._map[key]
+
+    def __iter__(self):
+        return iter(self._map)
+
+    def __len__(self):
+        return len(self._map)
+
+
+UNICODE_TRANSLATION_MAP = ReadOnlyMap(dict.fromkeys(
+    unicode_number
+    for starting_unicode_number, ending_unicode_number
+    in UNICODE_CONTROL_NUMBERS
+    for unicode_number
+    in range(starting_unicode_number, ending_unicode_number+1)
+))
+
+# The same characters as a regular expression class: deleting its matches
+# gives the same text as translating with the map, but runs at regular
+# expression speed instead of one dictionary lookup per character. Narrow
+# Python builds have no characters above sys.maxunicode (unichr fails on
+# them): their text holds surrogates instead, which are removed either way
+UNICODE_CONTROL_CHARACTERS = re.compile(u'[{0}]'.format(u''.join(
+    u'{0}-{1}'.format(unichr(starting_unicode_number),
+                      unichr(ending_unicode_number))
+    for starting_unicode_number, ending_unicode_number
+    in UNICODE_CONTROL_NUMBERS
+    if ending_unicode_number <= sys.maxunicode
+)))
+
+MULTIPLE_SPACES = re.compile('  +')
+
+
+# Version of the cleaning done by TextCleaner. Extraction results are marked
+# with it ('cleaned'), so that task_output_results does not clean them again;
+# increase it when the cleaning changes
+TEXT_CLEANER_VERSION = 1
+
+
 class TextCleaner(object):
     """
     Class that contains methods to clean text.
@@ -176,35 +460,8 @@ class TextCleaner(object):
         """
 
         self.text = text
-
-        translated_control_characters = ''.join(
-            [chr(i) if i in [9, 10] else ' ' for i in range(0, 32)])
-
-        input_control_characters = "".join([chr(i) for i in range(0, 32)])
-
-        self.ASCII_translation_map = string.maketrans(
-            input_control_characters, translated_control_characters)
-
-        unicode_control_numbers = [(0x00, 0x08), (0x0B, 0x1F), (0x7F, 0x84),
-                                   (0x86, 0x9F), (0xD800, 0xDFFF), (0xFDD0,
-                                                                    0xFDDF),
-                                   (0xFFFE, 0xFFFF),
-                                   (0x1FFFE, 0x1FFFF), (0x2FFFE, 0x2FFFF),
-                                   (0x3FFFE, 0x3FFFF), (0x4FFFE, 0x4FFFF),
-                                   (0x5FFFE, 0x5FFFF), (0x6FFFE, 0x6FFFF),
-                                   (0x7FFFE, 0x7FFFF), (0x8FFFE, 0x8FFFF),
-                                   (0x9FFFE, 0x9FFFF), (0xAFFFE, 0xAFFFF),
-                                   (0xBFFFE, 0xBFFFF), (0xCFFFE, 0xCFFFF),
-                                   (0xDFFFE, 0xDFFFF), (0xEFFFE, 0xEFFFF),
-                                   (0xFFFFE, 0xFFFFF), (0x10FFFE, 0x10FFFF)]
-
-        self.Unicode_translation_map = dict.fromkeys(
-            unicode_number
-            for starting_unicode_number, ending_unicode_number
-            in unicode_control_numbers
-            for unicode_number
-            in range(starting_unicode_number, ending_unicode_number+1)
-        )
+        self.ASCII_translation_map = ASCII_TRANSLATION_MAP
+        self.Unicode_translation_map = UNICODE_TRANSLATION_MAP
 
     def translate(self):
         """
@@ -214,6 +471,8 @@ class TextCleaner(object):
 
         if type(self.text) == str:
             self.text = self.text.translate(self.ASCII_translation_map)
+        elif self.Unicode_translation_map is UNICODE_TRANSLATION_MAP:
+            self.text = UNICODE_CONTROL_CHARACTERS.sub(u'', self.text)
         else:
             self.text = self.text.translate(self.Unicode_translation_map)
 
@@ -239,13 +498,17 @@ class TextCleaner(object):
         Removes "words" longer than wordlength characters, which tend to be
         artifacts generated by the text extraction pipeline (typically tables).
         We do this because these huge words cause problems further down the line
-        when they are indexed in SOLR
+        when they are indexed in SOLR. Multiple spaces, including the ones left
+        behind by the removed words, are substituted with just one space.
+
+        The long words are removed in a single scan of the text. The compiled
+        pattern is kept by the bounded cache of the re module.
         :param maxlength: maximum length of words to keep
         :return: no return
         """
-        self.text = re.sub(r'\S{'+str(maxlength)+r',}\b', '', self.text)
-        # Substitute multiple spaces with just one space:
-        self.text = re.sub('  +', ' ', self.text)
+        self.text = re.compile(r'\S{'+str(maxlength)+r',}\b').sub('', self.text)
+        if '  ' in self.text:
+            self.text = MULTIPLE_SPACES.sub(' ', self.text)
 
 
     def run(self, translate=True, decode=True, normalise=True, trim=True):
@@ -298,3 +561,124 @@ def get_filenames(file_string):
             files[i] = files[i][:-1]
 
     return files
+
+
+# Formats in which the full text can be stored at rest (FULLTEXT_COMPRESSION
+# in config.py), and the extension they add to the file name
+FULLTEXT_COMPRESSIONS = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+def check_compression(compression):
+    """
+    Raises ValueError if the compression is not known, or cannot be used
+    because its library is not installed
+
+    :param compression: one of FULLTEXT_COMPRESSIONS
+    :return: no return
+    """
+
+    if compression not in FULLTEXT_COMPRESSIONS:
+        raise ValueError('Unknown compression: {0}'.format(compression))
+    if compression == 'zstd' and zstandard is None:
+        raise ValueError('The zstandard package is needed for zstd compression')
+
+
+def compressed_file_name(file_name, compression):
+    """
+    Name of the file once stored with the given compression
+
+    :param file_name: name of the uncompressed file, e.g. fulltext.txt
+    :param compression: one of FULLTEXT_COMPRESSIONS
+    :return: file name with the extension of the compression
+    """
+
+    return file_name + FULLTEXT_COMPRESSIONS[compression]
+
+
+def file_compression(file_name):
+    """
+    Compression of a file, given by its extension
+
+    :param file_name: name of the file
+    :return: one of FULLTEXT_COMPRESSIONS
+    """
+
+    for compression, extension in FULLTEXT_COMPRESSIONS.items():
+        if extension and file_name.endswith(extension):
+            return compression
+    return None
+
+
+def stored_file_names(file_name, compression=None):
+    """
+    Names a file can be stored with, in the order they should be looked for:
+    the given compression first, as it is the one the writer uses
+
+    :param file_name: name of the uncompressed file, e.g. fulltext.txt
+    :param compression: compression the file is expected to have
+    :return: list of file names
+    """
+
+    names = [compressed_file_name(file_name, compression)]
+    for other in sorted(FULLTEXT_COMPRESSIONS):
+        if other != compression:
+            names.append(compressed_file_name(file_name, other))
+    return names
+
+
+def find_stored_file(file_name, compression=None, exists=os.path.exists):
+    """
+    Looks for a file stored with any compression
+
+    :param file_name: name of the uncompressed file, e.g. fulltext.txt
+    :param compression: compression the file is expected to have
+    :param exists: function telling if a path exists (e.g. a cached one)
+    :return: the name of the stored file, or None if there is none
+    """
+
+    for name in stored_file_names(file_name, compression):
+        if exists(name):
+            return name
+    return None
+
+
+def compress(data, compression):
+    """
+    Compresses the data
+
+    :param data: byte string
+    :param compression: one of FULLTEXT_COMPRESSIONS
+    :return: compressed byte string
+    """
+
+    if compression is None:
+        return data
+    check_compression(compression)
+    if compression == 'gzip':
+        # gzip container, so that the files can be read with zcat
+        buf = io.BytesIO()
+        with gzip.GzipFile(filename='', mode='wb', fileobj=buf, mtime=0) as f:
+            f.write(data)
+        return buf.getvalue()
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def decompress(data, compression):
+    """
+    Decompresses the data
+
+    :param data: compressed byte string
+    :param compression: one of FULLTEXT_COMPRESSIONS
+    :return: byte string
+    """
+
+    if compression is None:
+        return data
+    check_compression(compression)
+    if compression == 'gzip':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    return zstandard.ZstdDecompressor().decompress(data)
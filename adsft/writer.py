@@ -16,91 +16,454 @@ __license__ = 'GPLv3'
 
 import sys
 import os
+import errno
 import json
 import tempfile
-import shutil
+import hashlib
+import time
+from adsft import reader
 from adsft.rules import META_CONTENT
+from adsft.utils import get_filenames, check_compression, compress, \
+    compressed_file_name, find_stored_file, file_compression
 from adsputils import setup_logging
 
 logger = setup_logging(__name__)
 
-
-def write_to_temp_file(payload, temp_path='/tmp/', json_format=True):
+# Policies for flushing the written files to disk (WRITE_FSYNC in config.py):
+# none leaves it to the operating system, file syncs the content of each file
+# before it is renamed, and file+dir also syncs the directory after the rename
+FSYNC_NONE = 'none'
+FSYNC_FILE = 'file'
+FSYNC_FILE_AND_DIR = 'file+dir'
+FSYNC_POLICIES = (FSYNC_NONE, FSYNC_FILE, FSYNC_FILE_AND_DIR)
+
+# protect full-text from world access but keep it group-readable
+FILE_MODE = 0640
+
+# Version of the extracted content, part of its hash (see content_hash).
+# Increase it when a change of the extraction changes the text of documents
+# already extracted: each document is then written and forwarded again the
+# next time it is extracted, instead of being seen as unchanged. A full
+# re-extraction (run.py -e) brings all the stored content to the new version.
+#   2: XML articles keep their numeric character references (decoded) and
+#      their unknown entities (see entitydefs.convertentities)
+CONTENT_VERSION = 2
+
+# meta.json is published after the other files of a document, and records the
+# full text file published with it (see file_fingerprint): a document whose
+# full text does not match its meta.json was not completely written, and is
+# extracted again
+COMMIT_FILE = 'meta.json'
+
+# Files are staged in the directory of the document with this prefix. Those
+# older than STALE_TEMP_FILE_AGE seconds were left by a writer that died, and
+# are removed by scripts/remove_stale_temp_files.py
+TEMP_FILE_PREFIX = '.tmp'
+STALE_TEMP_FILE_AGE = 3600
+
+
+def write_to_temp_file(payload, temp_path='/tmp/', json_format=True,
+                       fsync=False, prefix='tmp'):
     """
     Writes the received payloadto a temporary file using the temporary file lib
 
     :param payload: text received from the pipeline
     :param temp_path: path to write the temporary file
     :param json_format: whether the given content is in json format
-    :return: the temporary file name written to disk
+    :param fsync: whether the content is flushed to disk before returning
+    :param prefix: prefix of the temporary file name
+    :return: the temporary file name written to disk, it is removed if the
+    payload cannot be written
     """
 
-    with tempfile.NamedTemporaryFile(mode='w', dir=temp_path,
+    with tempfile.NamedTemporaryFile(mode='w', dir=temp_path, prefix=prefix,
                                      delete=False) as temp_file:
         temp_file_name = temp_file.name
-        if json_format:
-            json.dump(payload, temp_file)
-        else:
-            if type(payload) == unicode:
-                temp_file.write(payload.encode('utf-8'))
+        try:
+            if json_format:
+                json.dump(payload, temp_file)
             else:
-                temp_file.write(payload) # assuming this is already a bytecode
+                if type(payload) == unicode:
+                    temp_file.write(payload.encode('utf-8'))
+                else:
+                    temp_file.write(payload) # assuming this is already a bytecode
+            if fsync:
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+        except Exception:
+            os.remove(temp_file_name)
+            raise
 
     logger.debug('Temp file name: {0}'.format(temp_file_name))
 
     return temp_file_name
 
 
-def move_temp_file_to_file(temp_file_name, new_file_name):
+def fsync_directory(path):
     """
-    Copies the temporary file to a new file with the wanted name. Removes the
-    old  temporary file on success.
+    Flushes the entries of the directory to disk, so that a file renamed into
+    it survives a crash
+
+    :param path: path of the directory
+    :return: no return
+    """
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def file_fingerprint(file_path, stat=None):
+    """
+    Name, size and modification time of a file, recorded in meta.json for the
+    full text file (see COMMIT_FILE)
+
+    :param file_path: path of the file
+    :param stat: os.stat of the file, if it is known
+    :return: list of the name, size and modification time
+    """
+
+    if stat is None:
+        stat = os.stat(file_path)
+    return [os.path.basename(file_path), stat.st_size, stat.st_mtime]
+
+
+def remove_stale_temp_files(path, age=STALE_TEMP_FILE_AGE):
+    """
+    Removes the files staged in the document directory (see WriteSession) that
+    are older than age seconds. It is not done when a document is written, as
+    it would list the directory every time, but by a periodic maintenance
+    pass, see scripts/remove_stale_temp_files.py
+
+    :param path: directory of the document
+    :param age: age in seconds
+    :return: number of files removed
+    """
+
+    limit = time.time() - age
+    removed = 0
+    for name in os.listdir(path):
+        if not name.startswith(TEMP_FILE_PREFIX):
+            continue
+        temp_file_name = os.path.join(path, name)
+        try:
+            if os.path.isfile(temp_file_name) and \
+                    os.path.getmtime(temp_file_name) < limit:
+                os.remove(temp_file_name)
+                removed += 1
+                logger.info('Removed stale temporary file: {0}'.format(
+                    temp_file_name))
+        except OSError as err:
+            logger.error('Could not remove stale temporary file {0}: '
+                         '{1}'.format(temp_file_name, err))
+    return removed
+
+
+def move_temp_file_to_file(temp_file_name, new_file_name, fsync_dir=False):
+    """
+    Renames the temporary file to the wanted name. The temporary file has to
+    be in the same directory (see WriteSession), so the rename is atomic and
+    replaces any previous file: readers see either the old or the new content.
+    The temporary file is removed if it cannot be renamed.
 
     :param temp_file_name: name of the temporary file
     :param new_file_name: name wanted for the final file
-    :return: no return is given
+    :param fsync_dir: whether the directory is flushed to disk after the rename
+    :return: whether the file was renamed
     """
 
     try:
-        shutil.copy(temp_file_name, new_file_name)
-        # protect full-text from world access but keep it group-readable
-        os.chmod(new_file_name, 0640)
+        os.chmod(temp_file_name, FILE_MODE)
+        os.rename(temp_file_name, new_file_name)
     except Exception as err:
-        logger.error('Unexpected error from shutil in copying temporary file to'
+        logger.error('Unexpected error from os in renaming temporary file to'
                      ' new file: {0}'.format(err))
+        try:
+            os.remove(temp_file_name)
+        except Exception as err:
+            logger.error(
+                'Unexpected error from os removing a file: {0}'.format(err))
+        return False
 
-    try:
-        os.remove(temp_file_name)
-    except Exception as err:
-        logger.error(
-            'Unexpected error from os removing a file: {0}'.format(err))
+    if fsync_dir:
+        fsync_directory(os.path.dirname(new_file_name) or '.')
 
     logger.debug(
-        'Succeeded to copy: {0} to {1}'.format(temp_file_name, new_file_name)
+        'Succeeded to rename: {0} to {1}'.format(temp_file_name, new_file_name)
     )
+    return True
 
-def write_file(file_name, payload, json_format=True):
+
+class WriteSession(object):
+    """
+    Writes the files of a document together. Each file is staged in a
+    temporary file of the document directory, and they are all renamed to
+    their final names once every file has been written, in the order they
+    were written but meta.json last (see COMMIT_FILE). Nothing is published
+    if a write fails, and the staged files are removed (or by the periodic
+    maintenance pass, if the writer died, see remove_stale_temp_files).
+
+    Use it as a context manager:
+
+        with WriteSession(path, fsync=FSYNC_FILE) as session:
+            session.write('fulltext.txt', text, json_format=False)
+            session.write('meta.json', meta_dict)
     """
-    A wrapper function for two separate functions, with the aim of:
-      1. creating a temporary file with the payload as content
-      2. moving the temporary file to the wanted file name
 
-    This approach is used in case of a race-condition, where two workers
-    have the same output path, and will stop the chance of corrupted files
+    def __init__(self, path, fsync=FSYNC_NONE):
+        """
+        :param path: directory of the document, created if needed
+        :param fsync: fsync policy, one of FSYNC_POLICIES
+        """
 
-    :param file_name: desired file name for output
-    :param payload: the content to be written to disk
-    :param json_format: whether or not the payload is in json format
-    :return: no return
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy: {0}'.format(fsync))
+
+        self.path = path
+        self.fsync = fsync
+        self.staged = []
+        self.obsolete = []
+
+    def __enter__(self):
+        try:
+            os.makedirs(self.path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.publish()
+        finally:
+            self.discard()
+        return False
+
+    def write(self, file_name, payload, json_format=True):
+        """
+        Stages a file of the document
+
+        :param file_name: name of the file in the document directory
+        :param payload: the content to be written to disk
+        :param json_format: whether or not the payload is in json format
+        :return: no return
+        """
+
+        temp_file_name = write_to_temp_file(payload, temp_path=self.path,
+                                            json_format=json_format,
+                                            fsync=self.fsync != FSYNC_NONE,
+                                            prefix=TEMP_FILE_PREFIX)
+        self.staged.append((temp_file_name,
+                            os.path.join(self.path, file_name)))
+
+    def staged_path(self, file_name):
+        """
+        Path of the staged copy of a file, until the session is published
+
+        :param file_name: name of the file in the document directory
+        :return: path of the temporary file
+        """
+
+        file_path = os.path.join(self.path, file_name)
+        for temp_file_name, staged_file_name in self.staged:
+            if staged_file_name == file_path:
+                return temp_file_name
+        raise KeyError(file_name)
+
+    def write_stored(self, file_name, payload, compression=None,
+                     previous_compression=None):
+        """
+        Stages a text file that is stored with the given compression. If the
+        file was stored with another compression until now, that copy is
+        removed when the session is published.
+
+        :param file_name: name of the uncompressed file, e.g. fulltext.txt
+        :param payload: the text to be written to disk
+        :param compression: one of utils.FULLTEXT_COMPRESSIONS
+        :param previous_compression: compression the file was stored with
+        :return: no return
+        """
+
+        if type(payload) == unicode:
+            payload = payload.encode('utf-8')
+        self.write(compressed_file_name(file_name, compression),
+                   compress(payload, compression), json_format=False)
+        if previous_compression != compression:
+            self.obsolete.append(compressed_file_name(file_name,
+                                                      previous_compression))
+
+    def publish(self):
+        """
+        Renames the staged files to their final names, see
+        move_temp_file_to_file, meta.json last. The directory is flushed to
+        disk once, after the last rename, under the file+dir fsync policy: a
+        meta.json that survives a crash without the files renamed before it
+        does not match them (see file_fingerprint), so no flush is needed in
+        between.
+
+        :return: no return
+        """
+
+        commit_file = os.path.join(self.path, COMMIT_FILE)
+        self.staged.sort(key=lambda staged: staged[1] == commit_file)
+        while self.staged:
+            temp_file_name, file_name = self.staged.pop(0)
+            if not move_temp_file_to_file(temp_file_name, file_name):
+                raise OSError('Could not rename {0} to {1}'.format(
+                    temp_file_name, file_name))
+
+        while self.obsolete:
+            file_name = self.obsolete.pop()
+            try:
+                os.remove(os.path.join(self.path, file_name))
+                logger.debug('Removed obsolete file: {0}'.format(file_name))
+            except OSError as err:
+                if err.errno != errno.ENOENT:
+                    raise
+
+        if self.fsync == FSYNC_FILE_AND_DIR:
+            fsync_directory(self.path)
+
+    def discard(self):
+        """
+        Removes the staged files that were not published
+
+        :return: no return
+        """
+
+        self.obsolete = []
+        while self.staged:
+            temp_file_name, file_name = self.staged.pop()
+            try:
+                os.remove(temp_file_name)
+            except OSError as err:
+                logger.error('Unexpected error from os removing a file: '
+                             '{0}'.format(err))
+
+
+def extraction_state(payload_dictionary):
+    """
+    Builds the extraction state of a document (see models.ExtractionState):
+    the relevant meta-data, the modification time and size of the source file,
+    and a hash of the full text content written to disk.
+
+    :param payload_dictionary: the complete extracted content and meta-data of
+    the document payload
+    :return: dictionary with the extraction state
+    """
+
+    state = {}
+    for const in ('bibcode', 'ft_source', 'provider', 'index_date', 'file_format'):
+        state[const] = payload_dictionary.get(const, None)
+
+    try:
+        stat = os.stat(get_filenames(payload_dictionary['ft_source'])[0])
+        state['source_mtime'] = int(stat.st_mtime)
+        state['source_size'] = stat.st_size
+    except (OSError, ValueError):
+        logger.warning('Could not stat the source file: {0}'.format(
+            payload_dictionary['ft_source']))
+        state['source_mtime'] = None
+        state['source_size'] = None
+
+    fulltext = payload_dictionary.get('fulltext', '')
+    if type(fulltext) == unicode:
+        fulltext = fulltext.encode('utf-8')
+    state['fulltext_hash'] = hashlib.sha1(fulltext).hexdigest()
+
+    return state
+
+
+def content_hash(payload_dictionary):
+    """
+    Hash of the extracted content of a document: the full text and the custom
+    extractions of content (see META_CONTENT), i.e. what is sent to master,
+    and the version of the extraction (see CONTENT_VERSION). The meta-data,
+    which changes every time a document is extracted, is not part of it.
+
+    :param payload_dictionary: the complete extracted content and meta-data of
+    the document payload
+    :return: sha1 hex digest
     """
 
-    temp_path = os.path.dirname(file_name)
-    temp_file_name = write_to_temp_file(payload, temp_path=temp_path,
-                                        json_format=json_format)
-    move_temp_file_to_file(temp_file_name, file_name)
+    keys = set(META_CONTENT[payload_dictionary['file_format']])
+    keys.add('fulltext')
+    content = [(key, payload_dictionary.get(key, None)) for key in sorted(keys)]
+    content.append(('content_version', CONTENT_VERSION))
+    return hashlib.sha1(json.dumps(content)).hexdigest()
 
 
-def write_content(payload_dictionary):
+def meta_content(payload_dictionary):
+    """
+    Content of the meta.json file of a document: its meta-data, the custom
+    extractions of content (see META_CONTENT) and the hash of the content
+    (see content_hash), but not the full text
+
+    :param payload_dictionary: the complete extracted content and meta-data of
+    the document payload
+    :return: dictionary with the meta.json content
+    """
+
+    meta_dict = {}
+
+    for const in ('meta_path', 'ft_source', 'bibcode', 'provider', 'UPDATE', 'file_format', 'index_date', 'dataset'):
+        try:
+            meta_dict[const] = payload_dictionary[const]
+            logger.debug('Adding meta content: {0}'.format(const))
+        except KeyError:
+            #print('Missing meta content: {0}'.format(const))
+            continue
+
+    for meta_key_word in META_CONTENT[payload_dictionary['file_format']]:
+        if meta_key_word in ('dataset', 'fulltext'):
+            continue
+        if meta_key_word in payload_dictionary:
+            meta_dict[meta_key_word] = payload_dictionary[meta_key_word]
+
+    meta_dict['content_hash'] = content_hash(payload_dictionary)
+
+    return meta_dict
+
+
+def existing_meta_content(meta_output_file_path):
+    """
+    Content of the meta.json file on disk
+
+    :param meta_output_file_path: path of the meta.json file
+    :return: dictionary, or None if there is no meta.json file to read
+    """
+
+    try:
+        return reader.read_file(meta_output_file_path, json_format=True)
+    except (IOError, ValueError):
+        return None
+
+
+def unchanged_content(existing_meta_dict, full_text_output_file_path,
+                      meta_dict):
+    """
+    Whether the content on disk is the one about to be written: the meta.json
+    file records the same content hash, and the full text is stored where it
+    would be written
+
+    :param existing_meta_dict: content of the meta.json file on disk, or None
+    :param full_text_output_file_path: path the full text would be written to
+    :param meta_dict: content of the meta.json file about to be written
+    :return: boolean
+    """
+
+    if existing_meta_dict is None:
+        return False
+
+    return existing_meta_dict.get('content_hash') == meta_dict['content_hash'] \
+        and os.path.exists(full_text_output_file_path)
+
+
+def write_content(payload_dictionary, state_store=None, fsync=FSYNC_NONE,
+                  compression=None):
     """
     Function that writes a single document to file. It expects a json-type
     payload that has been converted into a Python dictionary.
@@ -110,14 +473,26 @@ def write_content(payload_dictionary):
       3. dataset items
       4. a meta.json file containing relevant meta-data defined in settings.py
 
-    The files are then moved to their expected names, and the temporary
-    files removed.
+    The files are written in a single WriteSession: they are only moved to
+    their expected names once all of them are written, meta.json last. The
+    full text can be stored compressed, e.g. as fulltext.txt.gz. If a state
+    store is given, the extraction state of the document is updated as well.
+
+    If the content on disk has the same content hash, only meta.json is
+    written: the full text is not rewritten, its modification time is updated
+    and recorded in meta.json so that the document is not seen as stale.
 
     :param payload_dictionary: the complete extracted content and meta-data of
     the document payload
-    :return: no return
+    :param state_store: extraction state store (see app.py), optional
+    :param fsync: fsync policy of the files written, one of FSYNC_POLICIES
+    :param compression: compression of fulltext.txt, one of
+    utils.FULLTEXT_COMPRESSIONS
+    :return: whether the content on disk changed
     """
 
+    check_compression(compression)
+
     meta_output_file_path = payload_dictionary['meta_path']
     bibcode_pair_tree_path = os.path.dirname(meta_output_file_path)
     if payload_dictionary['file_format'] == 'pdf-grobid':
@@ -127,82 +502,176 @@ def write_content(payload_dictionary):
 
     if 'UPDATE' in payload_dictionary and \
         payload_dictionary['UPDATE'] == 'FORCE_TO_SEND' and \
-        os.path.exists(meta_output_file_path) and os.path.exists(full_text_output_file_path):
+        os.path.exists(meta_output_file_path) and \
+        find_stored_file(full_text_output_file_path, compression) is not None:
                 # Data was already extracted and saved
-                return
-
-    if not os.path.exists(bibcode_pair_tree_path):
-        try:
-            os.makedirs(bibcode_pair_tree_path)
-        except OSError:
-            raise OSError
+                return False
 
     # Write everything but the full text content to the meta.json
-    meta_dict = {}
-
-    for const in ('meta_path', 'ft_source', 'bibcode', 'provider', 'UPDATE', 'file_format', 'index_date', 'dataset'):
-        try:
-            meta_dict[const] = payload_dictionary[const]
-            logger.debug('Adding meta content: {0}'.format(const))
-        except KeyError:
-            #print('Missing meta content: {0}'.format(const))
-            continue
-
-    # Write the custom extractions of content to the meta.json
-    logger.debug('Copying extra meta content')
-    for meta_key_word in META_CONTENT[payload_dictionary['file_format']]:
-        if meta_key_word in ('dataset', 'fulltext'):
-            continue
-
-        logger.debug(meta_key_word)
-        try:
-            meta_key_word_value = payload_dictionary[meta_key_word]
-            meta_dict[meta_key_word] = meta_key_word_value
+    meta_dict = meta_content(payload_dictionary)
+
+    # meta.json records the compression the full text is stored with, so that
+    # the copy stored with another one is only looked for when it changed. A
+    # new document has no other copy.
+    existing_meta_dict = None
+    previous_compression = compression
+    if payload_dictionary['file_format'] != 'pdf-grobid':
+        existing_meta_dict = existing_meta_content(meta_output_file_path)
+        if existing_meta_dict is not None:
+            previous_compression = existing_meta_dict.get(
+                'fulltext_compression')
+
+    if payload_dictionary['file_format'] != 'pdf-grobid' \
+            and payload_dictionary.get('fulltext') \
+            and unchanged_content(existing_meta_dict,
+                                  compressed_file_name(full_text_output_file_path,
+                                                       compression),
+                                  meta_dict):
+        logger.info('Content of {0} is unchanged, only writing meta-data'
+                    .format(payload_dictionary['bibcode']))
+        # meta.json records the full text it is consistent with, which is
+        # not touched
+        stored_file_path = compressed_file_name(full_text_output_file_path,
+                                                compression)
+        meta_dict['fulltext_file'] = file_fingerprint(stored_file_path)
+        meta_dict['fulltext_compression'] = compression
+        with WriteSession(bibcode_pair_tree_path, fsync=fsync) as session:
+            session.write(os.path.basename(meta_output_file_path), meta_dict,
+                          json_format=True)
+        if state_store is not None:
+            state_store.update_extraction_state(
+                extraction_state(payload_dictionary))
+        return False
+
+    # The files are published together when the session ends
+    with WriteSession(bibcode_pair_tree_path, fsync=fsync) as session:
+
+        # Write the custom extractions of content to their own files
+        logger.debug('Copying extra meta content')
+        for meta_key_word in META_CONTENT[payload_dictionary['file_format']]:
+            if meta_key_word in ('dataset', 'fulltext'):
+                continue
+
+            logger.debug(meta_key_word)
+            try:
+                meta_key_word_value = meta_dict[meta_key_word]
+
+                try:
+                    meta_constant_file_name = meta_key_word + '.txt'
+                    logger.debug('Writing {0} to file at: {1}'.format(
+                        meta_key_word, os.path.join(bibcode_pair_tree_path,
+                                                    meta_constant_file_name)))
+                    session.write(meta_constant_file_name, meta_key_word_value,
+                                  json_format=False)
+                    logger.info('WriteMetaFile: completed bibcode: {0}'.format(
+                        payload_dictionary['bibcode']))
+                except IOError:
+                    logger.error('IO Error when writing to file.')
+                    raise IOError
+
+            except KeyError:
+                logger.debug('Does not contain the following meta data: {0}'
+                             .format(meta_key_word))
+                continue
+
+        # Write the full text content to its own file fulltext.txt
+        logger.debug('Copying full text content')
+
+        if 'fulltext' in payload_dictionary and payload_dictionary['fulltext'] != "":
+            try:
+                logger.debug('Writing to file: {0}'.format(full_text_output_file_path))
+                logger.debug('Content has length: {0}'.format(len(payload_dictionary['fulltext'])))
+                if payload_dictionary['file_format'] == 'pdf-grobid':
+                    session.write(os.path.basename(full_text_output_file_path),
+                                  payload_dictionary['fulltext'], json_format=False)
+                else:
+                    session.write_stored(os.path.basename(full_text_output_file_path),
+                                         payload_dictionary['fulltext'],
+                                         compression=compression,
+                                         previous_compression=previous_compression)
+                    stored_file_name = compressed_file_name(
+                        os.path.basename(full_text_output_file_path), compression)
+                    meta_dict['fulltext_file'] = file_fingerprint(
+                        stored_file_name,
+                        os.stat(session.staged_path(stored_file_name)))
+                    meta_dict['fulltext_compression'] = compression
+                logger.debug('Writing complete.')
+            except IOError:
+                logger.exception('IO Error when writing to file {0}'.format(payload_dictionary['bibcode']))
+                raise IOError
+        #else:
+            #logger.warning('No fulltext found for dictionary {0}'.format(payload_dictionary['bibcode']))
 
+        if payload_dictionary['file_format'] != "pdf-grobid":
+            # Do not write meta-data if it is a grobid extraction, only grobid_fulltext.xml is required
+            # and we avoid over-writting valid meta-data from the regular PDF extraction
             try:
-                meta_constant_file_path = os.path.join(bibcode_pair_tree_path,
-                                                       meta_key_word) + '.txt'
-                logger.debug('Writing {0} to file at: {1}'.format(
-                    meta_key_word, meta_constant_file_path))
-                write_file(meta_constant_file_path, meta_key_word_value,
-                           json_format=False)
-                logger.info('WriteMetaFile: completed bibcode: {0}'.format(
-                    payload_dictionary['bibcode']))
+                logger.debug('Writing to file: {0}'.format(meta_output_file_path))
+                logger.debug('Content has keys: {0}'.format((meta_dict.keys())))
+                session.write(os.path.basename(meta_output_file_path), meta_dict,
+                              json_format=True)
+                logger.debug('Writing complete.')
             except IOError:
-                logger.error('IO Error when writing to file.')
+                logger.exception('IO Error when writing to file.')
                 raise IOError
 
-        except KeyError:
-            logger.debug('Does not contain the following meta data: {0}'
-                         .format(meta_key_word))
-            continue
+    if payload_dictionary['file_format'] != "pdf-grobid":
+        if state_store is not None:
+            logger.debug('Updating extraction state of: {0}'.format(
+                payload_dictionary['bibcode']))
+            state_store.update_extraction_state(
+                extraction_state(payload_dictionary))
 
-    # Write the full text content to its own file fulltext.txt
-    logger.debug('Copying full text content')
+    return True
 
-    if 'fulltext' in payload_dictionary and payload_dictionary['fulltext'] != "":
-        try:
-            logger.debug('Writing to file: {0}'.format(full_text_output_file_path))
-            logger.debug('Content has length: {0}'.format(len(payload_dictionary['fulltext'])))
-            write_file(full_text_output_file_path, payload_dictionary['fulltext'], json_format=False)
-            logger.debug('Writing complete.')
-        except IOError:
-            logger.exception('IO Error when writing to file {0}'.format(payload_dictionary['bibcode']))
-            raise IOError
-    #else:
-        #logger.warning('No fulltext found for dictionary {0}'.format(payload_dictionary['bibcode']))
 
-    if payload_dictionary['file_format'] != "pdf-grobid":
-        # Do not write meta-data if it is a grobid extraction, only grobid_fulltext.xml is required
-        # and we avoid over-writting valid meta-data from the regular PDF extraction
-        try:
-            logger.debug('Writing to file: {0}'.format(meta_output_file_path))
-            logger.debug('Content has keys: {0}'.format((meta_dict.keys())))
-            write_file(meta_output_file_path, meta_dict, json_format=True)
-            logger.debug('Writing complete.')
-        except IOError:
-            logger.exception('IO Error when writing to file.')
-            raise IOError
+def migrate_fulltext(bibcode_pair_tree_path, compression=None,
+                     fsync=FSYNC_NONE):
+    """
+    Stores the full text of an extracted document with the given compression,
+    whatever the compression it currently has. The modification time of the
+    full text is kept, so that the checker does not see the document as stale
+    or changed.
+
+    :param bibcode_pair_tree_path: directory of the document
+    :param compression: one of utils.FULLTEXT_COMPRESSIONS
+    :param fsync: fsync policy, one of FSYNC_POLICIES
+    :return: the sizes of the full text file before and after, or None if it
+    is already stored with the compression, or does not exist
+    """
+
+    check_compression(compression)
+
+    full_text_file_path = os.path.join(bibcode_pair_tree_path, 'fulltext.txt')
+    stored_file_path = find_stored_file(full_text_file_path, None)
+    if stored_file_path is None or stored_file_path == \
+            compressed_file_name(full_text_file_path, compression):
+        return None
+
+    stat = os.stat(stored_file_path)
+    fulltext = reader.read_file(stored_file_path, json_format=False)
+    meta_file_path = os.path.join(bibcode_pair_tree_path, COMMIT_FILE)
+    try:
+        meta_dict = reader.read_file(meta_file_path, json_format=True)
+    except IOError:
+        meta_dict = None
+
+    new_file_path = compressed_file_name(full_text_file_path, compression)
+    new_file_name = os.path.basename(new_file_path)
+    with WriteSession(bibcode_pair_tree_path, fsync=fsync) as session:
+        session.write_stored('fulltext.txt', fulltext, compression=compression,
+                             previous_compression=file_compression(
+                                 stored_file_path))
+        os.utime(session.staged_path(new_file_name),
+                 (stat.st_atime, stat.st_mtime))
+        if meta_dict is not None:
+            # meta.json records the full text it was written with
+            meta_dict['fulltext_file'] = file_fingerprint(
+                new_file_name, os.stat(session.staged_path(new_file_name)))
+            meta_dict['fulltext_compression'] = compression
+            session.write(COMMIT_FILE, meta_dict, json_format=True)
+
+    return stat.st_size, os.path.getsize(new_file_path)
 
 
 def extract_content(input_list, **kwargs):
@@ -213,7 +682,8 @@ def extract_content(input_list, **kwargs):
     be passed on to an external pipeline.
 
     :param input_list: containing a dictionary for each article extracted
-    :param kwargs: currently redundant
+    :param kwargs: fsync, the fsync policy of the files written, and
+    compression, the compression of the full text
     :return: list of bibcodes written to disk and converted to json format
     """
 
@@ -222,7 +692,8 @@ def extract_content(input_list, **kwargs):
     bibcode_list = []
     for dict_item in input_list:
         try:
-            write_content(dict_item)
+            write_content(dict_item, fsync=kwargs.get('fsync', FSYNC_NONE),
+                          compression=kwargs.get('compression', None))
             bibcode_list.append(dict_item['bibcode'])
         except Exception:
             import traceback
@@ -9,6 +9,9 @@ from adsputils import setup_logging
 
 logger = setup_logging('run.py')
 
+# Records grouped into a single CheckIfExtract message
+PACKET_SIZE = 100
+
 
 def read_links_from_file(file_input, force_extract=False, force_send=False):
     """
@@ -26,6 +29,33 @@ def read_links_from_file(file_input, force_extract=False, force_send=False):
     return FileInputStream
 
 
+def stream_links_from_file(file_input, force_extract=False, force_send=False,
+                           packet_size=PACKET_SIZE, snapshot=None):
+    """
+    Opens the link file given and lazily parses the content into packets of
+    records, so that publishing can start before the whole file is read.
+
+    :param file_input: path to the link file
+    :param force_extract: did the user bypass the internal checks
+    :param force_send: always send results to master, even for already extracted files
+    :param packet_size: maximum number of records per packet
+    :param snapshot: snapshot of the previous run, only changed records are kept
+    unless the extraction or the sending is forced
+    :return: generator of lists of records (see utils.py)
+    """
+
+    FileInputStream = utils.FileInputStream(file_input)
+    records = FileInputStream.stream(
+        force_extract=force_extract,
+        force_send=force_send
+    )
+
+    if snapshot is not None:
+        records = snapshot.changed(records, force=force_extract or force_send)
+
+    return utils.make_packets(records, packet_size)
+
+
 def run(full_text_links, **kwargs):
     """
     Locates the file specified by the user, loads the list of bibcodes and
@@ -57,17 +87,6 @@ def run(full_text_links, **kwargs):
     else:
         diagnose = False
 
-
-    if diagnose:
-        print("Calling 'read_links_from_file' with filename '{}', force_extract set to '{}' and force_send set to '{}'".format(full_text_links, str(force_extract), str(force_send)))
-    logger.debug("Calling 'read_links_from_file' with filename '%s', force_extract set to '%s and force_send set to '%s''", full_text_links, str(force_extract), str(force_send))
-    records = read_links_from_file(
-        full_text_links,
-        force_extract=force_extract,
-        force_send=force_send
-    )
-
-
     logger.info('Setting variables')
     if 'max_queue_size' in kwargs:
         max_queue_size = kwargs['max_queue_size']
@@ -75,26 +94,91 @@ def run(full_text_links, **kwargs):
     else:
         max_queue_size = 0
 
+    if 'packet_size' in kwargs and kwargs['packet_size']:
+        packet_size = kwargs['packet_size']
+    else:
+        packet_size = PACKET_SIZE
+    logger.info('Packet size: %d' % packet_size)
+
+    if 'snapshot' in kwargs and kwargs['snapshot']:
+        snapshot = utils.LinksSnapshot(kwargs['snapshot'])
+        logger.info('Loaded {0:d} records from snapshot: {1}'.format(
+            snapshot.load(), kwargs['snapshot']))
+    else:
+        snapshot = None
+
+    if diagnose:
+        print("Calling 'stream_links_from_file' with filename '{}', force_extract set to '{}' and force_send set to '{}'".format(full_text_links, str(force_extract), str(force_send)))
+    logger.debug("Calling 'stream_links_from_file' with filename '%s', force_extract set to '%s and force_send set to '%s''", full_text_links, str(force_extract), str(force_send))
+    records = stream_links_from_file(
+        full_text_links,
+        force_extract=force_extract,
+        force_send=force_send,
+        packet_size=packet_size,
+        snapshot=snapshot
+    )
+
     logger.info('Publishing records to: CheckIfExtract')
 
+    # The links file is read while publishing, so the total is not known
+    # in advance and reading stops as soon as max_queue_size is reached
     i = 0
-    total = len(records.payload)
-    for record in records.payload:
-        logger.info(
-            'Publishing [{0:d}/{1:d}]: [{2}]'.format(
-                i+1, total, record['bibcode'])
-        )
+    for packet in records:
+        if max_queue_size and i + len(packet) > max_queue_size:
+            packet = packet[:max_queue_size - i]
+
+        if packet:
+            i += len(packet)
+            logger.info(
+                'Publishing [{0:d}]: [{1}]'.format(
+                    i, ', '.join([record['bibcode'] for record in packet]))
+            )
+            publish_packet(packet, i, diagnose=diagnose)
+            if snapshot is not None:
+                snapshot.published(packet)
 
         if max_queue_size and i >= max_queue_size:
             logger.info('Max_queue_size reached, stopping...')
             break
 
+    logger.info('Published {0:d} records'.format(i))
+
+    if snapshot is not None:
+        logger.info('Skipped {0:d} unchanged records'.format(snapshot.unchanged))
+        if snapshot.complete:
+            logger.info('{0:d} records were removed from the links file'.format(
+                len(snapshot.removed)))
+            for bibcode in snapshot.removed:
+                logger.debug('Removed from the links file: {0}'.format(bibcode))
         if diagnose:
-            print("[{}/{}] Calling 'task_check_if_extract' with '{}'".format(i+1, total, str(record)))
-        logger.debug("[%i/%i] Calling 'task_check_if_extract' with '%s'", i+1, total, str(record))
-        tasks.task_check_if_extract.delay(record)
-        #tasks.task_check_if_extract(record) # Treat synchronously to avoid saturating NFS mount access
-        i += 1
+            print("Not updating snapshot '{}' in diagnose mode".format(kwargs['snapshot']))
+        else:
+            logger.info('Saved {0:d} records to snapshot: {1}'.format(
+                snapshot.save(), kwargs['snapshot']))
+
+
+def publish_packet(packet, i, diagnose=False):
+    """
+    Sends a group of records to the CheckIfExtract queue as a single message.
+    A packet containing only one record is sent as a plain dictionary, which
+    keeps the original one-message-per-record behaviour for a packet size of 1.
+
+    :param packet: list of record dictionaries to publish
+    :param i: number of records published so far, including this packet
+    :param diagnose: print what is being sent
+    :return: no return
+    """
+
+    if len(packet) == 1:
+        message = packet[0]
+    else:
+        message = packet
+
+    if diagnose:
+        print("[{}] Calling 'task_check_if_extract' with '{}'".format(i, str(message)))
+    logger.debug("[%i] Calling 'task_check_if_extract' with '%s'", i, str(message))
+    tasks.task_check_if_extract.delay(message)
+    #tasks.task_check_if_extract(message) # Treat synchronously to avoid saturating NFS mount access
 
 def build_diagnostics(bibcodes=None, raw_files=None, providers=None):
     tmp_file = tempfile.NamedTemporaryFile(delete=False)
@@ -123,7 +207,26 @@ if __name__ == '__main__':
                         dest='max_queue_size',
                         action='store',
                         type=int,
-                        help='The maximum number of packets in a queue')
+                        help='The maximum number of records published'
+                             ' (0 publishes every record)')
+
+    parser.add_argument('-n',
+                        '--packet_size',
+                        dest='packet_size',
+                        action='store',
+                        type=int,
+                        help='Number of records grouped into a single'
+                             ' CheckIfExtract message (1 sends one message'
+                             ' per record)')
+
+    parser.add_argument('-i',
+                        '--snapshot',
+                        dest='snapshot',
+                        action='store',
+                        type=str,
+                        help='Path to the links snapshot of the previous run.'
+                             ' Only new or changed records are published and'
+                             ' the snapshot is updated afterwards')
 
     parser.add_argument('-e',
                         '--extract_force',
@@ -166,12 +269,13 @@ if __name__ == '__main__':
                         help='Comma delimited list of providers (for diagnostics)')
 
     parser.set_defaults(full_text_links=False)
-    parser.set_defaults(packet_size=100)
+    parser.set_defaults(packet_size=PACKET_SIZE)
     parser.set_defaults(purge_queues=False)
     parser.set_defaults(max_queue_size=0)
     parser.set_defaults(force_extract=False)
     parser.set_defaults(force_send=False)
     parser.set_defaults(diagnose=False)
+    parser.set_defaults(snapshot=None)
 
     args = parser.parse_args()
 
@@ -207,6 +311,7 @@ if __name__ == '__main__':
         max_queue_size=args.max_queue_size,
         force_extract=args.force_extract,
         force_send=args.force_send,
+        snapshot=args.snapshot,
         diagnose=args.diagnose)
 
     if args.diagnose:
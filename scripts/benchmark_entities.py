@@ -0,0 +1,79 @@
+"""
+Micro-benchmark of entitydefs.convertentities on entity-dense documents.
+
+"legacy" is the previous implementation: re.sub calling entitymap for every
+entity matched. "current" is convertentities as it is. Both are checked to
+give the same output before being timed.
+
+The documents are the stub XML serialised the way open_xml does before
+converting the entities (every non-ASCII character becomes a numeric
+entity), the stub HTML, and a synthetic math-heavy text mixing named,
+numeric and unknown entities.
+
+Run as:
+   python scripts/benchmark_entities.py [repetitions]
+"""
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '../')))
+from adsft import entitydefs as edef
+from lxml.html import soupparser
+from lxml.etree import tostring
+
+STUB_DATA = os.path.realpath(os.path.join(
+    os.path.dirname(__file__), '../tests/test_unit/stub_data'))
+
+
+def convertentities_legacy(input_string):
+    return re.sub('&(#\d+|#x[0-9a-fA-F]+|\w+);', edef.entitymap,
+                  input_string)
+
+
+def serialised_xml(file_name):
+    with open(os.path.join(STUB_DATA, file_name), 'rb') as f:
+        return tostring(soupparser.fromstring(f.read()))
+
+
+def raw_html(file_name):
+    with open(os.path.join(STUB_DATA, file_name), 'rb') as f:
+        return f.read().decode('utf-8')
+
+
+def math_text(size):
+    """Text where about one word in two is an entity"""
+    words = ['&alpha;', 'flux', '&#8722;', '&le;', 'M&#8857;', 'x&sup2;',
+             '&unknown;', '&amp;', '&#x3b2;', 'with', '&Sigma;', '&nbsp;']
+    text = ' '.join(words)
+    return (text * (size / len(text) + 1))[:size]
+
+
+DOCUMENTS = (
+    ('test.astro-ph-0002105.tei.xml', lambda: serialised_xml(
+        'test.astro-ph-0002105.tei.xml')),
+    ('test.stmp_2_1_014010.iop.xml', lambda: serialised_xml(
+        'test.stmp_2_1_014010.iop.xml')),
+    ('test.html', lambda: raw_html('test.html')),
+    ('math text (500k)', lambda: math_text(500000)),
+)
+
+
+if __name__ == '__main__':
+
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    print '{0:>30} {1:>9} {2:>12} {3:>13} {4:>8}'.format(
+        'document', 'entities', 'legacy (ms)', 'current (ms)', 'speedup')
+    for name, document in DOCUMENTS:
+        text = document()
+        assert edef.convertentities(text) == convertentities_legacy(text)
+        legacy = min(timeit.repeat(lambda: convertentities_legacy(text),
+                                   number=1, repeat=repetitions)) * 1000
+        current = min(timeit.repeat(lambda: edef.convertentities(text),
+                                    number=1, repeat=repetitions)) * 1000
+        print '{0:>30} {1:>9d} {2:>12.3f} {3:>13.3f} {4:>7.1f}x'.format(
+            name, len(edef.ENTITY.findall(text)), legacy, current,
+            legacy / current)
@@ -0,0 +1,126 @@
+"""
+Micro-benchmark of TextCleaner. It measures the cost of a single
+TextCleaner(text=...).run(...) call for texts of the sizes found in the
+pipeline: dataset identifiers and acknowledgements (one call per XPath hit),
+and full text bodies.
+
+"legacy" runs the cleaner as it used to: it rebuilds the translation maps for
+every call and translates one character at a time through the map. "current"
+is TextCleaner as it is.
+
+The throughput of the whole pipeline, without rebuilding the maps, is then
+reported in MB/s on the stub data files, after checking that both versions
+give byte-identical output.
+
+Run as:
+   python scripts/benchmark_text_cleaner.py [repetitions]
+"""
+
+import os
+import sys
+import string
+import glob
+import re
+import timeit
+import unicodedata
+
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '../')))
+from adsft import utils
+
+# characters per call: dataset id, acknowledgements, body, large body
+DOCUMENT_SIZES = (50, 1000, 50000, 500000)
+
+
+def legacy_maps():
+    """Builds the translation maps the way the old constructor did"""
+    ascii_map = string.maketrans(
+        ''.join([chr(i) for i in range(0, 32)]),
+        ''.join([chr(i) if i in [9, 10] else ' ' for i in range(0, 32)]))
+    unicode_map = dict.fromkeys(
+        unicode_number
+        for starting_unicode_number, ending_unicode_number
+        in utils.UNICODE_CONTROL_NUMBERS
+        for unicode_number
+        in range(starting_unicode_number, ending_unicode_number+1)
+    )
+    return ascii_map, unicode_map
+
+
+def sample_text(size):
+    """Unicode text of the given size built from the test stub data"""
+    stub = os.path.realpath(os.path.join(
+        os.path.dirname(__file__), '../tests/test_unit/stub_data/test.html'))
+    with open(stub, 'r') as f:
+        text = f.read().decode('utf-8', 'ignore')
+    return (text * (size / len(text) + 1))[:size]
+
+
+def stub_texts():
+    """Text of every stub data file, as TextCleaner would see it"""
+    root = os.path.realpath(os.path.join(os.path.dirname(__file__), '../tests'))
+    texts = {}
+    for stub in sorted(glob.glob(os.path.join(root, '*/stub_data/*.*'))):
+        if os.path.isfile(stub) and not stub.endswith('.pdf'):
+            with open(stub, 'r') as f:
+                texts[os.path.basename(stub)] = f.read().decode('utf-8', 'ignore')
+    return texts
+
+
+def clean(text):
+    return utils.TextCleaner(text=text).run(translate=True, decode=True,
+                                            normalise=True, trim=True)
+
+
+def clean_legacy(text, maps=None):
+    ascii_map, unicode_map = maps or legacy_maps()
+    if type(text) == str:
+        text = text.translate(ascii_map)
+    else:
+        text = text.translate(unicode_map)
+    if type(text) == str:
+        text = text.decode('utf-8', 'ignore')
+    text = unicodedata.normalize('NFKC', unicode(text))
+    text = re.sub(r'\S{200,}\b', '', text)
+    return re.sub('  +', ' ', text)
+
+
+def throughput(function, text, repetitions):
+    """MB/s of the utf-8 encoded text"""
+    seconds = min(timeit.repeat(lambda: function(text), number=1,
+                                repeat=repetitions))
+    return len(text.encode('utf-8')) / 1e6 / seconds
+
+
+if __name__ == '__main__':
+
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    print '{0:>10} {1:>14} {2:>14} {3:>8}'.format(
+        'size', 'legacy (ms)', 'current (ms)', 'speedup')
+    for size in DOCUMENT_SIZES:
+        text = sample_text(size)
+        assert clean(text) == clean_legacy(text)
+        legacy = min(timeit.repeat(lambda: clean_legacy(text), number=1,
+                                   repeat=repetitions)) * 1000
+        current = min(timeit.repeat(lambda: clean(text), number=1,
+                                    repeat=repetitions)) * 1000
+        print '{0:>10d} {1:>14.3f} {2:>14.3f} {3:>7.1f}x'.format(
+            size, legacy, current, legacy / current)
+
+    print
+    print '{0:>50} {1:>14} {2:>14}'.format(
+        'file', 'legacy (MB/s)', 'current (MB/s)')
+    texts = stub_texts()
+    # tables extracted as runs of words without spaces
+    words = sample_text(500000).split()
+    texts['table-like body'] = u' '.join(
+        u''.join(words[i:i + 40]) if i % 400 == 0 else u' '.join(words[i:i + 40])
+        for i in range(0, len(words), 40))
+    maps = legacy_maps()
+    for name, text in sorted(texts.items()):
+        assert clean(text).encode('utf-8') == \
+            clean_legacy(text, maps).encode('utf-8')
+        print '{0:>50} {1:>14.1f} {2:>14.1f}'.format(
+            name[-50:],
+            throughput(lambda t: clean_legacy(t, maps), text, repetitions),
+            throughput(clean, text, repetitions))
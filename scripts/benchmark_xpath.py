@@ -0,0 +1,94 @@
+"""
+Micro-benchmark of the XPath evaluation done by the extractors. For each stub
+document, it measures the cost of evaluating every rule of its file format
+once, as extract_multi_content does for a document.
+
+"legacy" evaluates the XPath strings with element.xpath, which compiles them
+on every call, and builds the table links XPath for each table with
+str.replace. "current" uses the compiled XPath of the rules registry.
+
+Run as:
+   python scripts/benchmark_xpath.py [repetitions]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '../')))
+from adsft import extraction
+from adsft.rules import META_CONTENT, compiled_xpath
+
+STUB_DATA = os.path.realpath(os.path.join(
+    os.path.dirname(__file__), '../tests/test_unit/stub_data'))
+
+# stub document, file format, and extractor used to parse it
+DOCUMENTS = (
+    ('test.xml', 'xml'),
+    ('test.astro-ph-0002105.tei.xml', 'teixml'),
+    ('test_elsevier.xml', 'xmlelsevier'),
+    ('test.html', 'html'),
+)
+
+EXTRACTORS = {
+    'xml': 'xml',
+    'teixml': 'teixml',
+    'xmlelsevier': 'elsevier',
+    'html': 'html',
+}
+
+# names of the tables linked by A&A HTML articles
+TABLE_NAMES = ['tableE.{0}.html'.format(i) for i in range(1, 6)]
+
+
+def parsed_document(file_name, file_format):
+    """Parses the stub document the way its extractor does"""
+    extractor = extraction.EXTRACTOR_FACTORY[EXTRACTORS[file_format]](
+        {'ft_source': os.path.join(STUB_DATA, file_name), 'bibcode': 'TEST'})
+    if file_format == 'html':
+        extractor.open_html()
+        return extractor.parse_html()
+    extractor.open_xml()
+    return extractor.parse_xml()
+
+
+def rules(file_format):
+    """XPath expressions of the rules of the file format"""
+    for rule in META_CONTENT[file_format].values():
+        for xpath in (rule['xpath'] if isinstance(rule, dict) else rule):
+            yield xpath
+
+
+def evaluate_legacy(root, file_format):
+    for xpath in rules(file_format):
+        if '$table_name' in xpath:
+            legacy_xpath = xpath.replace('$table_name', '"TABLE_NAME"')
+            for table_name in TABLE_NAMES:
+                root.xpath(legacy_xpath.replace('TABLE_NAME', table_name))
+        else:
+            root.xpath(xpath)
+
+
+def evaluate(root, file_format):
+    for xpath in rules(file_format):
+        if '$table_name' in xpath:
+            for table_name in TABLE_NAMES:
+                compiled_xpath(xpath)(root, table_name=table_name)
+        else:
+            compiled_xpath(xpath)(root)
+
+
+if __name__ == '__main__':
+
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    print '{0:>32} {1:>14} {2:>14} {3:>8}'.format(
+        'document', 'legacy (us)', 'current (us)', 'speedup')
+    for file_name, file_format in DOCUMENTS:
+        root = parsed_document(file_name, file_format)
+        legacy = min(timeit.repeat(lambda: evaluate_legacy(root, file_format),
+                                   number=1, repeat=repetitions)) * 1e6
+        current = min(timeit.repeat(lambda: evaluate(root, file_format),
+                                    number=1, repeat=repetitions)) * 1e6
+        print '{0:>32} {1:>14.1f} {2:>14.1f} {3:>7.1f}x'.format(
+            file_name, legacy, current, legacy / current)
@@ -0,0 +1,134 @@
+"""
+Consumer of the extract-grobid queue, to run instead of the Celery workers
+of that queue: a single process keeps up to GROBID_IN_FLIGHT PDFs at the
+Grobid service at all times (see GrobidStage in adsft/grobid.py), whereas a
+worker process sends the PDFs of one message at a time and waits for all of
+them before taking the next message.
+
+The messages are those sent to task_extract_grobid. Up to GROBID_IN_FLIGHT
+of them are taken from the queue at a time, and each is acknowledged once
+all its PDFs are written (or failed, which is logged, as task_extract_grobid
+does). The messages not acknowledged when the consumer is stopped are sent
+again to the next consumer.
+
+Run as:
+   python scripts/grobid_consumer.py [-k 16]
+"""
+
+import os
+import sys
+import Queue
+import socket
+import argparse
+
+PROJ_HOME = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+sys.path.append(PROJ_HOME)
+from kombu import Connection, Consumer
+from adsft import tasks, extraction, grobid
+
+app = tasks.app
+logger = tasks.logger
+
+
+def task_messages(body):
+    """
+    The messages of a task_extract_grobid task, sent with the protocol 2 of
+    Celery (body of args, kwargs, embed) or 1 (body with the args)
+    """
+    args = body['args'] if isinstance(body, dict) else body[0]
+    message = args[0]
+    if not isinstance(message, list):
+        message = [message]
+    return message
+
+
+def acknowledge(finished):
+    """
+    Acknowledges the messages whose PDFs are all written or failed
+
+    :param finished: queue of the messages and their number of failed PDFs
+    :return: no return
+    """
+
+    while True:
+        try:
+            message, failed = finished.get_nowait()
+        except Queue.Empty:
+            return
+        if failed:
+            logger.warning('%s PDFs of a message failed', failed)
+        message.ack()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Consumes the extract-grobid'
+                                     ' queue.')
+    parser.add_argument('-k',
+                        '--in-flight',
+                        dest='in_flight',
+                        action='store',
+                        type=int,
+                        default=app.conf.get('GROBID_IN_FLIGHT', 16),
+                        help='Number of PDFs at the Grobid service at the'
+                             ' same time')
+    args = parser.parse_args()
+
+    if app.conf['GROBID_SERVICE'] is None:
+        parser.error('GROBID_SERVICE is not set')
+
+    client = grobid.GrobidClient(
+        app.conf['GROBID_SERVICE'],
+        concurrency=args.in_flight,
+        timeout=app.conf.get('GROBID_TIMEOUT', 120),
+        max_retries=app.conf.get('GROBID_MAX_RETRIES', 5),
+        backoff=app.conf.get('GROBID_BACKOFF', 1.0))
+
+    def extract(msg):
+        # Modify file format to force the use of GrobidPDFExtractor
+        msg['file_format'] += "-grobid"
+        return extraction.extract_content([msg], grobid_client=client)
+
+    stage = grobid.GrobidStage(extract, tasks.output_storage().write,
+                               in_flight=args.in_flight)
+
+    # the messages are acknowledged by this thread, the channel is not
+    # shared with the threads of the stage
+    finished = Queue.Queue()
+
+    def on_message(body, message):
+        try:
+            documents = task_messages(body)
+        except (KeyError, IndexError, TypeError):
+            logger.error('Unexpected message on extract-grobid: %r', body)
+            message.reject()
+            return
+        stage.submit(documents, done=lambda failed: finished.put((message, failed)))
+
+    queue = [q for q in app.conf.CELERY_QUEUES if q.name == 'extract-grobid'][0]
+    with Connection(app.conf['CELERY_BROKER']) as connection:
+        with Consumer(connection, [queue], callbacks=[on_message],
+                      accept=app.conf.accept_content) as consumer:
+            consumer.qos(prefetch_count=args.in_flight)
+            logger.info('Consuming extract-grobid with %s PDFs in flight', args.in_flight)
+            try:
+                while True:
+                    try:
+                        connection.drain_events(timeout=0.1)
+                    except socket.timeout:
+                        pass
+                    acknowledge(finished)
+            except KeyboardInterrupt:
+                logger.info('Stopping: %s', dict(stage.stats))
+            finally:
+                stage.close()
+                # the messages finished while the stage was closed are
+                # acknowledged before the connection is released, or they
+                # would be extracted again by the next consumer
+                try:
+                    acknowledge(finished)
+                except Exception:
+                    logger.exception('Could not acknowledge the messages finished'
+                                     ' while stopping, they will be sent again')
+                client.close()
+                tasks.close_output_storage()
@@ -0,0 +1,104 @@
+"""
+Converts the full text files of an extracted tree to the given compression
+(see FULLTEXT_COMPRESSION in config.py), or back to plain fulltext.txt files.
+
+Each document is rewritten with writer.migrate_fulltext: the new file is
+renamed in place and the old one removed, so the pipeline can keep running
+while a tree is migrated. Documents already stored with the compression are
+skipped, so an interrupted migration can be run again.
+
+Run as:
+   python scripts/migrate_fulltext.py -c gzip [-p /proj/ads/fulltext/extracted] [-d]
+"""
+
+import os
+import sys
+import argparse
+
+PROJ_HOME = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+sys.path.append(PROJ_HOME)
+from adsft import writer
+from adsft.utils import check_compression, compressed_file_name, \
+    find_stored_file, stored_file_names
+from adsputils import load_config, setup_logging
+
+logger = setup_logging('migrate_fulltext.py')
+
+
+def document_paths(extract_path):
+    """Directories of the tree that contain a full text file"""
+    names = set(os.path.basename(name)
+                for name in stored_file_names('fulltext.txt'))
+    for path, dirs, files in os.walk(extract_path):
+        dirs.sort()
+        if names.intersection(files):
+            yield path
+
+
+if __name__ == '__main__':
+
+    config = load_config(proj_home=PROJ_HOME)
+
+    parser = argparse.ArgumentParser(description='Converts the full text '
+                                     'files of an extracted tree to the given '
+                                     'compression.')
+
+    parser.add_argument('-c',
+                        '--compression',
+                        dest='compression',
+                        action='store',
+                        choices=['none', 'gzip', 'zstd'],
+                        required=True,
+                        help='Compression to store the full text with'
+                             ' (none for plain fulltext.txt files)')
+
+    parser.add_argument('-p',
+                        '--path',
+                        dest='path',
+                        action='store',
+                        default=config['FULLTEXT_EXTRACT_PATH'],
+                        help='Root of the extracted tree'
+                             ' (default: FULLTEXT_EXTRACT_PATH)')
+
+    parser.add_argument('-d',
+                        '--dry_run',
+                        dest='dry_run',
+                        action='store_true',
+                        default=False,
+                        help='Only count the documents to convert')
+
+    args = parser.parse_args()
+    compression = None if args.compression == 'none' else args.compression
+    check_compression(compression)
+
+    documents = converted = failed = 0
+    size_before = size_after = 0
+    for path in document_paths(args.path):
+        documents += 1
+        if args.dry_run:
+            full_text_file_path = os.path.join(path, 'fulltext.txt')
+            if find_stored_file(full_text_file_path) != \
+                    compressed_file_name(full_text_file_path, compression):
+                converted += 1
+            continue
+        try:
+            sizes = writer.migrate_fulltext(
+                path, compression=compression,
+                fsync=config.get('WRITE_FSYNC', writer.FSYNC_NONE))
+        except Exception as err:
+            failed += 1
+            logger.error('Could not convert {0}: {1}'.format(path, err))
+            continue
+        if sizes is not None:
+            converted += 1
+            size_before += sizes[0]
+            size_after += sizes[1]
+            logger.debug('Converted {0}: {1} -> {2} bytes'.format(
+                path, sizes[0], sizes[1]))
+
+    print '{0} documents with a full text, {1} {2}, {3} failed'.format(
+        documents, converted, 'to convert' if args.dry_run else 'converted',
+        failed)
+    if size_before:
+        print '{0} bytes before, {1} bytes after ({2:.1f}%)'.format(
+            size_before, size_after, 100. * size_after / size_before)
@@ -0,0 +1,13 @@
+#!/bin/bash
+
+# Start the PDF extractor in server mode: it extracts the PDFs requested on
+# STDIN until STDIN is closed (see App.serve for the protocol)
+
+# modify these lines if you need to change java/locations etc.
+
+java=java
+home=`dirname "$BASH_SOURCE"`
+jar=$home/../target/ADSfulltext-1.2-SNAPSHOT-jar-with-dependencies.jar
+
+# exec, so that the pid and the memory use seen by the client are the JVM's
+exec $java -jar $jar --server
@@ -0,0 +1,83 @@
+"""
+Removes the temporary files left in the extracted tree by writers that died
+while writing a document (see writer.WriteSession). Writers do not look for
+them, so that writing a document does not list its directory: run this
+periodically instead, e.g. from cron.
+
+Only the files older than the given age are removed, so it can run while the
+pipeline is writing documents.
+
+Run as:
+   python scripts/remove_stale_temp_files.py [-p /proj/ads/fulltext/extracted] [-a 3600] [-d]
+"""
+
+import os
+import sys
+import time
+import argparse
+
+PROJ_HOME = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+sys.path.append(PROJ_HOME)
+from adsft import writer
+from adsputils import load_config, setup_logging
+
+logger = setup_logging('remove_stale_temp_files.py')
+
+
+def temp_file_paths(extract_path):
+    """Directories of the tree that contain a temporary file"""
+    for path, dirs, files in os.walk(extract_path):
+        dirs.sort()
+        if any(name.startswith(writer.TEMP_FILE_PREFIX) for name in files):
+            yield path
+
+
+if __name__ == '__main__':
+
+    config = load_config(proj_home=PROJ_HOME)
+
+    parser = argparse.ArgumentParser(description='Removes the stale temporary '
+                                     'files of an extracted tree.')
+
+    parser.add_argument('-p',
+                        '--path',
+                        dest='path',
+                        action='store',
+                        default=config['FULLTEXT_EXTRACT_PATH'],
+                        help='Root of the extracted tree'
+                             ' (default: FULLTEXT_EXTRACT_PATH)')
+
+    parser.add_argument('-a',
+                        '--age',
+                        dest='age',
+                        action='store',
+                        type=int,
+                        default=writer.STALE_TEMP_FILE_AGE,
+                        help='Age in seconds above which a temporary file is'
+                             ' stale (default: {0})'.format(
+                                 writer.STALE_TEMP_FILE_AGE))
+
+    parser.add_argument('-d',
+                        '--dry_run',
+                        dest='dry_run',
+                        action='store_true',
+                        default=False,
+                        help='Only count the stale temporary files')
+
+    args = parser.parse_args()
+
+    limit = time.time() - args.age
+    directories = removed = 0
+    for path in temp_file_paths(args.path):
+        directories += 1
+        if args.dry_run:
+            for name in os.listdir(path):
+                temp_file_name = os.path.join(path, name)
+                if name.startswith(writer.TEMP_FILE_PREFIX) and \
+                        os.path.getmtime(temp_file_name) < limit:
+                    removed += 1
+            continue
+        removed += writer.remove_stale_temp_files(path, age=args.age)
+
+    print '{0} directories with temporary files, {1} stale files {2}'.format(
+        directories, removed, 'to remove' if args.dry_run else 'removed')
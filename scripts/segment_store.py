@@ -0,0 +1,76 @@
+"""
+Maintenance of the segment store (OUTPUT_BACKEND = 'segments', see
+adsft/storage.py):
+
+  check    verifies that the index and the segment files agree
+  compact  rewrites the sealed segments with too much dead data
+  seal     seals the segments left open by worker processes that died, so
+           that they can be compacted (only give segments whose owner is
+           known to be gone)
+
+Run as:
+   python scripts/segment_store.py check
+   python scripts/segment_store.py compact [-r 0.5]
+   python scripts/segment_store.py seal SEGMENT [SEGMENT ...]
+"""
+
+import os
+import sys
+import argparse
+
+PROJ_HOME = os.path.realpath(os.path.join(os.path.dirname(__file__), '../'))
+sys.path.append(PROJ_HOME)
+from adsft import app as app_module
+from adsft import storage
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Maintenance of the segment'
+                                     ' store.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('check', help='Check the index and the segments')
+    compact = subparsers.add_parser('compact', help='Compact the segments')
+    compact.add_argument('-r',
+                         '--ratio',
+                         dest='ratio',
+                         action='store',
+                         type=float,
+                         default=storage.COMPACTION_LIVE_RATIO,
+                         help='Compact the sealed segments with less live'
+                              ' data than this ratio (1 compacts every'
+                              ' segment with dead data)')
+    seal = subparsers.add_parser('seal', help='Seal segments left open')
+    seal.add_argument('segments', nargs='+', help='Names of the segments')
+
+    args = parser.parse_args()
+
+    app = app_module.ADSFulltextCelery('segment-store', proj_home=PROJ_HOME)
+    config = dict(app.conf, OUTPUT_BACKEND='segments')
+    if not app.database_enabled():
+        parser.error('SQLALCHEMY_URL is not set, the segment store has no'
+                     ' index')
+    store = storage.get_storage(config, index=app)
+
+    if args.command == 'check':
+        report = store.check()
+        print '{0} segments, {1} live records, {2} dead records'.format(
+            report['segments'], report['live'], report['dead'])
+        for problem in ('missing', 'truncated', 'corrupted', 'unknown'):
+            for item in report[problem]:
+                print '{0}: {1}'.format(problem, item)
+        if any(report[problem] for problem in
+               ('missing', 'truncated', 'corrupted')):
+            sys.exit(1)
+
+    elif args.command == 'compact':
+        report = store.compact(live_ratio=args.ratio)
+        print '{0} segments compacted, {1} records moved, {2} bytes' \
+              ' freed'.format(report['segments'], report['records'],
+                              report['freed'])
+
+    elif args.command == 'seal':
+        for name in args.segments:
+            app.update_segment({'name': name, 'sealed': True,
+                                'size': os.path.getsize(
+                                    store.segment_path(name))})
+            print 'sealed: {0}'.format(name)
@@ -9,6 +9,9 @@
 // This class is the main application layer that starts the Java PDF Extractor. This should be activated by,
 // and maintained by supervisord.
 //
+// With --server, it extracts the PDFs requested on stdin until stdin is closed, so that the JVM start and the
+// PDFBox class loading are paid once for many files (see serve() for the protocol, and adsft/pdfserver.py).
+//
 
 package org.adslabs.adsfulltext;
 
@@ -21,12 +24,27 @@ import net.sourceforge.argparse4j.inf.Namespace;
 import net.sourceforge.argparse4j.inf.MutuallyExclusiveGroup;
 import net.sourceforge.argparse4j.impl.Arguments;
 
+import org.apache.log4j.Appender;
+import org.apache.log4j.ConsoleAppender;
+import org.apache.log4j.LogManager;
+
 import java.nio.file.Files;
 import java.nio.file.Paths;
 import java.nio.charset.StandardCharsets;
+import java.util.ArrayList;
+import java.util.Collections;
 import java.util.List;
 import java.lang.String;
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.EOFException;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
 import java.io.IOException;
+import java.io.InputStream;
+import java.io.OutputStream;
 import java.io.PrintStream;
 
 public class App {
@@ -34,8 +52,78 @@ public class App {
     // Variable declaration
     // --------------------------
     static Logger logger = LoggerFactory.getLogger(App.class);
+
+    static final byte STATUS_OK = 'O';
+    static final byte STATUS_ERROR = 'E';
     // --------------------------
 
+    // Server mode: extracts the PDFs requested on in, and writes their text to out, until in is closed.
+    //
+    // Request:  4 byte big-endian length, then the path of the PDF in UTF-8. A length of 0 is a ping.
+    // Response: 1 status byte, 'O' or 'E', 4 byte big-endian length, then the text of the PDF or the
+    //           error message in UTF-8. A ping is answered with 'O' and "pong".
+    //
+    // Errors extracting a PDF are answered with 'E' and the server carries on. Any other error (e.g., out of
+    // memory) ends the server, the client is expected to start a new one.
+    //
+    public static void serve(InputStream in, OutputStream out, PDFExtract extractor) throws IOException {
+
+        DataInputStream requests = new DataInputStream(new BufferedInputStream(in));
+        DataOutputStream responses = new DataOutputStream(new BufferedOutputStream(out));
+
+        while (true) {
+            int length;
+            try {
+                length = requests.readInt();
+            } catch (EOFException error) {
+                logger.debug("Input closed, stopping the server");
+                return;
+            }
+            byte[] request = new byte[length];
+            requests.readFully(request);
+
+            byte status = STATUS_OK;
+            String result;
+            if (length == 0) {
+                result = "pong";
+            } else {
+                String file = new String(request, StandardCharsets.UTF_8);
+                logger.debug("Extracting: " + file);
+                try {
+                    result = extractor.extract(file);
+                } catch (Exception error) {
+                    logger.error("Failed extracting {}, error: {}", file, error.getMessage());
+                    status = STATUS_ERROR;
+                    result = error.getMessage() != null ? error.getMessage() : error.toString();
+                }
+            }
+
+            byte[] response = result.getBytes(StandardCharsets.UTF_8);
+            responses.writeByte(status);
+            responses.writeInt(response.length);
+            responses.write(response);
+            responses.flush();
+        }
+    }
+
+    // stdout carries the responses in server mode: the console appenders log to stderr instead
+    //
+    private static void redirectConsoleLogging() {
+        List<org.apache.log4j.Logger> loggers = new ArrayList<org.apache.log4j.Logger>();
+        loggers.add(LogManager.getRootLogger());
+        for (Object current: Collections.list(LogManager.getCurrentLoggers())) {
+            loggers.add((org.apache.log4j.Logger) current);
+        }
+        for (org.apache.log4j.Logger current: loggers) {
+            for (Object appender: Collections.list(current.getAllAppenders())) {
+                if (appender instanceof ConsoleAppender) {
+                    ((ConsoleAppender) appender).setTarget(ConsoleAppender.SYSTEM_ERR);
+                    ((ConsoleAppender) appender).activateOptions();
+                }
+            }
+        }
+    }
+
     public static void main(String[] args) throws Exception {
 
         // Parsing details
@@ -47,8 +135,11 @@ public class App {
         parser.addArgument("pdfs")
               .metavar("N")
               .type(String.class)
-              .nargs("+")
+              .nargs("*")
               .help("Location of the source pdf[| + output path to save results to]");
+        parser.addArgument("--server")
+              .action(Arguments.storeTrue())
+              .help("Extract the PDFs requested on stdin until it is closed (see App.serve)");
         // -------------------------------------------------------------------
         Namespace ns = null;
         try {
@@ -61,6 +152,19 @@ public class App {
          
         PDFExtract extractor = new PDFExtract();
         String result = null;
+
+        if (ns.getBoolean("server")) {
+            OutputStream out = new FileOutputStream(FileDescriptor.out);
+            redirectConsoleLogging();
+            System.setOut(System.err);
+            serve(System.in, out, extractor);
+            System.exit(0);
+        }
+
+        if (((List<String>) ns.get("pdfs")).isEmpty()) {
+            parser.printUsage();
+            System.exit(1);
+        }
         
         for (String file: (List<String>) ns.get("pdfs")) {
           if (file.indexOf("|") > -1) {
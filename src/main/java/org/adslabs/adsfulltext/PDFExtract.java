@@ -103,19 +103,22 @@ public class PDFExtract {
             throw new Exception(message, error);
         }
 
-        // Create the PDF parser of the document of interest
+        // Create the PDF parser of the document of interest, parse the document and obtain the
+        // PDDocument, followed by extracting the content
+        // Make sure we close the PDDocument at the end, or the file if the parser could not be
+        // created or the file could not be parsed (the extractor is reused for every file in
+        // server mode, see App)
+        this.pdDocument = null;
         try {
-            logger.debug("Creating PDF parser for the PDF file");
-            this.pdfParser = new PDFParser(pdfFile);
-        } catch (java.io.IOException error) {
-            String message = "There is an error loading the COSDocument: " + error.getMessage();
-            logger.error(message);
-            throw new Exception(message, error);
-        }
+            try {
+                logger.debug("Creating PDF parser for the PDF file");
+                this.pdfParser = new PDFParser(pdfFile);
+            } catch (java.io.IOException error) {
+                String message = "There is an error loading the COSDocument: " + error.getMessage();
+                logger.error(message);
+                throw new Exception(message, error);
+            }
 
-        // Parse the document and obtain the PDDocument, followed by extracting the content
-        // Make sure we close the PDDocument at the end
-        try {
             logger.debug("Parsing and extracting the PDF file");
             this.pdfParser.parse();
             this.pdDocument = this.pdfParser.getPDDocument();
@@ -128,7 +131,11 @@ public class PDFExtract {
         } finally {
             try {
                 logger.debug("Closing all relevant PDF content.");
-                this.pdDocument.close();
+                if (this.pdDocument != null) {
+                    this.pdDocument.close();
+                } else {
+                    this.pdfFile.close();
+                }
             } catch (java.io.IOException error) {
                 String message = "There is an error loading the PDFBox Stripper properties: " + error.getMessage();
                 logger.error(message);
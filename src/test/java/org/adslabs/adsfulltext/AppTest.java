@@ -0,0 +1,58 @@
+package org.adslabs.adsfulltext;
+//
+// This class is to test the server mode of the App class, with requests and responses kept in memory.
+//
+
+import org.junit.Test; // for @Test annotation
+import static org.junit.Assert.*; // for assertThat()
+import static org.hamcrest.CoreMatchers.containsString;
+
+import java.io.ByteArrayInputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.nio.charset.StandardCharsets;
+
+import org.adslabs.adsfulltext.App;
+import org.adslabs.adsfulltext.PDFExtract;
+
+public class AppTest {
+
+    PDFExtract extractor = new PDFExtract();
+
+    private static void request(DataOutputStream requests, String file) throws Exception {
+        byte[] request = file.getBytes(StandardCharsets.UTF_8);
+        requests.writeInt(request.length);
+        requests.write(request);
+    }
+
+    private static String response(DataInputStream responses, byte status) throws Exception {
+        assertEquals(status, responses.readByte());
+        byte[] response = new byte[responses.readInt()];
+        responses.readFully(response);
+        return new String(response, StandardCharsets.UTF_8);
+    }
+
+    @Test
+    public void testServerExtractsUntilInputIsClosed() throws Exception {
+        String test_pdf = getClass().getResource("/test_doc.pdf").getFile();
+
+        ByteArrayOutputStream input = new ByteArrayOutputStream();
+        DataOutputStream requests = new DataOutputStream(input);
+        request(requests, "");
+        request(requests, test_pdf);
+        request(requests, "/does/not/exist.pdf");
+        request(requests, test_pdf);
+
+        ByteArrayOutputStream output = new ByteArrayOutputStream();
+        App.serve(new ByteArrayInputStream(input.toByteArray()), output, extractor);
+
+        DataInputStream responses = new DataInputStream(new ByteArrayInputStream(output.toByteArray()));
+        assertEquals("pong", response(responses, App.STATUS_OK));
+        assertThat(response(responses, App.STATUS_OK), containsString("This is a PDF document"));
+        assertThat(response(responses, App.STATUS_ERROR), containsString("File not found"));
+        // the server carries on after an error
+        assertThat(response(responses, App.STATUS_OK), containsString("This is a PDF document"));
+        assertEquals(0, responses.available());
+    }
+}
@@ -0,0 +1,46 @@
+"""
+Stand-in for the PDF extractor in server mode (see App.serve), used by the
+tests of adsft/pdfserver.py. The "text" of a PDF is its path, except for
+paths containing:
+
+  error   answered with an error
+  crash   the server exits
+  hang    the server does not answer
+  big     a 3 MB text
+"""
+
+import os
+import sys
+import time
+import struct
+
+
+def main():
+    requests = os.fdopen(sys.stdin.fileno(), 'rb', 0)
+    responses = os.fdopen(sys.stdout.fileno(), 'wb', 0)
+    while True:
+        header = requests.read(4)
+        if len(header) < 4:
+            return 0
+        length, = struct.unpack('>I', header)
+        path = requests.read(length)
+
+        status = 'O'
+        if not path:
+            response = 'pong'
+        elif 'error' in path:
+            status, response = 'E', 'File not found: ' + path
+        elif 'crash' in path:
+            return 3
+        elif 'hang' in path:
+            time.sleep(60)
+            return 0
+        elif 'big' in path:
+            response = 'x' * (3 << 20)
+        else:
+            response = 'text of ' + path
+        responses.write(struct.pack('>cI', status, len(response)) + response)
+
+
+if __name__ == '__main__':
+    sys.exit(main())